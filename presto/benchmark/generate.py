@@ -0,0 +1,183 @@
+# generate.py
+# Generates synthetic product databases for benchmarks, so that performance can be measured without the private product database.
+#
+# Real review data is heavily skewed: a few products get most reviews, and a few users write most of them. Both product
+# popularity and reviewer activity are drawn from Zipf (power law) distributions, which is what makes our hot paths
+# (popular products with huge reviewer pools, prolific reviewers with huge review histories) expensive.
+# Databases use the project schema (data/init/sql_schema) and are loaded through sql_ingest, so all derived tables are populated.
+#
+# Usage (from the presto directory):
+#   python -m benchmark.generate --size small --out benchmark/data/small.sql
+#   python -m benchmark.generate --products 50000 --users 100000 --reviews 1000000 --out benchmark/data/custom.sql
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import shared.connection as connection
+import shared.query as q
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'data', 'ingest')) # sql_ingest is not part of a package
+import sql_ingest as ingest
+
+# Dataset sizes for the benchmark suite
+sizes = {
+    'tiny': {'products': 2_000, 'users': 5_000, 'reviews': 20_000},
+    'small': {'products': 20_000, 'users': 50_000, 'reviews': 300_000},
+    'medium': {'products': 100_000, 'users': 250_000, 'reviews': 2_000_000},
+    'large': {'products': 400_000, 'users': 1_000_000, 'reviews': 10_000_000}
+}
+
+categories = ['Books', 'Music']
+
+_words = [
+    'love', 'night', 'river', 'light', 'dark', 'road', 'fire', 'dream', 'heart', 'home', 'blue', 'gold', 'silver', 'moon',
+    'sun', 'rain', 'summer', 'winter', 'city', 'sea', 'time', 'story', 'song', 'garden', 'house', 'war', 'peace', 'secret',
+    'last', 'first', 'lost', 'wild', 'little', 'great', 'old', 'new', 'world', 'king', 'queen', 'child', 'shadow', 'stone'
+]
+_first_names = ['Anna', 'Ben', 'Carla', 'David', 'Elena', 'Frank', 'Grace', 'Hugo', 'Iris', 'José', 'Kim', 'Léa', 'Marc', 'Nina', 'Omar', 'Zoë']
+_last_names = ['Smith', 'Jones', 'Müller', 'García', 'Rossi', 'Dubois', 'Kowalski', 'Nakamura', 'Silva', 'Jensen', 'Novak', 'Brown']
+
+def get_zipf_weights(count: int, exponent: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    Returns sampling probabilities for count items that follow a Zipf distribution (weight ~ 1 / rank ^ exponent),
+    assigned to items in random order so that popularity does not follow ids.
+    """
+    weights = 1 / np.arange(1, count + 1) ** exponent
+    return rng.permutation(weights / weights.sum())
+
+def get_titles(count: int, rng: np.random.Generator) -> list:
+    words = np.array(_words)
+    lengths = rng.integers(1, 5, count)
+    titles = [' '.join(words[rng.integers(0, len(words), length)]).title() for length in lengths]
+    prefixed = rng.random(count) < 0.1 # some titles start with 'The', which search ignores
+    return ['The ' + title if prefix else title for title, prefix in zip(titles, prefixed)]
+
+def get_products(count: int, creator_exponent = 1.0, rng: np.random.Generator = None) -> pd.DataFrame:
+    """
+    Returns count products in the format of import_products. Creators have Zipf-distributed numbers of products.
+    """
+    rng = rng or np.random.default_rng(0)
+    creator_count = max(count // 5, 1)
+    creator_names = [
+        f'{_first_names[i % len(_first_names)]} {_last_names[(i // len(_first_names)) % len(_last_names)]} {i}'
+        for i in range(creator_count)
+    ]
+    creators = np.array(creator_names, dtype = object)[rng.choice(creator_count, count, p = get_zipf_weights(creator_count, creator_exponent, rng))]
+    products = pd.DataFrame({
+        'title': get_titles(count, rng),
+        'creator': creators,
+        'publisher': '',
+        'description': '',
+        'category': np.array(categories, dtype = object)[rng.integers(0, len(categories), count)],
+        'subcategory': '',
+        'release_date': pd.Timestamp('1960-01-01') + pd.to_timedelta(rng.integers(0, 60 * 365, count), unit = 'D')
+    }, index = pd.Index([f'P{i:09d}' for i in range(count)], name = 'id'))
+    products['release_date'] = products.release_date.dt.strftime('%Y-%m-%d')
+    products['title_search'] = q.search_texts(products.title)
+    products['creator_search'] = q.search_texts(products.creator)
+    return products
+
+def get_reviews(
+    product_ids: np.ndarray,
+    user_count: int,
+    count: int,
+    product_exponent = 1.0,
+    user_exponent = 0.9,
+    anonymous_share = 0.01,
+    rng: np.random.Generator = None,
+    user_prefix = 'U'
+) -> pd.DataFrame:
+    """
+    Returns up to count reviews in the format of import_reviews, at most one per user and product. Products are picked by
+    Zipf-distributed popularity and users by Zipf-distributed activity. A share of reviews is anonymous (no user).
+    """
+    rng = rng or np.random.default_rng(0)
+    product_weights = get_zipf_weights(len(product_ids), product_exponent, rng)
+    user_weights = get_zipf_weights(user_count, user_exponent, rng)
+    pairs = pd.DataFrame({'user': [], 'product': []}, dtype = np.int64)
+    for _ in range(20): # popular products and active users repeat combinations, so sample until we have enough distinct ones
+        sample_size = int((count - len(pairs)) * 1.2) + 1
+        sample = pd.DataFrame({
+            'user': rng.choice(user_count, sample_size, p = user_weights),
+            'product': rng.choice(len(product_ids), sample_size, p = product_weights)
+        })
+        pairs = pd.concat([pairs, sample], ignore_index = True).drop_duplicates()
+        if len(pairs) >= count:
+            break
+    pairs = pairs[:count]
+    size = len(pairs)
+    user_ids = pd.Series([f'{user_prefix}{user:09d}' for user in pairs.user], dtype = object)
+    user_ids[rng.random(size) < anonymous_share] = None
+    return pd.DataFrame({
+        'user_id': user_ids.values,
+        'product_id': np.asarray(product_ids, dtype = object)[pairs['product'].to_numpy()],
+        'title': '',
+        'review': '',
+        'rating': rng.choice([1, 2, 3, 4, 5], size, p = [0.08, 0.07, 0.12, 0.23, 0.5]).astype(float),
+        'upvotes': rng.geometric(0.5, size) - 1,
+        'downvotes': rng.geometric(0.7, size) - 1,
+        'timestamp': 1_000_000_000_000 + rng.integers(0, 700_000_000_000, size)
+    })
+
+def generate_database(
+    path: str,
+    products = 20_000,
+    users = 50_000,
+    reviews = 300_000,
+    product_exponent = 1.0,
+    user_exponent = 0.9,
+    seed = 0,
+    verbosity = 1
+) -> dict:
+    """
+    Creates a synthetic database at path, replacing any existing file. Returns the number of products, users and reviews.
+
+    Parameters
+    ----------
+    - product_exponent: the Zipf exponent of product popularity. Higher values concentrate more reviews on the top products.
+    - user_exponent: the Zipf exponent of reviewer activity
+    - seed: the random seed. The same settings and seed generate the same database.
+    """
+    t = time.perf_counter()
+    def profile(message: str):
+        if verbosity > 0:
+            elapsed = time.perf_counter() - t
+            print(f"{elapsed:.2f}: {message}")
+
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+    rng = np.random.default_rng(seed)
+    conn = connection.open_connection(path)
+    q.update_schema(conn, verbosity = 0)
+    product_data = get_products(products, rng = rng)
+    profile(f'Generated {len(product_data):,d} products')
+    ingest.import_products(product_data, conn, bulk = True, verbosity = 0)
+    review_data = get_reviews(product_data.index.values, users, reviews, product_exponent, user_exponent, rng = rng)
+    profile(f'Generated {len(review_data):,d} reviews')
+    ingest.import_reviews(review_data, conn, bulk = True, verbosity = 0)
+    conn.close()
+    profile(f'Created {path}')
+    return {'products': len(product_data), 'users': int(review_data.user_id.nunique()), 'reviews': len(review_data)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Generate a synthetic product database with power law popularity and reviewer activity')
+    parser.add_argument('--out', required = True)
+    parser.add_argument('--size', choices = list(sizes), default = None, help = 'a predefined size. Counts passed explicitly take precedence.')
+    parser.add_argument('--products', type = int, default = None)
+    parser.add_argument('--users', type = int, default = None)
+    parser.add_argument('--reviews', type = int, default = None)
+    parser.add_argument('--product-exponent', type = float, default = 1.0)
+    parser.add_argument('--user-exponent', type = float, default = 0.9)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+    counts = dict(sizes[args.size or 'small'])
+    counts.update({name: getattr(args, name) for name in counts if getattr(args, name) is not None})
+    generate_database(
+        args.out, **counts,
+        product_exponent = args.product_exponent, user_exponent = args.user_exponent, seed = args.seed
+    )
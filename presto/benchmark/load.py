@@ -0,0 +1,382 @@
+# load.py
+# Load tests get_recommendations under concurrent traffic: requests are replayed from a file or sampled from popular products,
+# and served by a pool of threads or processes, either at a fixed concurrency or at a fixed arrival rate.
+#
+# Reports throughput, latency percentiles, a per-stage breakdown from the tracer (see shared/profile.py) and SQLite lock waits.
+# Optionally a background writer inserts reviews while requests are served, to measure contention between readers and writers.
+# Runs use a scratch copy of the database, since connection settings such as the journal mode are persisted in the file.
+#
+# Closed loop (fixed concurrency): every worker takes the next request as soon as it is done. Latency is the service time.
+# Open loop (fixed rate): requests arrive on a schedule whether or not workers keep up. Latency runs from the scheduled arrival
+# to completion, so queueing delays are included rather than hidden (coordinated omission).
+#
+# Usage (from the presto directory):
+#   python -m benchmark.load --size small --requests 500 --config threads4 workers=4 --config threads8 workers=8
+#   python -m benchmark.load --replay requests.jsonl --config wal rate=20 write_interval=0.5 --config journal rate=20 write_interval=0.5 wal=False
+#   python -m benchmark.load --size small --config processes mode=process workers=4 options.reviewer_max_pool_size=50
+import argparse
+import ast
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import json
+import os
+import shutil
+import sqlite3 as sql
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import shared.connection as connection
+import shared.query as q
+from shared.profile import Histogram, tracer
+from benchmark import generate, run
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'data', 'ingest')) # sql_ingest is not part of a package
+import sql_ingest as ingest
+
+# Settings of a load test run. Configurations override these, e.g. {'workers': 8, 'pragmas': {'cache_size': -65536}}.
+default_settings = {
+    'mode': 'thread',       # 'thread' serves requests from a thread pool sharing a ConnectionPool, 'process' from a process pool
+    'workers': 4,           # the number of threads or processes, i.e. the number of connections serving requests
+    'rate': None,           # requests per second for an open loop. None runs a closed loop at a concurrency of workers.
+    'wal': True,            # write-ahead logging. Without it, readers wait for the writer.
+    'pragmas': {},          # connection pragmas on top of connection.default_pragmas
+    'write_interval': None, # seconds between review batches written by a background writer. None disables writes.
+    'write_batch': 1_000,   # reviews per write
+    'options': {}           # keyword arguments for get_recommendations, e.g. {'reviewer_max_pool_size': 50}
+}
+
+# Lock waits are measured by disabling SQLite's internal busy wait and retrying in Python instead
+busy_pragmas = {'busy_timeout': 0}
+retry_delay = 0.001 # seconds
+
+def get_settings(overrides: dict = None) -> dict:
+    settings = {**default_settings, 'pragmas': dict(default_settings['pragmas']), 'options': dict(default_settings['options'])}
+    for key, value in (overrides or {}).items():
+        if key not in default_settings:
+            raise ValueError(f"Unknown load test setting '{key}'. Use one of: {', '.join(default_settings)}")
+        settings[key] = {**settings[key], **value} if isinstance(settings[key], dict) else value
+    if settings['mode'] not in ['thread', 'process']:
+        raise ValueError(f"Unknown mode '{settings['mode']}'. Use 'thread' or 'process'.")
+    return settings
+
+###########
+# Requests
+###########
+def load_requests(path: str) -> pd.DataFrame:
+    """
+    Reads requests from a CSV or JSON lines file with the columns category, search_term and optionally search_field (default: title)
+    """
+    requests = pd.read_json(path, lines = True) if path.endswith(('.jsonl', '.json')) else pd.read_csv(path)
+    missing = {'category', 'search_term'} - set(requests.columns)
+    if len(missing) > 0:
+        raise ValueError(f"{path} is missing the columns {', '.join(sorted(missing))}")
+    if 'search_field' not in requests.columns:
+        requests['search_field'] = 'title'
+    return requests[['category', 'search_term', 'search_field']]
+
+def sample_requests(conn: sql.Connection, count = 1_000, seed = 0) -> pd.DataFrame:
+    """
+    Returns count title searches for products picked with probability proportional to their review count. Popular products
+    repeat, as they do in real traffic.
+    """
+    products = q.query("""
+    SELECT p.title, p.category, s.review_count
+    FROM product p JOIN product_stats s ON s.product_id = p.id
+    """, conn, verbosity = 0)
+    rng = np.random.default_rng(seed)
+    picks = products.iloc[rng.choice(len(products), count, p = products.review_count / products.review_count.sum())]
+    return pd.DataFrame({'category': picks.category.values, 'search_term': picks.title.values, 'search_field': 'title'})
+
+###########
+# Serving
+###########
+# queries through pandas raise pandas' DatabaseError, caused by the sqlite3 error
+_database_errors = (sql.OperationalError, pd.errors.DatabaseError)
+
+def _is_lock_error(error: Exception) -> bool:
+    message = str(error.__cause__ or error)
+    return 'locked' in message or 'busy' in message
+
+def _get_stage_durations(span, stages: dict, prefix_length: int):
+    # sum the durations of nested spans per path, without the path of the request span itself
+    for child in span.children:
+        path = child.path[prefix_length:]
+        stages[path] = stages.get(path, 0) + child.duration
+        _get_stage_durations(child, stages, prefix_length)
+
+def serve_request(request: dict, conn: sql.Connection, options: dict) -> dict:
+    """
+    Runs get_recommendations for a request and returns its service time, stage durations and lock waits.
+    Attempts that fail because the database is locked are retried, and count as lock wait time.
+    """
+    start = time.perf_counter()
+    lock_wait = 0.0
+    retries = 0
+    while True:
+        attempt = time.perf_counter()
+        try:
+            with tracer.span('request') as span:
+                results = q.get_recommendations(
+                    request['category'], request['search_term'], conn,
+                    search_field = request['search_field'], verbosity = 0, **options
+                )
+            break
+        except _database_errors as error:
+            if not _is_lock_error(error):
+                return {'service': time.perf_counter() - start, 'error': str(error)}
+            retries += 1
+            time.sleep(retry_delay)
+            lock_wait += time.perf_counter() - attempt
+    stages = {}
+    _get_stage_durations(span, stages, len(span.path) + 1)
+    recommendations = results['recommendations']
+    return {
+        'service': time.perf_counter() - start,
+        'stages': stages,
+        'lock_wait': lock_wait,
+        'retries': retries,
+        'recommendations': 0 if recommendations is None else len(recommendations),
+        'error': None
+    }
+
+_process_connection = None
+
+def _init_process(db: str, pragmas: dict):
+    global _process_connection
+    _process_connection = connection.open_connection(db, read_only = True, pragmas = pragmas)
+    tracer.enable()
+
+def _serve_process_request(request: dict, options: dict) -> dict:
+    return serve_request(request, _process_connection, options)
+
+def _write_reviews(pool: connection.ConnectionPool, product_ids: np.ndarray, interval: float, batch: int, stop: threading.Event, stats: dict):
+    """
+    Inserts a batch of new reviews every interval seconds until stop is set, retrying while the database is locked
+    """
+    rng = np.random.default_rng(2)
+    while not stop.wait(interval):
+        reviews = generate.get_reviews(product_ids, batch, batch, rng = rng, user_prefix = f"L{stats['batches']}-")
+        start = time.perf_counter()
+        while True:
+            attempt = time.perf_counter()
+            try:
+                with pool.writer() as conn:
+                    ingest.insert_records(reviews, 'review', conn, include_index = False, commit_batches = False, feedback_batch_size = None)
+                break
+            except _database_errors as error:
+                if not _is_lock_error(error):
+                    raise
+                stats['retries'] += 1
+                time.sleep(retry_delay)
+                stats['lock_wait'] += time.perf_counter() - attempt
+        stats['batches'] += 1
+        stats['reviews'] += len(reviews)
+        stats['seconds'] += time.perf_counter() - start
+
+def run_load(db: str, requests: pd.DataFrame, count: int = None, settings: dict = None, warmup = 10, verbosity = 1) -> dict:
+    """
+    Serves requests against a scratch copy of a database and returns a summary (see summarize).
+
+    Parameters
+    ----------
+    - requests: DataFrame of category, search_term and search_field. Requests are cycled until count requests have been sent.
+    - count: the number of requests to send. Default: the number of requests.
+    - settings: overrides of default_settings
+    - warmup: the number of requests to serve before measuring, to fill page caches
+    """
+    settings = get_settings(settings)
+    count = count or len(requests)
+    records = requests.to_dict('records')
+    schedule = [records[i % len(records)] for i in range(count + warmup)]
+    pragmas = {**settings['pragmas'], **busy_pragmas}
+    options = settings['options']
+    results = [None] * count
+    completions = [None] * count
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'load.sql')
+        shutil.copy(db, path)
+        if not settings['wal']:
+            journal = connection.open_connection(path)
+            journal.execute("PRAGMA journal_mode = DELETE")
+            journal.close()
+        pool = connection.ConnectionPool(path, pragmas = pragmas, wal = settings['wal'])
+        tracer.enable()
+        tracer.reset()
+        if settings['mode'] == 'thread':
+            executor = ThreadPoolExecutor(settings['workers'])
+            submit = lambda request: executor.submit(lambda: serve_request(request, pool.connection(), options))
+        else:
+            executor = ProcessPoolExecutor(settings['workers'], initializer = _init_process, initargs = (path, pragmas))
+            submit = lambda request: executor.submit(_serve_process_request, request, options)
+
+        writer_stats = {'batches': 0, 'reviews': 0, 'seconds': 0.0, 'retries': 0, 'lock_wait': 0.0}
+        stop = threading.Event()
+        writer = None
+        try:
+            for future in [submit(request) for request in schedule[:warmup]]:
+                future.result()
+            if settings['write_interval'] is not None:
+                product_ids = q.query("SELECT id FROM product", pool.connection(), verbosity = 0).id.values
+                writer = threading.Thread(
+                    target = _write_reviews,
+                    args = (pool, product_ids, settings['write_interval'], settings['write_batch'], stop, writer_stats)
+                )
+                writer.start()
+
+            start = time.perf_counter()
+            futures = []
+            for i, request in enumerate(schedule[warmup:]):
+                if settings['rate'] is not None:
+                    delay = start + i / settings['rate'] - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                future = submit(request)
+                future.add_done_callback(lambda future, i = i: completions.__setitem__(i, time.perf_counter()))
+                futures.append(future)
+            for i, future in enumerate(futures):
+                results[i] = future.result()
+            elapsed = max(completions) - start
+        finally:
+            stop.set()
+            if writer is not None:
+                writer.join()
+            executor.shutdown()
+            pool.close()
+            tracer.disable()
+
+    if settings['rate'] is not None:
+        for i, result in enumerate(results):
+            result['latency'] = completions[i] - (start + i / settings['rate'])
+    summary = summarize(results, elapsed, settings)
+    if settings['write_interval'] is not None:
+        summary['writer'] = writer_stats
+    if verbosity > 0:
+        latency = summary['latency']
+        print(
+            f"{summary['requests']:,d} requests in {elapsed:.2f}s: {summary['throughput']:.1f}/s, "
+            f"p50 {latency['p50'] * 1000:.1f}ms, p95 {latency['p95'] * 1000:.1f}ms, p99 {latency['p99'] * 1000:.1f}ms, "
+            f"{summary['lock_waits']['requests']} requests waited for locks"
+        )
+    return summary
+
+###########
+# Reports
+###########
+def summarize(results: list, elapsed: float, settings: dict) -> dict:
+    """
+    Aggregates the results of serve_request into throughput, latency percentiles (see Histogram.get_stats),
+    a per-stage breakdown and lock waits. Each stage reports its share of the total service time.
+    """
+    def get_stats(values) -> dict:
+        histogram = Histogram(max_samples = max(len(values), 1))
+        for value in values:
+            histogram.add(value)
+        return histogram.get_stats()
+
+    completed = [result for result in results if result['error'] is None]
+    service_total = sum(result['service'] for result in completed)
+    stage_durations = {}
+    for result in completed:
+        for path, duration in result['stages'].items():
+            stage_durations.setdefault(path, []).append(duration)
+    stages = {}
+    for path, durations in sorted(stage_durations.items()):
+        stages[path] = get_stats(durations)
+        stages[path]['share'] = stages[path]['total'] / service_total if service_total > 0 else None
+    waits = [result['lock_wait'] for result in completed if result['lock_wait'] > 0]
+    return {
+        'settings': settings,
+        'requests': len(results),
+        'errors': len(results) - len(completed),
+        'elapsed': elapsed,
+        'throughput': len(completed) / elapsed,
+        'latency': get_stats([result.get('latency', result['service']) for result in completed]),
+        'service': get_stats([result['service'] for result in completed]),
+        'stages': stages,
+        'lock_waits': {
+            'requests': len(waits),
+            'retries': sum(result['retries'] for result in completed),
+            **{key: get_stats(waits)[key] for key in ['total', 'p95', 'max']}
+        }
+    }
+
+def compare_summaries(summaries: dict, min_share = 0.01) -> pd.DataFrame:
+    """
+    Returns the main metrics of several runs side by side, one column per configuration.
+    Stages are included by their mean duration if they take at least min_share of the service time in any run.
+    """
+    rows = {}
+    for name, summary in summaries.items():
+        column = {
+            'throughput (requests/s)': summary['throughput'],
+            'errors': summary['errors'],
+            **{f'latency {key} (ms)': summary['latency'][key] * 1000 for key in ['mean', 'p50', 'p95', 'p99', 'max']},
+            'lock wait requests': summary['lock_waits']['requests'],
+            'lock wait total (ms)': summary['lock_waits']['total'] * 1000
+        }
+        if 'writer' in summary:
+            column['writer reviews'] = summary['writer']['reviews']
+            column['writer lock wait (ms)'] = summary['writer']['lock_wait'] * 1000
+        rows[name] = column
+    stage_paths = [
+        path for path in dict.fromkeys(path for summary in summaries.values() for path in summary['stages'])
+        if any((summary['stages'].get(path, {}).get('share') or 0) >= min_share for summary in summaries.values())
+    ]
+    for name, summary in summaries.items():
+        for path in stage_paths:
+            stage = summary['stages'].get(path)
+            rows[name][f'{path} (ms)'] = None if stage is None else stage['mean'] * 1000
+    return pd.DataFrame(rows)
+
+def parse_config(arguments: list) -> tuple:
+    """
+    Parses a configuration from the command line: a name followed by key=value settings.
+    Dotted keys set pragmas and get_recommendations options, e.g. pragmas.cache_size=-65536 options.limit=20.
+    Values are Python literals; anything else is taken as a string.
+    """
+    name, overrides = arguments[0], {}
+    for argument in arguments[1:]:
+        key, _, text = argument.partition('=')
+        try:
+            value = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            value = text
+        section, _, option = key.partition('.')
+        if option:
+            overrides.setdefault(section, {})[option] = value
+        else:
+            overrides[key] = value
+    return name, overrides
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Load test get_recommendations with concurrent requests')
+    parser.add_argument('--db', default = None, help = 'the database to test. Default: the benchmark database of --size.')
+    parser.add_argument('--size', default = 'small', choices = list(generate.sizes))
+    parser.add_argument('--replay', default = None, help = 'a CSV or JSON lines file of requests. Default: sample requests from popular products.')
+    parser.add_argument('--requests', type = int, default = 500, help = 'the number of requests to send')
+    parser.add_argument('--warmup', type = int, default = 10)
+    parser.add_argument('--config', nargs = '+', action = 'append', metavar = ('NAME', 'KEY=VALUE'), help = 'a named configuration to run. Repeat to compare.')
+    parser.add_argument('--out', default = None, help = 'write the summaries to this JSON file')
+    args = parser.parse_args()
+
+    db = args.db or run.get_database(args.size)
+    if args.replay:
+        requests = load_requests(args.replay)
+    else:
+        conn = connection.open_connection(db, read_only = True)
+        requests = sample_requests(conn, args.requests)
+        conn.close()
+    summaries = {}
+    for name, overrides in [parse_config(config) for config in args.config or [['default']]]:
+        print(f'{name}: {overrides}')
+        summaries[name] = run_load(db, requests, args.requests, overrides, warmup = args.warmup)
+    with pd.option_context('display.width', 250, 'display.max_columns', None, 'display.max_colwidth', 120, 'display.float_format', '{:.2f}'.format):
+        print(compare_summaries(summaries))
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(summaries, file, indent = 2)
@@ -0,0 +1,252 @@
+# run.py
+# Times the hot paths of search, recommendations and ingest against synthetic databases of several sizes (see generate.py)
+# and writes the results as JSON, so that the performance of different commits can be compared.
+#
+# Usage (from the presto directory):
+#   python -m benchmark.run --sizes tiny small                    # writes benchmark/results/<time>-<commit>.json
+#   python -m benchmark.run --compare benchmark/results/a.json benchmark/results/b.json
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import shutil
+import sqlite3 as sql
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import shared.connection as connection
+import shared.query as q
+from benchmark import generate
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'data', 'ingest')) # sql_ingest is not part of a package
+import sql_ingest as ingest
+
+benchmark_path = os.path.dirname(os.path.abspath(__file__))
+data_path = os.path.join(benchmark_path, 'data')
+results_path = os.path.join(benchmark_path, 'results')
+
+###########
+# Timing
+###########
+def get_timing_stats(durations: list, records: int = None) -> dict:
+    """
+    Returns summary statistics in seconds for a list of call durations. With records, also the records processed per second.
+    """
+    durations = np.asarray(durations)
+    stats = {
+        'count': len(durations),
+        'min': float(durations.min()),
+        'p50': float(np.percentile(durations, 50)),
+        'mean': float(durations.mean()),
+        'p95': float(np.percentile(durations, 95)),
+        'max': float(durations.max())
+    }
+    if records is not None:
+        stats['records_per_second'] = records / float(durations.sum())
+    return stats
+
+def time_calls(calls: list, warmup = 1) -> list:
+    """
+    Runs each call (a function without arguments) and returns the duration of each. The first warmup calls are run
+    an extra time beforehand, so that page cache and statement cache effects do not end up in the first samples.
+    """
+    for call in calls[:warmup]:
+        call()
+    durations = []
+    for call in calls:
+        t = time.perf_counter()
+        call()
+        durations.append(time.perf_counter() - t)
+    return durations
+
+def get_sample_products(conn: sql.Connection, count = 50, seed = 0) -> pd.DataFrame:
+    """
+    Returns count reviewed products, picked with probability proportional to their review count like real traffic.
+    """
+    products = q.query("""
+    SELECT p.id, p.title, p.title_search, p.category, s.review_count
+    FROM product p JOIN product_stats s ON s.product_id = p.id
+    """, conn, verbosity = 0)
+    rng = np.random.default_rng(seed)
+    weights = products.review_count / products.review_count.sum()
+    return products.iloc[rng.choice(len(products), min(count, len(products)), replace = False, p = weights)]
+
+###########
+# Benchmarks
+###########
+# Each benchmark returns a list of calls to time, given a connection to the benchmark database and sample products
+
+def find_products_exact(conn: sql.Connection, products: pd.DataFrame) -> list:
+    return [
+        lambda product = product: q.find_products(product.category, product.title, conn, exact_match = True, verbosity = 0)
+        for product in products.itertuples()
+    ]
+
+def find_products_like(conn: sql.Connection, products: pd.DataFrame) -> list:
+    # search for a substring of each title, as users typing partial titles do
+    return [
+        lambda product = product: q.find_products(product.category, product.title_search[:6], conn, exact_match = False, verbosity = 0)
+        for product in products.itertuples()
+    ]
+
+def get_reviews(conn: sql.Connection, products: pd.DataFrame) -> list:
+    return [lambda product_id = product_id: q.get_reviews(product_id, conn, verbosity = 0) for product_id in products.id]
+
+def get_related_reviews(conn: sql.Connection, products: pd.DataFrame) -> list:
+    reviews = {product_id: q.get_reviews(product_id, conn, verbosity = 0) for product_id in products.id}
+    return [lambda product_id = product_id: q.get_related_reviews(reviews[product_id], conn, verbosity = 0) for product_id in products.id]
+
+def get_recommendations(conn: sql.Connection, products: pd.DataFrame) -> list:
+    return [
+        lambda product = product: q.get_recommendations(product.category, product.title, conn, verbosity = 0)
+        for product in products.itertuples()
+    ]
+
+def get_records_by_ids(conn: sql.Connection, products: pd.DataFrame, batch_size = 1_000) -> list:
+    product_ids = q.query("SELECT id FROM product", conn, verbosity = 0).id.to_numpy()
+    rng = np.random.default_rng(0)
+    batches = [rng.choice(product_ids, min(batch_size, len(product_ids)), replace = False) for _ in range(len(products))]
+    return [lambda batch = batch: q.get_records_by_ids(batch, 'product', conn, verbosity = 0) for batch in batches]
+
+benchmarks = {
+    'find_products_exact': find_products_exact,
+    'find_products_like': find_products_like,
+    'get_reviews': get_reviews,
+    'get_related_reviews': get_related_reviews,
+    'get_recommendations': get_recommendations,
+    'get_records_by_ids': get_records_by_ids
+}
+
+def benchmark_insert_records(db: str, products: pd.Series, batches = 5, batch_records = 20_000) -> dict:
+    """
+    Times inserting batches of new reviews with insert_records into a scratch copy of a database, which is deleted afterwards.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'insert.sql')
+        shutil.copy(db, path)
+        conn = connection.open_connection(path)
+        rng = np.random.default_rng(1)
+        durations = []
+        for batch in range(batches):
+            reviews = generate.get_reviews(products.values, batch_records, batch_records, rng = rng, user_prefix = f'N{batch}-')
+            t = time.perf_counter()
+            ingest.insert_records(reviews, 'review', conn, include_index = False, feedback_batch_size = None)
+            durations.append(time.perf_counter() - t)
+        conn.close()
+    return get_timing_stats(durations, records = batches * batch_records)
+
+###########
+# Suite
+###########
+def get_environment() -> dict:
+    """
+    Returns the commit and library versions that results were measured with
+    """
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd = benchmark_path, capture_output = True, text = True, check = True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    status = git('status', '--porcelain')
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': None if status is None else len(status) > 0,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'sqlite': sql.sqlite_version,
+        'numpy': np.__version__,
+        'pandas': pd.__version__
+    }
+
+def get_database(size: str, regenerate = False, verbosity = 1) -> str:
+    """
+    Returns the path of the benchmark database of a size, generating it first if needed
+    """
+    path = os.path.join(data_path, f'{size}.sql')
+    if regenerate or not os.path.exists(path):
+        generate.generate_database(path, **generate.sizes[size], verbosity = verbosity)
+    return path
+
+def run_benchmarks(sizes = ('tiny', 'small'), names = None, sample_size = 50, regenerate = False, verbosity = 1) -> dict:
+    """
+    Runs the benchmarks (all by default) against the database of each size and returns the results along with the
+    environment they were measured in.
+
+    Parameters
+    ----------
+    - sizes: dataset sizes as defined in generate.sizes
+    - names: the benchmarks to run: keys of benchmarks, plus 'insert_records'
+    - sample_size: the number of products to run each benchmark for
+    - regenerate: generate the databases even if they already exist
+    """
+    names = names or list(benchmarks) + ['insert_records']
+    results = []
+    for size in sizes:
+        db = get_database(size, regenerate = regenerate, verbosity = verbosity)
+        conn = connection.open_connection(db, read_only = True)
+        products = get_sample_products(conn, sample_size)
+        counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ['product', 'review', 'user_stats']}
+        for name in names:
+            if name == 'insert_records':
+                product_ids = q.query("SELECT id FROM product", conn, verbosity = 0).id
+                stats = benchmark_insert_records(db, product_ids)
+            else:
+                stats = get_timing_stats(time_calls(benchmarks[name](conn, products)))
+            results.append({'size': size, 'benchmark': name, **counts, **stats})
+            if verbosity > 0:
+                print(f"{size:>8} {name:<22} p50 {stats['p50'] * 1000:9.2f}ms  p95 {stats['p95'] * 1000:9.2f}ms")
+        conn.close()
+    return {'environment': get_environment(), 'results': results}
+
+def write_results(results: dict, path: str = None) -> str:
+    """
+    Writes results to a JSON file, by default benchmark/results/<time>-<commit>.json. Returns the path.
+    """
+    if path is None:
+        environment = results['environment']
+        name = datetime.fromisoformat(environment['created']).strftime('%Y%m%d-%H%M%S') + '-' + (environment['commit'] or 'unknown')[:8]
+        path = os.path.join(results_path, name + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+    with open(path, 'w') as file:
+        json.dump(results, file, indent = 2)
+    return path
+
+def compare_results(base_path: str, new_path: str, threshold = 0.1) -> pd.DataFrame:
+    """
+    Compares the median latencies of two result files. Benchmarks that got more than threshold (10%) slower or faster
+    are flagged as regressions or improvements.
+    """
+    def load(path: str) -> pd.DataFrame:
+        with open(path) as file:
+            return pd.DataFrame(json.load(file)['results']).set_index(['size', 'benchmark'])
+    base, new = load(base_path), load(new_path)
+    comparison = pd.DataFrame({'base_p50': base.p50, 'new_p50': new.p50}).dropna()
+    comparison['ratio'] = comparison.new_p50 / comparison.base_p50
+    comparison['change'] = np.select(
+        [comparison.ratio > 1 + threshold, comparison.ratio < 1 - threshold], ['regression', 'improvement'], ''
+    )
+    return comparison
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Run the benchmark suite against synthetic databases')
+    parser.add_argument('--sizes', nargs = '+', default = ['tiny', 'small'], choices = list(generate.sizes))
+    parser.add_argument('--benchmarks', nargs = '+', default = None, choices = list(benchmarks) + ['insert_records'])
+    parser.add_argument('--samples', type = int, default = 50, help = 'products to run each benchmark for')
+    parser.add_argument('--regenerate', action = 'store_true', help = 'generate the databases even if they exist')
+    parser.add_argument('--out', default = None, help = 'the results file. Default: benchmark/results/<time>-<commit>.json')
+    parser.add_argument('--compare', nargs = 2, metavar = ('BASE', 'NEW'), help = 'compare two results files instead of running benchmarks')
+    args = parser.parse_args()
+    if args.compare:
+        with pd.option_context('display.width', 200):
+            print(compare_results(*args.compare))
+    else:
+        results = run_benchmarks(args.sizes, args.benchmarks, sample_size = args.samples, regenerate = args.regenerate)
+        print(f'Wrote {write_results(results, args.out)}')
@@ -1,7 +1,10 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import csv
+import io
 import json
 import os
 import pandas as pd
+import shutil
 import time
 
 # JSONL TO CSV
@@ -46,6 +49,7 @@ def jsonl_to_csv(
     Saves results in batches for potentially long operations that can be paused and resumed.
     If the destination file exists, new records will be appended to the end of the file. This allows us to potentially consolidate multiple 
     jsonl files into a single CSV file.
+    Note that resuming appends all records again: to import jsonl data into the database with resumable progress, use sql_ingest.stream_jsonl.
     """
     # to do: how to make a properly documented enum-type string for if_exists?
     csv_filename = csvpath or jsonpath.replace('jsonl', 'csv')    
@@ -80,4 +84,151 @@ def jsonl_to_csv(
                     profile(f'Finshed converting {count} records from json to csv.\nSee {csv_filename} for results.', t0)
                 break
 
+
+# PARALLEL CONVERSION
+# Parsing JSON is CPU-bound, so jsonl_to_csv is limited to a single core. jsonl_to_csv_parallel splits the file into byte ranges
+# that start and end on line boundaries, and converts each range into its own CSV shard in a pool of worker processes.
+# Workers parse records into plain dicts and only create one DataFrame per shard, rather than one pd.Series per record.
+
+def get_chunks(path: str, chunk_size = 64 * 1024 ** 2) -> list:
+    """
+    Splits a file into (start, end) byte ranges of roughly chunk_size bytes. Every range ends at the end of a line.
+    """
+    size = os.path.getsize(path)
+    chunks = []
+    with open(path, 'rb') as file:
+        start = 0
+        while start < size:
+            file.seek(min(start + chunk_size, size))
+            file.readline() # move on to the end of the line we landed in
+            end = min(file.tell(), size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+def convert_chunk(jsonpath: str, start: int, end: int, csvpath: str, process_record = None) -> tuple:
+    """
+    Converts the records in a byte range of a jsonl file (see get_chunks) to a CSV file. Runs inside a worker process.
+    process_record, if given, transforms each record (a dict) and must be picklable, e.g. a function defined at module level.
+
+    Returns (number of records, seconds spent, worker process id)
+    """
+    t = time.perf_counter()
+    with open(jsonpath, 'rb') as file:
+        file.seek(start)
+        lines = file.read(end - start).splitlines()
+    records = [json.loads(line) for line in lines if line.strip()]
+    if process_record is not None:
+        records = [process_record(record) for record in records]
+    pd.DataFrame.from_records(records).to_csv(csvpath)
+    return len(records), time.perf_counter() - t, os.getpid()
+
+def read_header(path: str) -> list:
+    with open(path, newline = '') as file:
+        return next(csv.reader(file), [])
+
+def merge_shards(shard_paths: list, path: str) -> int:
+    """
+    Appends CSV shards to a single CSV file in order, creating it with a header if it does not exist. Returns the number of shards merged.
+
+    Shards with the same columns are copied as raw bytes. If records in different shards have different fields, 
+    shards are aligned to the union of all columns (in order of appearance), leaving missing values empty. Values are
+    copied as text, never parsed, so that ids like '0439708184' keep their leading zeros.
+    """
+    headers = [read_header(shard_path) for shard_path in shard_paths]
+    columns = list(dict.fromkeys(column for header in headers for column in header[1:])) # the first column is the index
+    file_exists = os.path.exists(path)
+    with open(path, 'ab') as outfile:
+        for i, (shard_path, header) in enumerate(zip(shard_paths, headers)):
+            write_header = i == 0 and not file_exists
+            if header[1:] == columns:
+                with open(shard_path, 'rb') as shard:
+                    header_line = shard.readline()
+                    if write_header:
+                        outfile.write(header_line)
+                    shutil.copyfileobj(shard, outfile)
+            else:
+                # the position of each output column in the shard's rows, None for missing columns
+                positions = [header.index(column) if column in header[1:] else None for column in columns]
+                text = io.TextIOWrapper(outfile, encoding = 'utf-8', newline = '', write_through = True)
+                with open(shard_path, encoding = 'utf-8', newline = '') as shard:
+                    reader, writer = csv.reader(shard), csv.writer(text, lineterminator = '\n')
+                    next(reader, None)
+                    if write_header:
+                        writer.writerow(header[:1] + columns)
+                    for row in reader:
+                        writer.writerow(row[:1] + ['' if position is None else row[position] for position in positions])
+                text.detach() # leaves outfile open
+    return len(shard_paths)
+
+def jsonl_to_csv_parallel(
+        jsonpath: str, csvpath: str = None,
+        process_record = None,
+        chunk_size = 64 * 1024 ** 2,
+        workers = None,
+        merge = True,
+        verbosity = 1,
+        if_exists = 'append'
+) -> list:
+    """
+    Converts potentially large jsonl files to csv using a pool of worker processes. Produces the same CSV format as jsonl_to_csv.
+
+    The file is converted in chunks of about chunk_size bytes, each into its own CSV shard in a '<csv file>.shards' directory.
+    With merge, shards are then appended in order to the destination file (as in jsonl_to_csv) and removed.
+    Without merge, the ordered shards are kept, which avoids copying the data once more when they are loaded separately anyway.
+
+    Returns the paths of the written files: the destination file, or the shards when not merging.
+
+    Parameters
+    ----------
+    - process_record: optional function that transforms each record, given and returning a dict. Unlike jsonl_to_csv's 
+      process_json, it receives a plain dict, and it must be picklable to be sent to worker processes.
+    - workers: the number of worker processes. None uses one per CPU.
+    - if_exists: 'append', 'overwrite' or 'skip', as in jsonl_to_csv
+    """
+    csv_filename = csvpath or jsonpath.replace('jsonl', 'csv')
+    if os.path.exists(csv_filename):
+        if if_exists == 'overwrite':
+            os.remove(csv_filename)
+        if if_exists == 'skip':
+            return [csv_filename]
+    t0 = time.perf_counter()
+    shard_directory = csv_filename + '.shards'
+    if os.path.exists(shard_directory):
+        shutil.rmtree(shard_directory)
+    os.makedirs(shard_directory)
+    chunks = get_chunks(jsonpath, chunk_size = chunk_size)
+    shard_paths = [os.path.join(shard_directory, f'part-{i:05d}.csv') for i in range(len(chunks))]
+    if verbosity > 0:
+        print(f'Converting {jsonpath} in {len(chunks)} chunks')
+
+    count = 0
+    worker_stats = {} # process id -> [records, seconds]
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        futures = [
+            executor.submit(convert_chunk, jsonpath, start, end, shard_path, process_record)
+            for (start, end), shard_path in zip(chunks, shard_paths)
+        ]
+        for future in as_completed(futures):
+            records, seconds, pid = future.result()
+            count += records
+            stats = worker_stats.setdefault(pid, [0, 0.0])
+            stats[0] += records
+            stats[1] += seconds
+            if verbosity > 0:
+                profile(f'converted {count:,} records', t0)
+    if verbosity > 0:
+        for pid, (records, seconds) in worker_stats.items():
+            print(f'\tworker {pid}: {records:,} records @ {records / max(seconds, 1e-9):,.0f} records / sec')
+
+    if not merge:
+        if verbosity > 0:
+            profile(f'Finished converting {count:,} records from json to csv.\nSee {shard_directory} for results.', t0)
+        return shard_paths
+    merge_shards(shard_paths, csv_filename)
+    shutil.rmtree(shard_directory)
+    if verbosity > 0:
+        profile(f'Finished converting {count:,} records from json to csv @ {count / (time.perf_counter() - t0):,.0f} records / sec.\nSee {csv_filename} for results.', t0)
+    return [csv_filename]
+
 # to do: add scripting ability
\ No newline at end of file
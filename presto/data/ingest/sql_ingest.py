@@ -1,15 +1,45 @@
+import ast
 from collections.abc import Iterable 
+import contextlib
+import json
+import os
 import sqlite3 as sql
+import sys
 import time
 
 import numpy as np
 import pandas as pd
+from scipy import sparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')) # the presto directory, for the shared package
+from shared.integer_keys import has_integer_keys
+import shared.query as q
 
 def check_required_columns(data: pd.DataFrame, columns: list):
     missing_columns = set(columns).difference(set(data.columns))
     if len(missing_columns) > 0:
         raise ValueError(f'Missing column(s): {missing_columns}')
 
+# Callbacks to notify after records are inserted, as callback(table, count). Use these to invalidate caches and other derived data.
+# Listeners are notified once the changes are committed, so that they never see (and cache) data from before the commit.
+insert_listeners = []
+
+def add_insert_listener(listener):
+    if listener not in insert_listeners:
+        insert_listeners.append(listener)
+
+def remove_insert_listener(listener):
+    if listener in insert_listeners:
+        insert_listeners.remove(listener)
+
+def notify_change(table: str, count: int):
+    """
+    Notifies insert listeners that count records of a table changed. Ingest functions call this after committing their inserts.
+    Call it yourself after committing changes made outside of them, such as deleting reviews.
+    """
+    for listener in insert_listeners:
+        listener(table, count)
+
 def insert_records(
     data: pd.DataFrame,
     table: str,
@@ -17,8 +47,10 @@ def insert_records(
     include_index = True,
     batch_size = 500,
     commit_batches = True,
-    feedback_batch_size = 100_000
-    # potential future option as needed: how to handle duplicates
+    feedback_batch_size = 100_000,
+    bulk = False,
+    skip_duplicates: list = None,
+    notify = True
 ):    
     """
     Inserts potentially large volumes (millions of records) of Pandas data into an SQL database.
@@ -33,6 +65,12 @@ def insert_records(
     - batch_size: the numer of records to insert into SQL at once. Tuning this parameter is important for performance. Try experimenting with different values to find what is best for your machine.
     - commit_batches: saves changes to disk after each batch. This is recommended for large datasets. If disabled, you are responsible for committing changes to disk as needed. 
     - feedback_batch_size: the number of records after which to emit progressive feedback for progress. Use None to disable all feedback.
+    - bulk: insert all records in a single bulk load (see bulk_load): the table's indexes are rebuilt afterwards and batch_size and 
+      commit_batches are ignored. This is many times faster for large imports, but only use it for offline ingest.
+    - skip_duplicates: optionally, the columns that identify a record (e.g. ['user_id', 'product_id'], or the index name). 
+      Records whose key already exists in the table, or appears earlier in data, are skipped (see remove_duplicates).
+    - notify: notify insert listeners once the records are committed. Without commit_batches (and bulk), records are not 
+      committed here: commit them and call notify_change yourself.
 
     Performance Notes
     -----------------
@@ -50,6 +88,8 @@ def insert_records(
     -1000:   78,000
     -5000:   67,000
     """
+    if skip_duplicates != None:
+        data = remove_duplicates(data, table, conn, skip_duplicates, verbosity = 0 if feedback_batch_size is None else 1)
     count = len(data)
     if feedback_batch_size != None:
         print(f'Inserting {count:,d} records into {table}...')
@@ -57,39 +97,750 @@ def insert_records(
     if include_index:
         columns_str = data.index.name + ',' + columns_str
     placeholder_str = ','.join(['?'] * (data.shape[1] + 1 if include_index else data.shape[1]))
-    batch_count = 1 + count // batch_size
     query = f"""
     INSERT INTO {table}({columns_str})
     VALUES({placeholder_str})
     """
+    if bulk:
+        batch_size = bulk_batch_size
+    batch_count = 1 + count // batch_size
     t = time.perf_counter()
-    for batch in range(batch_count):
-        range_start = batch * batch_size
-        range_end = min(range_start + batch_size, count)
-        records = data.iloc[range_start : range_end].to_records(index = include_index)
-        # Fix: sqlite mangles numpy integers. sqlite documentation states that only Python standard data types are supported for parameterized queries, so this is by design.
-        # To resolve, we convert all numpy ints to standard ints:
-        records = [[int(value) if isinstance(value, np.int64) else value for value in values] for values in records]
-        conn.executemany(query, records)
-        if commit_batches:
-            conn.commit()
-
-        should_emit_feedback = feedback_batch_size != None and (range_end // feedback_batch_size > range_start // feedback_batch_size or range_end >= count)
-        if should_emit_feedback:
+    with bulk_load(conn, [table], verbosity = 0 if feedback_batch_size is None else 1) if bulk else contextlib.nullcontext():
+        for batch in range(batch_count):
+            range_start = batch * batch_size
+            range_end = min(range_start + batch_size, count)
+            conn.executemany(query, get_rows(data.iloc[range_start : range_end], include_index = include_index))
+            if commit_batches and not bulk:
+                conn.commit()
+
+            should_emit_feedback = feedback_batch_size != None and (range_end // feedback_batch_size > range_start // feedback_batch_size or range_end >= count)
+            if should_emit_feedback:
+                elapsed = time.perf_counter() - t
+                progress = range_end / count
+                print(f'{elapsed:.2f}: inserted {range_end:,d} of {count:,d} records ({progress * 100:.1f}%) @ {round(range_end / elapsed)} records / sec')
+    if notify and (commit_batches or bulk):
+        notify_change(table, count)
+
+def get_rows(data: pd.DataFrame, include_index = True):
+    """
+    Returns the records of a DataFrame as rows of SQL parameters, built column by column.
+    """
+    # Fix: sqlite mangles numpy integers. sqlite documentation states that only Python standard data types are supported for parameterized queries, so this is by design.
+    # tolist converts a whole column to standard Python values at once, which is much faster than converting value by value.
+    columns = [data[column].tolist() for column in data.columns]
+    if include_index:
+        columns.insert(0, data.index.tolist())
+    return zip(*columns)
+
+################
+# Bulk loading
+################
+# Inserting millions of records is many times faster when SQLite does not need to update indexes for every record or to 
+# sync to disk for every transaction. A crash or power loss during a bulk load can corrupt the database, so only use bulk 
+# loads for offline ingest, ideally on a copy of the database.
+
+# Applied for the duration of a bulk load, then restored
+bulk_pragmas = {
+    'synchronous': 'OFF',
+    'journal_mode': 'MEMORY'
+}
+bulk_batch_size = 100_000 # records to convert and insert at once during bulk loads
+
+def get_secondary_indexes(table: str, conn: sql.Connection) -> dict:
+    """
+    Returns the CREATE statements of the indexes on a table by index name.
+    Indexes that enforce uniqueness are left out, since records must be checked against them during inserts.
+    """
+    indexes = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", [table]
+    ).fetchall()
+    return {name: statement for name, statement in indexes if not statement.upper().startswith('CREATE UNIQUE')}
+
+@contextlib.contextmanager
+def bulk_load(conn: sql.Connection, tables: list, verbosity = 1):
+    """
+    Context manager for inserting large volumes of records into tables in a single transaction:
+    - Relaxes durability (see bulk_pragmas) for the duration of the load
+    - Drops the tables' secondary indexes before the load and rebuilds them afterwards, which is much faster than updating them record by record
+    - Commits once at the end, then runs ANALYZE on the tables so that the query planner knows about the new data
+
+    On errors, the load is rolled back and the indexes are restored.
+    """
+    t = time.perf_counter()
+    def profile(message: str):
+        if verbosity > 0:
             elapsed = time.perf_counter() - t
-            progress = range_end / count
-            print(f'{elapsed:.2f}: inserted {range_end:,d} of {count:,d} records ({progress * 100:.1f}%) @ {round(range_end / elapsed)} records / sec')
-    
+            print(f"{elapsed:.2f}: {message}")
 
-def import_reviews(reviews: pd.DataFrame, db_connection: sql.Connection):
+    conn.commit() # pragmas can not change journal modes inside a transaction
+    previous_pragmas = {name: conn.execute(f"PRAGMA {name}").fetchone()[0] for name in bulk_pragmas}
+    for name, value in bulk_pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    indexes = {}
+    for table in tables:
+        indexes.update(get_secondary_indexes(table, conn))
+    try:
+        for name in indexes:
+            conn.execute(f"DROP INDEX {name}")
+        profile(f'Dropped {len(indexes)} indexes for bulk load')
+        yield conn
+        conn.commit()
+        profile('Committed bulk load')
+    except:
+        conn.rollback()
+        raise
+    finally:
+        for name, statement in indexes.items():
+            conn.execute(statement)
+            profile(f'Rebuilt index {name}')
+        conn.commit()
+        for name, value in previous_pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+    for table in tables:
+        conn.execute(f"ANALYZE {table}")
+    conn.commit()
+    profile(f'Analyzed {", ".join(tables)}')
+
+def import_reviews(reviews: pd.DataFrame, db_connection: sql.Connection, bulk = False, commit = True, skip_duplicates = False, verbosity = 1):
+    """
+    Inserts reviews and updates review statistics, including co-rating stats once they have been built (see build_corating_stats).
+    Use bulk for large imports (see insert_records).
+    Without commit, nothing is committed so that the caller can commit the import together with other changes (bulk loads always commit).
+    With skip_duplicates, reviews by a user of a product they already reviewed are skipped (see remove_duplicates). 
+    Anonymous reviews are always imported.
+    """
     check_required_columns(reviews, ['product_id', 'user_id', 'rating', 'review', 'title', 'upvotes'])
-    insert_records(reviews, 'review', db_connection, include_index = False)
+    if has_integer_keys(db_connection):
+        reviews = encode_reviews(reviews, db_connection)
+    if skip_duplicates:
+        reviews = remove_duplicates(reviews, 'review', db_connection, review_key_columns, verbosity = verbosity)
+    min_reviews = get_corating_min_reviews(db_connection)
+    first_rowid = None if min_reviews is None else get_next_rowid('review', db_connection)
+    insert_records(
+        reviews, 'review', db_connection, include_index = False, bulk = bulk, 
+        commit_batches = commit, feedback_batch_size = 100_000 if verbosity > 0 else None, notify = False
+    )
+    update_product_stats(reviews, db_connection)
+    update_user_stats(reviews, db_connection)
+    if first_rowid != None:
+        t = time.perf_counter()
+        pair_count = update_corating_stats(db_connection, first_rowid, min_reviews)
+        if verbosity > 0:
+            print(f'{time.perf_counter() - t:.2f}: updated co-rating stats of {pair_count:,d} product pairs')
+    if commit:
+        db_connection.commit()
+        notify_change('review', len(reviews))
+
+################
+# Review stats
+################
+# Review statistics are denormalized into stats tables so that queries can rank by popularity without counting reviews.
+# Every workflow that adds or removes reviews is responsible for keeping them up to date:
+# - Adding reviews: update_product_stats and update_user_stats (called by import_reviews) apply the new reviews incrementally
+#   (co-rating stats are maintained the same way, see update_corating_stats)
+# - Removing or editing reviews: refresh_product_stats and refresh_user_stats recompute statistics for the affected products/users from scratch
+#   (and refresh_corating_stats the co-rating stats of the affected products)
+
+rating_histogram_columns = q.rating_histogram_columns
+
+def get_product_stats(reviews: pd.DataFrame) -> pd.DataFrame:
+    """
+    Given a set of reviews, returns the product_stats record for each reviewed product.
+    """
+    downvotes = reviews.downvotes if 'downvotes' in reviews.columns else 0 # 0 is the SQL default
+    stars = np.floor(reviews.rating.clip(1, 5) + 0.5) # round half up, like SQL ROUND
+    stats = pd.DataFrame({
+        'product_id': reviews.product_id,
+        'review_count': 1,
+        'helpful_review_count': (reviews.upvotes >= downvotes).astype(int),
+        'avg_rating': reviews.rating.astype(float)
+    })
+    for stars_value, column in enumerate(rating_histogram_columns, start = 1):
+        stats[column] = (stars == stars_value).astype(int)
+    aggregations = {column: 'sum' for column in stats.columns if column != 'product_id'}
+    aggregations['avg_rating'] = 'mean'
+    return stats.groupby('product_id').agg(aggregations)
+
+def update_product_stats(reviews: pd.DataFrame, conn: sql.Connection):
+    """
+    Adds newly inserted reviews to the product_stats table. Does not commit.
+    """
+    stats = get_product_stats(reviews)
+    columns = ['product_id'] + list(stats.columns)
+    counts = ['review_count', 'helpful_review_count'] + rating_histogram_columns
+    updates = ',\n'.join([f'{column} = {column} + excluded.{column}' for column in counts])
+    query = f"""
+    INSERT INTO product_stats({','.join(columns)}) VALUES({','.join(['?'] * len(columns))})
+    ON CONFLICT(product_id) DO UPDATE SET
+    avg_rating = (avg_rating * review_count + excluded.avg_rating * excluded.review_count) / (review_count + excluded.review_count),
+    {updates}
+    """
+    records = zip(stats.index.tolist(), *[stats[column].tolist() for column in stats.columns])
+    conn.executemany(query, records)
+
+def _refresh_stats(conn: sql.Connection, table: str, key_column: str, aggregates: dict, ids = None, where = None):
+    """
+    Recomputes a stats table from the review table for the given keys, or for all keys if ids is None.
+    aggregates maps each stats column to the SQL aggregate that computes it (see query.product_stats_aggregates).
+    """
+    conditions = [] if where is None else [where]
+    def refresh(condition_list, params = ()):
+        conn.execute(q.get_stats_statement(table, key_column, aggregates, condition_list), params)
+    if ids is None:
+        conn.execute(f"DELETE FROM {table}")
+        refresh(conditions)
+        return
+    ids = list(ids)
+    batch_size = 10_000 # stay well within sqlite's limit on query parameters
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start : start + batch_size]
+        values = ','.join('?' * len(batch))
+        conn.execute(f"DELETE FROM {table} WHERE {key_column} IN ({values})", batch)
+        refresh(conditions + [f'{key_column} IN ({values})'], batch)
+
+def refresh_product_stats(conn: sql.Connection, product_ids = None):
+    """
+    Recomputes product_stats from the review table for the given products, or for all products if product_ids is None. 
+    Use this after deleting or modifying reviews. Does not commit.
+    """
+    _refresh_stats(conn, 'product_stats', 'product_id', q.product_stats_aggregates, product_ids)
+
+def update_user_stats(reviews: pd.DataFrame, conn: sql.Connection):
+    """
+    Adds newly inserted reviews to the user_stats table. Reviews without a user are ignored. Does not commit.
+    """
+    reviews = reviews[reviews.user_id.notna()]
+    downvotes = reviews.downvotes if 'downvotes' in reviews.columns else 0 # 0 is the SQL default
+    stats = pd.DataFrame({
+        'user_id': reviews.user_id,
+        'review_count': 1,
+        'helpful_review_count': (reviews.upvotes >= downvotes).astype(int)
+    }).groupby('user_id').sum()
+    query = """
+    INSERT INTO user_stats(user_id, review_count, helpful_review_count) VALUES(?,?,?)
+    ON CONFLICT(user_id) DO UPDATE SET
+    review_count = review_count + excluded.review_count,
+    helpful_review_count = helpful_review_count + excluded.helpful_review_count
+    """
+    records = zip(stats.index.tolist(), stats.review_count.tolist(), stats.helpful_review_count.tolist())
+    conn.executemany(query, records)
+
+def refresh_user_stats(conn: sql.Connection, user_ids = None):
+    """
+    Recomputes user_stats from the review table for the given users, or for all users if user_ids is None.
+    Use this after deleting or modifying reviews. Does not commit.
+    """
+    _refresh_stats(conn, 'user_stats', 'user_id', q.user_stats_aggregates, user_ids, where = 'user_id IS NOT NULL')
+
+###################
+# Co-rating stats
+###################
+# The cosine similarity of two products only needs the squared length (norm) of each product's rating vector and the dot
+# product of the two vectors: the sum of rating products over the users who rated both. Both are sums over reviews, so they
+# can be maintained incrementally. A new review only changes the norm of its product and the dot products between its product 
+# and the other products its user rated. product_norm and product_corating hold these sums for products with a minimum
+# number of helpful reviews, so that get_recommendations(..., source = 'corating') reads cosine scores directly.
+# - build_corating_stats computes them from scratch. From then on, import_reviews keeps them up to date (see update_corating_stats)
+# - Removing or editing reviews: refresh_corating_stats recomputes them for the affected products
+# Like live recommendations, only helpful reviews (at least as many upvotes as downvotes) by known users count, and a user 
+# who reviewed a product more than once only counts with their latest review (see query.get_sparse_ratings_by_user).
+
+corating_min_reviews = 20 # default number of helpful reviews a product needs to be tracked
+
+def get_corating_min_reviews(conn: sql.Connection) -> int:
+    """
+    Returns the min_reviews that co-rating stats were built with, or None if they have not been built (see build_corating_stats)
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'corating_settings'").fetchone() is None:
+        return None
+    row = conn.execute("SELECT min_reviews FROM corating_settings").fetchone()
+    return None if row is None else row[0]
+
+def get_next_rowid(table: str, conn: sql.Connection) -> int:
+    """
+    Returns the rowid that the next record inserted into a table will get. Records inserted later always have a higher rowid.
+    """
+    return conn.execute(f"SELECT COALESCE(MAX(rowid), 0) + 1 FROM {table}").fetchone()[0]
+
+def get_tracked_reviews(keys: pd.Series, key_column: str, conn: sql.Connection) -> pd.DataFrame:
+    """
+    Returns the helpful reviews of tracked products (those in product_norm) by the given users or of the given products, 
+    along with their rowid.
+
+    Parameters
+    ----------
+    - key_column: 'user_id' if keys are user ids, 'product_id' if keys are product ids
+    """
+    temp_table = load_keys(pd.DataFrame({key_column: keys.unique()}), [key_column], conn, name = 'corating_keys')
+    reviews = pd.read_sql_query(f"""
+    SELECT r.rowid AS review_rowid, r.user_id, r.product_id, r.rating
+    FROM {temp_table} k JOIN review r ON r.{key_column} = k.{key_column} JOIN product_norm n ON n.product_id = r.product_id
+    WHERE r.user_id IS NOT NULL AND r.upvotes >= r.downvotes
+    """, conn)
+    conn.execute(f"DROP TABLE {temp_table}")
+    return reviews
+
+def get_rating_matrices(reviews: pd.DataFrame, mask = None) -> tuple[sparse.csr_matrix, sparse.csr_matrix, np.ndarray]:
+    """
+    Returns sparse matrices of ratings and of rating counts with users as rows and products as columns, plus the product id 
+    of each column. With a mask, only the masked reviews are included, but rows and columns still cover all reviews.
+    """
+    user_codes, user_ids = pd.factorize(reviews.user_id)
+    product_codes, product_ids = pd.factorize(reviews.product_id)
+    mask = np.ones(len(reviews), dtype = bool) if mask is None else mask
+    shape = (len(user_ids), len(product_ids))
+    def matrix(values: np.ndarray) -> sparse.csr_matrix:
+        return sparse.csr_matrix((values[mask], (user_codes[mask], product_codes[mask])), shape = shape)
+    return matrix(reviews.rating.to_numpy(dtype = float)), matrix(np.ones(len(reviews))), np.asarray(product_ids, dtype = object)
+
+def get_pairs(dot_products: sparse.spmatrix, co_raters: sparse.spmatrix, product_ids: np.ndarray, neighbor_ids: np.ndarray) -> pd.DataFrame:
+    """
+    Returns the product pairs of sparse dot product and co-rater matrices as records for product_corating, 
+    leaving out pairs of a product with itself. The matrices may hold changes (see update_corating_stats), in which case
+    either one can be 0 for a pair whose other value changed.
+    """
+    pattern = (abs(dot_products) + abs(co_raters)).tocoo()
+    def values(matrix: sparse.spmatrix) -> np.ndarray:
+        if pattern.nnz == 0:
+            return np.zeros(0)
+        return np.asarray(matrix.tocsr()[pattern.row, pattern.col]).ravel()
+    pairs = pd.DataFrame({
+        'product_id': product_ids[pattern.row],
+        'neighbor_id': neighbor_ids[pattern.col],
+        'dot_product': values(dot_products),
+        'co_raters': values(co_raters).round().astype(np.int64)
+    })
+    return pairs[pairs.product_id != pairs.neighbor_id]
+
+def get_latest_reviews(reviews: pd.DataFrame) -> pd.DataFrame:
+    """
+    Given reviews with their rowid, return only the latest review of each user and product
+    """
+    return reviews.sort_values('review_rowid').drop_duplicates(['user_id', 'product_id'], keep = 'last')
+
+def get_corating_stats(product_ids: pd.Series, conn: sql.Connection) -> tuple[pd.Series, pd.DataFrame]:
+    """
+    Computes the full co-rating stats of tracked products from their reviews.
+    Returns (sum of squared ratings by product, product pairs in both directions).
+    """
+    raters = get_tracked_reviews(product_ids, 'product_id', conn).user_id
+    reviews = get_latest_reviews(get_tracked_reviews(raters, 'user_id', conn))
+    ratings, counts, columns = get_rating_matrices(reviews)
+    selected = np.flatnonzero(pd.Index(columns).isin(product_ids))
+    pairs = get_pairs(ratings[:, selected].T @ ratings, counts[:, selected].T @ counts, columns[selected], columns)
+    mirrored = pairs.rename(columns = {'product_id': 'neighbor_id', 'neighbor_id': 'product_id'})
+    pairs = pd.concat([pairs, mirrored], ignore_index = True).drop_duplicates(['product_id', 'neighbor_id'])
+    reviews = reviews[reviews.product_id.isin(product_ids)]
+    norms = (reviews.rating.astype(float) ** 2).groupby(reviews.product_id).sum()
+    return norms, pairs
 
+def write_corating_stats(norms: pd.Series, pairs: pd.DataFrame, conn: sql.Connection, add = False):
+    """
+    Writes norms and product pairs. With add, they are added to the existing sums. Otherwise, they replace them. Does not commit.
+    """
+    if add:
+        norm_query = "UPDATE product_norm SET sum_squares = sum_squares + ? WHERE product_id = ?"
+        pair_conflict = "dot_product = dot_product + excluded.dot_product, co_raters = co_raters + excluded.co_raters"
+    else:
+        norm_query = "UPDATE product_norm SET sum_squares = ? WHERE product_id = ?"
+        pair_conflict = "dot_product = excluded.dot_product, co_raters = excluded.co_raters"
+    conn.executemany(norm_query, zip(norms.tolist(), norms.index.tolist()))
+    conn.executemany(f"""
+    INSERT INTO product_corating(product_id, neighbor_id, dot_product, co_raters) VALUES(?,?,?,?)
+    ON CONFLICT(product_id, neighbor_id) DO UPDATE SET {pair_conflict}
+    """, get_rows(pairs, include_index = False))
+
+def build_corating_stats(conn: sql.Connection, min_reviews = corating_min_reviews, chunk_size = 1_000, verbosity = 1) -> int:
+    """
+    Computes product_norm and product_corating from scratch for every product with at least min_reviews helpful reviews, 
+    and commits. Once built, import_reviews maintains them with the same min_reviews. Returns the number of product pairs.
+
+    Parameters
+    ----------
+    - min_reviews: the number of helpful reviews a product needs to be tracked. Products with few reviews have unreliable 
+      similarities and tracking them inflates the number of pairs.
+    - chunk_size: the number of products to compute at once. Memory use grows with the number of pairs per chunk.
+    """
+    t = time.perf_counter()
+    def profile(message: str):
+        if verbosity > 0:
+            elapsed = time.perf_counter() - t
+            print(f"{elapsed:.2f}: {message}")
+
+    conn.execute("DELETE FROM product_corating")
+    conn.execute("DELETE FROM product_norm")
+    conn.execute("DELETE FROM corating_settings")
+    conn.execute("INSERT INTO corating_settings(min_reviews) VALUES(?)", [min_reviews])
+    conn.execute("""
+    INSERT INTO product_norm(product_id, sum_squares) SELECT product_id, 0 FROM product_stats WHERE helpful_review_count >= ?
+    """, [min_reviews])
+    product_ids = pd.read_sql_query("SELECT product_id FROM product_norm", conn).product_id
+    profile(f'Computing co-rating stats for {len(product_ids):,d} products')
+    pair_count = 0
+    for start in range(0, len(product_ids), chunk_size):
+        chunk = product_ids.iloc[start : start + chunk_size]
+        norms, pairs = get_corating_stats(chunk, conn)
+        pairs = pairs[pairs.product_id.isin(chunk)] # the other direction is written with the neighbor's chunk
+        write_corating_stats(norms, pairs, conn)
+        pair_count += len(pairs)
+        profile(f'{min(start + chunk_size, len(product_ids)):,d} of {len(product_ids):,d} products ({pair_count // 2:,d} pairs)')
+    conn.commit()
+    return pair_count // 2
+
+def update_corating_stats(conn: sql.Connection, first_rowid: int, min_reviews: int) -> int:
+    """
+    Adds the reviews inserted since first_rowid (see get_next_rowid) to the co-rating stats. Does not commit.
+    Returns the number of product pairs updated.
+
+    Only the products rated by the new reviews' users are touched. Products that reach min_reviews helpful reviews 
+    (see update_product_stats) start being tracked and get their stats computed in full. Use the min_reviews that the stats 
+    were built with (see get_corating_min_reviews).
+    """
+    new_reviews = pd.read_sql_query("""
+    SELECT user_id, product_id FROM review WHERE rowid >= ? AND user_id IS NOT NULL AND upvotes >= downvotes
+    """, conn, params = [first_rowid])
+    if len(new_reviews) == 0:
+        return 0
+    temp_table = load_keys(pd.DataFrame({'product_id': new_reviews.product_id.unique()}), ['product_id'], conn, name = 'corating_keys')
+    new_products = pd.read_sql_query(f"""
+    SELECT s.product_id FROM {temp_table} k JOIN product_stats s ON s.product_id = k.product_id
+    WHERE s.helpful_review_count >= ? AND NOT EXISTS (SELECT 1 FROM product_norm n WHERE n.product_id = s.product_id)
+    """, conn, params = [min_reviews]).product_id
+    conn.execute(f"DROP TABLE {temp_table}")
+    pair_count = 0
+    if len(new_products) > 0:
+        conn.executemany("INSERT INTO product_norm(product_id, sum_squares) VALUES(?, 0)", [[product_id] for product_id in new_products])
+        norms, pairs = get_corating_stats(new_products, conn)
+        write_corating_stats(norms, pairs, conn)
+        pair_count += len(pairs)
+
+    # reviews of newly tracked products were fully counted above
+    reviews = get_tracked_reviews(new_reviews.user_id, 'user_id', conn)
+    reviews = reviews[~reviews.product_id.isin(new_products)].sort_values('review_rowid')
+    # Only the latest review of a user and product counts. The stats hold the latest of the old reviews: a new review of
+    # the same product replaces it (superseded), and the others stay (kept).
+    is_new = (reviews.review_rowid >= first_rowid).to_numpy()
+    keys = ['user_id', 'product_id']
+    is_latest = ~reviews.duplicated(keys, keep = 'last').to_numpy()
+    was_latest = ~is_new & ~reviews[~is_new].duplicated(keys, keep = 'last').reindex(reviews.index, fill_value = True).to_numpy()
+    added = is_new & is_latest
+    kept = was_latest & is_latest
+    superseded = was_latest & ~is_latest
+    ratings, counts, product_ids = get_rating_matrices(reviews, kept)
+    new_ratings, new_counts, _ = get_rating_matrices(reviews, added)
+    old_ratings, old_counts, _ = get_rating_matrices(reviews, superseded)
+    # with ratings A = kept + added after and B = kept + superseded before, the change A^T A - B^T B is
+    # added^T (kept + added) + kept^T added - superseded^T (kept + superseded) - kept^T superseded
+    pairs = get_pairs(
+        new_ratings.T @ (ratings + new_ratings) + ratings.T @ new_ratings 
+        - old_ratings.T @ (ratings + old_ratings) - ratings.T @ old_ratings, 
+        new_counts.T @ (counts + new_counts) + counts.T @ new_counts 
+        - old_counts.T @ (counts + old_counts) - counts.T @ old_counts, 
+        product_ids, product_ids
+    )
+    squares = reviews.rating.astype(float) ** 2
+    norms = squares[added].groupby(reviews.product_id[added]).sum().sub(
+        squares[superseded].groupby(reviews.product_id[superseded]).sum(), fill_value = 0
+    )
+    write_corating_stats(norms, pairs, conn, add = True)
+    if superseded.any():
+        # pairs whose only co-rater replaced their review of one of the products may no longer be co-rated
+        conn.executemany(
+            "DELETE FROM product_corating WHERE product_id = ? AND neighbor_id = ? AND co_raters <= 0",
+            get_rows(pairs[pairs.co_raters < 0][['product_id', 'neighbor_id']], include_index = False)
+        )
+    return (pair_count + len(pairs)) // 2
+
+def refresh_corating_stats(conn: sql.Connection, product_ids) -> int:
+    """
+    Recomputes the co-rating stats of the given products (norms and their pairs with all other products) from the review table,
+    if co-rating stats have been built. Use this after deleting or modifying reviews. Does not commit.
+    Products stay tracked even if they drop below the min_reviews the stats were built with, as they do on import.
+    Returns the number of product pairs written.
+    """
+    if get_corating_min_reviews(conn) is None:
+        return 0
+    temp_table = load_keys(pd.DataFrame({'product_id': pd.Series(product_ids).unique()}), ['product_id'], conn, name = 'corating_keys')
+    tracked = pd.read_sql_query(f"SELECT n.product_id FROM {temp_table} k JOIN product_norm n ON n.product_id = k.product_id", conn).product_id
+    # pairs are stored in both directions: delete the mirrored pairs by primary key rather than scanning for neighbor_id
+    conn.execute(f"""
+    DELETE FROM product_corating WHERE (product_id, neighbor_id) IN (
+        SELECT c.neighbor_id, c.product_id FROM {temp_table} k JOIN product_corating c ON c.product_id = k.product_id
+    )
+    """)
+    conn.execute(f"DELETE FROM product_corating WHERE product_id IN (SELECT product_id FROM {temp_table})")
+    conn.execute(f"DROP TABLE {temp_table}")
+    if len(tracked) == 0:
+        return 0
+    norms, pairs = get_corating_stats(tracked, conn)
+    write_corating_stats(norms.reindex(tracked, fill_value = 0), pairs, conn) # products without reviews left have a norm of 0
+    return len(pairs)
+
+###########
+# Works
+###########
+# Editions of the same title by the same creator (search-equivalent title_search and creator_search) share a work, 
+# so that search and recommendations can treat them as one product (see the work table in data/init/sql_schema).
+# - Adding products: import_products assigns works to new products (see assign_works)
+# - Editing titles or creators: set work_id to NULL for the affected products and run assign_works again
 
-def import_products(products: pd.DataFrame, connection: sql.Connection):
+def assign_works(conn: sql.Connection) -> int:
+    """
+    Assigns products without a work to the work of their title and creator, creating works as needed (see query.work_statements).
+    Returns the number of products assigned. Does not commit.
+    """
+    if not q.has_works(conn):
+        return 0
+    for statement in q.work_statements:
+        cursor = conn.execute(statement)
+    return cursor.rowcount
+
+def import_products(products: pd.DataFrame, connection: sql.Connection, bulk = False, commit = True, skip_duplicates = False, verbosity = 1):
+    """
+    Inserts products, using the index as product ids. With skip_duplicates, products whose id already exists are skipped.
+    New products are assigned to the work of their title and creator (see assign_works).
+    """
     required_columns = ['title', 'title_search', 'description', 'creator', 'creator_search', 'category']
     check_required_columns(products, required_columns)    
-    insert_records(products, 'product', conn)
+    if has_integer_keys(connection):
+        # product ids are assigned by the database. Our ids are stored as external ids.
+        products = products.rename_axis('external_id')
+    insert_records(
+        products, 'product', connection, bulk = bulk, 
+        commit_batches = commit, feedback_batch_size = 100_000 if verbosity > 0 else None,
+        skip_duplicates = [products.index.name] if skip_duplicates else None, notify = False
+    )
+    assign_works(connection)
+    if commit:
+        connection.commit()
+        notify_change('product', len(products))
+
+####################
+# Streaming ingest
+####################
+# Converting to CSV and loading a full dataset into memory does not scale to arbitrarily large source files.
+# stream_jsonl reads a jsonl file in chunks of a bounded number of records and imports each chunk straight into the database,
+# so memory use depends on the chunk size only. After each chunk, the byte offset of the next record is committed to the 
+# ingest_checkpoint table together with the chunk's records, so an interrupted run resumes exactly where it left off.
+# A chunk that fails is rolled back, so that its records are never committed with the next chunk under the wrong checkpoint.
+
+checkpoint_table = """
+CREATE TABLE IF NOT EXISTS ingest_checkpoint(
+    source TEXT NOT NULL,           -- absolute path of the source file
+    target TEXT NOT NULL,           -- the table the source is imported into
+    offset INTEGER NOT NULL,        -- byte offset of the first record that has not been imported yet
+    records INTEGER NOT NULL,       -- the number of records imported so far
+    size INTEGER NOT NULL,          -- the size of the source file, to detect changed files
+    updated TEXT NOT NULL,
+    PRIMARY KEY(source, target)
+);
+"""
+
+def get_checkpoint(source: str, table: str, conn: sql.Connection) -> tuple:
+    """
+    Returns the (offset, records, size) checkpoint of a source file import, or (0, 0, 0) if the import has not started.
+    """
+    conn.execute(checkpoint_table)
+    row = conn.execute(
+        "SELECT offset, records, size FROM ingest_checkpoint WHERE source = ? AND target = ?", [os.path.abspath(source), table]
+    ).fetchone()
+    return (0, 0, 0) if row is None else row
+
+def set_checkpoint(source: str, table: str, offset: int, records: int, conn: sql.Connection):
+    """
+    Records the progress of a source file import. Does not commit: commit it together with the imported records.
+    """
+    conn.execute("""
+    INSERT OR REPLACE INTO ingest_checkpoint(source, target, offset, records, size, updated) 
+    VALUES(?, ?, ?, ?, ?, datetime('now'))
+    """, [os.path.abspath(source), table, offset, records, os.path.getsize(source)])
+
+def read_jsonl_chunk(file, chunk_size: int) -> list:
+    """
+    Reads and parses up to chunk_size records from an open binary jsonl file, starting at its current position.
+    """
+    records = []
+    while len(records) < chunk_size:
+        line = file.readline()
+        if not line:
+            break
+        if line.strip():
+            records.append(json.loads(line))
+    return records
+
+def stream_jsonl(
+    jsonpath: str,
+    table: str,
+    conn: sql.Connection,
+    normalize = lambda records: records,
+    chunk_size = 50_000,
+    restart = False,
+    skip_duplicates = False,
+    verbosity = 1
+) -> int:
+    """
+    Imports a potentially huge jsonl file straight into a database table, one chunk of records at a time.
+    Reviews and products are imported with import_reviews and import_products; other tables with insert_records.
+
+    Each chunk is committed together with a checkpoint. Running the import again after an interruption resumes from the 
+    last committed chunk, and running it again after it completed imports nothing. A chunk that fails is rolled back.
+    Since every chunk is committed, the connection must not have uncommitted changes of its own: that raises a ValueError.
+    Resuming raises a ValueError if the file is smaller than at the last checkpoint, i.e. it was truncated or replaced.
+
+    Returns the number of records imported by this run.
+
+    Parameters
+    ----------
+    - normalize: transforms each chunk (a DataFrame of raw records) into records that fit the table, 
+      e.g. normalize_amazon_music_reviews. For products, the index should hold the product ids.
+    - chunk_size: the number of records per chunk. Memory use is proportional to this.
+    - restart: discard any previous checkpoint and import the file from the beginning
+    - skip_duplicates: skip reviews and products that already exist, as in import_reviews and import_products
+    """
+    t = time.perf_counter()
+    def profile(message: str):
+        if verbosity > 0:
+            elapsed = time.perf_counter() - t
+            print(f"{elapsed:.2f}: {message}")
+
+    if conn.in_transaction:
+        raise ValueError('The connection has uncommitted changes. Commit or roll them back before streaming an import.')
+    size = os.path.getsize(jsonpath)
+    offset, total, checkpoint_size = (0, 0, 0) if restart else get_checkpoint(jsonpath, table, conn)
+    if checkpoint_size > size or offset > size:
+        raise ValueError(
+            f'{jsonpath} is smaller than at the last checkpoint ({checkpoint_size:,d} bytes): it was truncated or replaced. '
+            'Use restart to import it again.'
+        )
+    if offset > 0:
+        profile(f'Resuming {jsonpath} at byte {offset:,d} of {size:,d} after {total:,d} records')
+    count = 0
+    with open(jsonpath, 'rb') as file:
+        file.seek(offset)
+        while True:
+            records = read_jsonl_chunk(file, chunk_size)
+            if len(records) == 0:
+                break
+            data = normalize(pd.DataFrame.from_records(records))
+            try:
+                if table == 'review':
+                    import_reviews(data, conn, commit = False, skip_duplicates = skip_duplicates, verbosity = 0)
+                elif table == 'product':
+                    import_products(data, conn, commit = False, skip_duplicates = skip_duplicates, verbosity = 0)
+                else:
+                    insert_records(
+                        data, table, conn, include_index = data.index.name is not None,
+                        commit_batches = False, feedback_batch_size = None
+                    )
+                set_checkpoint(jsonpath, table, file.tell(), total + count + len(records), conn)
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+            count += len(records)
+            notify_change(table, len(data))
+            profile(f'Processed {total + count:,d} records, {file.tell() / max(size, 1) * 100:.1f}% of {jsonpath} @ {count / (time.perf_counter() - t):,.0f} records / sec')
+    if count == 0:
+        set_checkpoint(jsonpath, table, offset, total, conn) # make sure completed and empty files are recorded
+        conn.commit()
+    return count
+
+################
+# Integer keys
+################
+# Databases created with the integer key variant of our schema (see shared/integer_keys.py) reference users and products 
+# by integer id instead of by their original ids. Source data still uses the original ids, so we translate them on import.
+
+def _get_ids(external_ids: list, table: str, conn: sql.Connection) -> pd.Series:
+    batch_size = 10_000 # stay well within sqlite's limit on query parameters
+    results = []
+    for start in range(0, len(external_ids), batch_size):
+        batch = external_ids[start : start + batch_size]
+        values = ','.join('?' * len(batch))
+        results.append(pd.read_sql_query(f"SELECT external_id, id FROM {table} WHERE external_id IN ({values})", conn, params = batch))
+    if len(results) == 0:
+        return pd.Series(dtype = 'Int64')
+    ids = pd.concat(results)
+    return pd.Series(ids.id.values, index = ids.external_id.values)
+
+def encode_reviews(reviews: pd.DataFrame, conn: sql.Connection) -> pd.DataFrame:
+    """
+    Given reviews with original user and product ids, return the reviews with integer user and product ids.
+    Users are added to the user table as needed. Reviews of unknown products are left out, because they can not reference a product.
+    """
+    user_ids = reviews.user_id.dropna().unique().tolist()
+    conn.executemany("INSERT OR IGNORE INTO user(external_id) VALUES(?)", [[user_id] for user_id in user_ids])
+    users = _get_ids(user_ids, 'user', conn)
+    products = _get_ids(reviews.product_id.unique().tolist(), 'product', conn)
+    def encode(ids: pd.Series, dictionary: pd.Series) -> pd.Series:
+        encoded = ids.map(dictionary).astype('Int64')
+        return encoded.astype(object).where(encoded.notna(), None) # sqlite can bind None, but not pandas NA
+    result = reviews.assign(user_id = encode(reviews.user_id, users), product_id = encode(reviews.product_id, products))
+    orphaned = result.product_id.isna()
+    if orphaned.any():
+        print(f'Skipping {orphaned.sum():,d} reviews of unknown products')
+        result = result[~orphaned]
+    return result
+
+################
+# Duplicates
+################
+# Duplicates are found in SQL rather than in Python: the keys of the records to check are loaded into a temporary table, 
+# which is joined against the target table using the target table's indexes. This scales to tables of any size.
+
+# Reviews have no ids of their own: a user reviewing the same product twice is a duplicate
+review_key_columns = ['user_id', 'product_id']
+
+def get_key_columns(data: pd.DataFrame, key_columns: list) -> list:
+    """
+    Returns the values of key columns as lists. Key columns can include the name of the index.
+    """
+    return [(data.index if column == data.index.name and column not in data.columns else data[column]).tolist() for column in key_columns]
+
+def load_keys(data: pd.DataFrame, key_columns: list, conn: sql.Connection, name = 'candidate_keys') -> str:
+    """
+    Loads the keys of records into an indexed temporary table, along with each record's position in data (as '_row').
+    Returns the name of the temporary table, which lasts until it is reloaded or the connection is closed.
+    """
+    temp_table = f'temp.{name}'
+    conn.execute(f"DROP TABLE IF EXISTS {temp_table}")
+    conn.execute(f"CREATE TEMP TABLE {name}(_row INTEGER PRIMARY KEY, {', '.join(key_columns)})")
+    placeholder_str = ','.join(['?'] * (len(key_columns) + 1))
+    conn.executemany(f"INSERT INTO {temp_table} VALUES({placeholder_str})", zip(range(len(data)), *get_key_columns(data, key_columns)))
+    conn.execute(f"CREATE INDEX {temp_table}_key ON {name}({', '.join(key_columns)})")
+    return temp_table
+
+def find_duplicate_rows(data: pd.DataFrame, table: str, conn: sql.Connection, key_columns: list, sql_key_columns: list = None) -> np.ndarray:
+    """
+    Returns the positions of the records in data whose key already exists in an SQL table, in ascending order.
+    Records with a missing (NULL) key value never match, as in SQL.
+
+    Parameters
+    ----------
+    - key_columns: the columns of data that identify a record. Can include the name of the index.
+    - sql_key_columns: the matching columns in the SQL table, if they are named differently
+    """
+    sql_key_columns = sql_key_columns or key_columns
+    temp_table = load_keys(data, key_columns, conn)
+    conditions = ' AND '.join([f't.{sql_column} = k.{column}' for column, sql_column in zip(key_columns, sql_key_columns)])
+    rows = conn.execute(f"""
+    SELECT k._row FROM {temp_table} k WHERE EXISTS (SELECT 1 FROM {table} t WHERE {conditions}) ORDER BY k._row
+    """).fetchall()
+    conn.execute(f"DROP TABLE {temp_table}")
+    return np.array([row for (row,) in rows], dtype = np.int64)
+
+def remove_duplicates(data: pd.DataFrame, table: str, conn: sql.Connection, key_columns: list, verbosity = 1) -> pd.DataFrame:
+    """
+    Returns the records in data that are not duplicates: records whose key neither exists in the SQL table yet nor appears 
+    earlier in data. Records with a missing key value are never considered duplicates.
+    """
+    keys = pd.DataFrame(dict(zip(key_columns, get_key_columns(data, key_columns))))
+    has_key = keys.notna().all(axis = 1).to_numpy()
+    duplicate = has_key & keys.duplicated().to_numpy()
+    duplicate[find_duplicate_rows(data, table, conn, key_columns)] = True
+    if verbosity > 0 and duplicate.any():
+        print(f'Skipping {duplicate.sum():,d} duplicate {table} records')
+    return data[~duplicate]
 
 def find_duplicates(
     data: pd.DataFrame,
@@ -97,19 +848,23 @@ def find_duplicates(
     conn: sql.Connection,
     sql_index_column = 'id',
     data_index_column = None, # None means use the DataFrame index
+    key_columns: list = None
 ) -> pd.DataFrame:
     """ 
     Given a DataFrame and a target SQL table, return the records in the DataFrame that already exist in the target table.
 
     The purpose of this method is to help insert non-duplicate records and to troubleshoot errors relating to duplicate records.
+    Records are matched on a single id (sql_index_column / data_index_column), or on a composite key given as key_columns 
+    (e.g. review_key_columns) that have the same names in the DataFrame and the table. Results are indexed like data_index_column.
     """
     result = data.copy()
     if data_index_column != None:
         result = result.set_index(data_index_column)
-    sql_ids = pd.read_sql_query(f"SELECT {sql_index_column} FROM {table}", conn)[sql_index_column]
-    dataframe_ids = data.index
-    duplicate_ids = list(set(sql_ids).intersection(set(dataframe_ids)))
-    return result.loc[duplicate_ids]
+    if key_columns is None:
+        rows = find_duplicate_rows(result.rename_axis('_id'), table, conn, ['_id'], [sql_index_column])
+    else:
+        rows = find_duplicate_rows(result, table, conn, key_columns)
+    return result.iloc[rows]
 
 def get_single_value(iterable_or_string, sep = ', ') -> str:
     """
@@ -124,12 +879,29 @@ def get_single_value(iterable_or_string, sep = ', ') -> str:
     if isinstance(iterable_or_string, str):
         # if string represents an array ('[...]'), unpack the array. This happens frequently in our data sets.
         if iterable_or_string.startswith('['):
+            # literal_eval only parses literals, so data can never execute code
             try:
-                l = eval(iterable_or_string)
-                return get_single_value(l)
-            except:
+                l = ast.literal_eval(iterable_or_string)
+                return get_single_value(l, sep)
+            except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
                 pass
         return iterable_or_string
     if isinstance(iterable_or_string, Iterable):
         return sep.join(map(str, iterable_or_string))
-    return str(iterable_or_string)
\ No newline at end of file
+    return str(iterable_or_string)
+
+def get_single_values(values: pd.Series, sep = ', ') -> pd.Series:
+    """
+    Batch version of get_single_value for a whole column. Results are identical to values.map(get_single_value).
+    Every distinct value is only parsed once, which saves most of the work for columns with many repeats (creators, categories).
+    """
+    try:
+        codes, uniques = pd.factorize(values)
+    except TypeError:
+        # lists are not hashable, so columns of actual lists are flattened one by one
+        return values.map(lambda value: get_single_value(value, sep))
+    result = np.empty(len(values), dtype = object)
+    found = codes >= 0
+    result[found] = np.array([get_single_value(value, sep) for value in uniques], dtype = object)[codes[found]]
+    result[~found] = [get_single_value(value, sep) for value in values[~found]]
+    return pd.Series(result, index = values.index, name = values.name, dtype = str)
\ No newline at end of file
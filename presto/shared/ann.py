@@ -0,0 +1,445 @@
+# ann.py
+# An approximate nearest neighbor (ANN) index over product rating vectors, for recommendations across a whole category.
+#
+# Live recommendations only compare a product against the neighborhood reachable through its own reviewers (see
+# query.get_related_reviews), and their cost grows with its reviewer count. The index is built offline from the review table:
+# every product's user rating vector is hashed with random hyperplanes (SimHash), which gives products with a small angle
+# between their vectors (a high cosine similarity) a high chance of sharing hash bits. The bits are split into bands, and
+# each band is a hash table of products. A query looks up the buckets of the product in each table, and only the products
+# found there are compared with exact cosine similarity.
+#
+# This is an approximation: it misses some of the true neighbors, and it still compares a large share of the category
+# (see build_index for the recall / scan tradeoff, which max_candidates makes explicit at query time). Products only have a handful of ratings each, so even their nearest
+# neighbors have a low cosine similarity, which is where random hyperplanes separate products worst. Use 'live' or
+# 'precomputed' recommendations where exact results matter.
+#
+# Usage (from the presto directory):
+#   python -m shared.ann --db data/products.sql --category Music --out data/ann-music --evaluate
+#   index = ann.load_index('data/ann-music')
+#   result = q.get_recommendations('Music', 'Nevermind', conn, source = 'ann', ann_index = index)
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import shutil
+import sqlite3 as sql
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+import shared.query as q
+from shared.review_store import IdDictionary
+
+# Increase when the index layout changes, so that old indexes are rejected rather than misread
+index_version = 1
+metadata_file = 'metadata.json'
+
+###########
+# Hashing
+###########
+def get_signatures(ratings: sparse.csr_matrix, bits: int, seed = 0, chunk_size = 100_000) -> np.ndarray:
+    """
+    Returns the SimHash signature of every row of a sparse matrix as a boolean matrix with one column per bit.
+
+    Bit i is set when the row lies on the positive side of random hyperplane i. For two rows with an angle of theta between
+    them, each bit differs with probability theta / pi. Hyperplanes are generated chunk_size users at a time, so that the
+    random matrix never takes more than chunk_size * bits floats.
+    """
+    ratings = ratings.tocsc()
+    projections = np.zeros((ratings.shape[0], bits), dtype = np.float32)
+    for chunk, start in enumerate(range(0, ratings.shape[1], chunk_size)):
+        end = min(start + chunk_size, ratings.shape[1])
+        hyperplanes = np.random.default_rng([seed, chunk]).standard_normal((end - start, bits), dtype = np.float32)
+        projections += ratings[:, start:end] @ hyperplanes
+    return projections > 0
+
+def get_band_keys(signatures: np.ndarray, band_bits: int) -> np.ndarray:
+    """
+    Splits signatures into bands of band_bits bits and returns the key of each band as an integer:
+    a matrix of products by bands
+    """
+    count, bits = signatures.shape
+    weights = (1 << np.arange(band_bits, dtype = np.uint32)).astype(np.uint32)
+    return (signatures.reshape(count, bits // band_bits, band_bits) @ weights).astype(np.uint32)
+
+###########
+# Index
+###########
+class AnnIndex:
+    """
+    A SimHash LSH index over the rating vectors of the products of a category (see build_index).
+
+    Arrays may be memory-mapped (see load_index), in which case the index is read-only and shared between processes.
+    """
+    def __init__(
+        self,
+        product_ids: IdDictionary,
+        signatures: np.ndarray,     # packed SimHash bits per product
+        table_keys: np.ndarray,     # per table (band): the band keys of all products, sorted
+        table_order: np.ndarray,    # per table (band): the product codes in the order of table_keys
+        vectors: sparse.csr_matrix, # unit-length user rating vectors per product, for exact reranking
+        band_bits: int,
+        metadata: dict = None
+    ):
+        self.product_ids = product_ids
+        self.signatures = signatures
+        self.table_keys = table_keys
+        self.table_order = table_order
+        self.vectors = vectors
+        self.band_bits = band_bits
+        self.metadata = metadata or {}
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    @property
+    def tables(self) -> int:
+        return self.table_keys.shape[0]
+
+    @property
+    def bits(self) -> int:
+        return self.tables * self.band_bits
+
+    @property
+    def cache_key(self) -> tuple:
+        """
+        Identifies the index in cache keys (see cache.RecommendationCache): its build settings and when it was built
+        """
+        settings = ('category', 'min_reviews', 'filter_unhelpful_reviews', 'seed', 'created')
+        return (len(self), self.tables, self.band_bits) + tuple(self.metadata.get(name) for name in settings)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory footprint of the index arrays in bytes, which is also its size on disk
+        """
+        vectors = self.vectors.data.nbytes + self.vectors.indices.nbytes + self.vectors.indptr.nbytes
+        return self.product_ids.nbytes + self.signatures.nbytes + self.table_keys.nbytes + self.table_order.nbytes + vectors
+
+    def get_keys(self, code: int) -> np.ndarray:
+        signature = np.unpackbits(self.signatures[code], count = self.bits).astype(bool)
+        return get_band_keys(signature.reshape(1, -1), self.band_bits)[0]
+
+    def get_candidates(self, code: int, max_candidates = None) -> np.ndarray:
+        """
+        Returns the codes of the products that share at least one bucket with a product, excluding the product itself.
+
+        With max_candidates, at most that many candidates are returned: those that share a bucket in the most tables. Products 
+        with a smaller angle to the product collide in more tables, so these are the likeliest nearest neighbors.
+        """
+        keys = self.get_keys(code)
+        members = []
+        for table, key in enumerate(keys):
+            start = np.searchsorted(self.table_keys[table], key, side = 'left')
+            end = np.searchsorted(self.table_keys[table], key, side = 'right')
+            members.append(self.table_order[table, start:end])
+        candidates, collisions = np.unique(np.concatenate(members), return_counts = True)
+        keep = candidates != code
+        candidates, collisions = candidates[keep], collisions[keep]
+        if max_candidates != None and len(candidates) > max_candidates:
+            top = np.argsort(-collisions, kind = 'stable')[:max_candidates]
+            candidates = np.sort(candidates[top])
+        return candidates
+
+    def get_neighbors(self, product_id, limit = 100, max_candidates = None) -> pd.Series:
+        """
+        Returns the approximate nearest neighbors of a product sorted by cosine similarity, like query.get_product_similarities
+        followed by query.get_top_similarities. Candidates are found through the hash tables (see get_candidates), and then 
+        ranked by their exact similarity. Neighbors with a similarity of 0 (no raters in common) are left out.
+
+        Products that are not in the index have no neighbors.
+        """
+        code = self.product_ids.get_indexer([product_id])[0]
+        if code < 0:
+            return pd.Series([], dtype = float, name = 'similarity')
+        candidates = self.get_candidates(code, max_candidates = max_candidates)
+        similarities = (self.vectors[candidates] @ self.vectors[code].T).toarray().ravel()
+        similarities = np.clip(similarities, -1, 1)
+        keep = similarities > 0
+        candidates, similarities = candidates[keep], similarities[keep]
+        if limit != None and limit < len(similarities):
+            top = np.argpartition(-similarities, limit)[:limit]
+            candidates, similarities = candidates[top], similarities[top]
+        order = np.argsort(-similarities, kind = 'stable')
+        return pd.Series(similarities[order], index = self.product_ids.take(candidates[order]), name = 'similarity')
+
+def get_category_reviews(
+    conn: sql.Connection,
+    category = None,
+    filter_unhelpful_reviews = True,
+    store = None,
+    verbosity = q.query_verbosity
+) -> pd.DataFrame:
+    """
+    Returns the user, product and rating of every review of a category ('Books', 'Music') by a known user.
+    None returns the reviews of all categories. With a ReviewStore, reviews are read from the store.
+    """
+    helpful = " AND r.upvotes >= r.downvotes" if filter_unhelpful_reviews else ""
+    if store is not None:
+        q_str = "SELECT id FROM product" + (" WHERE category = ?" if category != None else "")
+        product_ids = q.query(q_str, conn, params = [category] if category != None else None, verbosity = 0).id
+        reviews = store.get_reviews(product_ids, drop_null_reviewers = True)
+        if filter_unhelpful_reviews:
+            reviews = reviews[reviews.upvotes >= reviews.downvotes]
+        return reviews[['user_id', 'product_id', 'rating']]
+    if category == None:
+        q_str = f"SELECT r.user_id, r.product_id, r.rating FROM review r WHERE r.user_id IS NOT NULL{helpful}"
+        params = None
+    else:
+        q_str = f"""
+        SELECT r.user_id, r.product_id, r.rating
+        FROM review r JOIN product p ON p.id = r.product_id
+        WHERE p.category = ? AND r.user_id IS NOT NULL{helpful}
+        """
+        params = [category]
+    return q.query(q_str, conn, params = params, query_description = 'category reviews', verbosity = verbosity)
+
+def build_index(
+    conn: sql.Connection,
+    category = None,
+    min_reviews = 1,
+    tables = 48,
+    band_bits = 6,
+    filter_unhelpful_reviews = True,
+    seed = 0,
+    store = None,
+    verbosity = 1
+) -> AnnIndex:
+    """
+    Builds an ANN index over the user rating vectors of every product in a category with at least min_reviews reviews.
+
+    Tables and band_bits trade recall for the share of the category compared per query, and max_candidates (see 
+    AnnIndex.get_candidates) caps that share at the cost of recall. Measured with evaluate_index (k = 20) on the Books 
+    categories of the benchmark databases (9K and 48K products, see benchmark/generate.py):
+
+        tables x bits   max_candidates   recall@20   compared   size per 10K products
+        32 x 8          None             0.60        13%        4.0MB
+        32 x 6          None             0.78-0.82   42%        3.8MB
+        48 x 6          None             0.87-0.88   55%        5.2MB
+        48 x 6          10% of products  0.62-0.64   10%
+        48 x 6          20% of products  0.72-0.73   20%
+        128 x 8         None             0.85        41%        12MB
+        256 x 8         None             0.92-0.94   65%        23MB
+        256 x 8         10% of products  0.75-0.78   10%
+        256 x 8         20% of products  0.80-0.83   20%
+        256 x 10        None             0.79        26%        24MB
+
+    No setting reaches a recall@20 of 0.8 while comparing less than a fifth of the category, so queries are not sublinear:
+    the index only saves a constant share of the work of an exact search. The defaults (48 x 6, no max_candidates) favor
+    recall, and queries take about half as long as an exact search. To bound the work per query, build with more tables and
+    pass max_candidates. Bucket lookups touch about tables / 2 ** band_bits products per product in the category either way.
+    Run evaluate_index on your own data before changing these settings.
+
+    Parameters
+    ----------
+    - category: the category to index ('Books', 'Music'). None indexes all categories together.
+    - min_reviews: products with fewer (helpful) reviews by known users are left out
+    - tables: the number of hash tables. More tables find more true neighbors (recall) at the cost of more candidates per query.
+    - band_bits: the number of signature bits per table. More bits make buckets smaller and more selective: fewer candidates
+      per query, but also fewer true neighbors found.
+    - filter_unhelpful_reviews: ignore reviews with more downvotes than upvotes, as get_recommendations does
+    - seed: the random seed for the hyperplanes. The same data and seed build the same index.
+    - store: an optional ReviewStore to read reviews from (see shared/review_store.py)
+    """
+    t = time.perf_counter()
+    def profile(message: str):
+        if verbosity > 0:
+            elapsed = time.perf_counter() - t
+            print(f"{elapsed:.2f}: {message}")
+
+    if band_bits > 32:
+        raise ValueError(f'band_bits can be at most 32, got {band_bits}')
+    reviews = get_category_reviews(conn, category, filter_unhelpful_reviews = filter_unhelpful_reviews, store = store, verbosity = 0)
+    if min_reviews > 1:
+        counts = reviews.product_id.value_counts()
+        reviews = reviews[reviews.product_id.isin(counts.index[counts >= min_reviews])]
+    profile(f'Loaded {len(reviews):,d} reviews')
+    ratings = q.get_sparse_ratings_by_user(reviews)
+    vectors = normalize(ratings.ratings).astype(np.float32)
+    vectors.indices = vectors.indices.astype(np.int32)
+    vectors.indptr = vectors.indptr.astype(np.int64)
+    profile(f'Created rating vectors for {ratings.shape[0]:,d} products and {ratings.shape[1]:,d} users')
+
+    signatures = get_signatures(vectors, tables * band_bits, seed = seed)
+    keys = get_band_keys(signatures, band_bits)
+    table_order = np.argsort(keys, axis = 0, kind = 'stable').T.astype(np.int32)
+    table_keys = np.take_along_axis(keys.T, table_order, axis = 1)
+    profile(f'Hashed products into {tables} tables of {band_bits} bits')
+
+    metadata = {
+        'category': category,
+        'min_reviews': min_reviews,
+        'filter_unhelpful_reviews': filter_unhelpful_reviews,
+        'seed': seed,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'review_count': len(reviews),
+        'user_count': ratings.shape[1],
+        'build_seconds': round(time.perf_counter() - t, 3)
+    }
+    index = AnnIndex(
+        IdDictionary.from_ids(ratings.product_ids.values),
+        np.packbits(signatures, axis = 1),
+        table_keys, table_order,
+        vectors,
+        band_bits,
+        metadata = metadata
+    )
+    profile(f'Built an index of {len(index):,d} products ({index.nbytes / 1024 ** 2:,.1f}MB)')
+    return index
+
+###########
+# Storage
+###########
+def get_arrays(index: AnnIndex) -> dict:
+    """
+    Returns the arrays that make up an index by file name
+    """
+    return {
+        'product_ids': index.product_ids.values,
+        'signatures': index.signatures,
+        'table_keys': index.table_keys,
+        'table_order': index.table_order,
+        'vector_offsets': index.vectors.indptr,
+        'vector_users': index.vectors.indices,
+        'vector_values': index.vectors.data
+    }
+
+def export_index(index: AnnIndex, path: str, verbosity = 1):
+    """
+    Writes an index to a directory of .npy files, replacing any previous index at that path.
+    Like snapshot.export_snapshot, the index is written to a temporary directory first and then moved into place.
+    """
+    t = time.perf_counter()
+    temp_path = path.rstrip('/') + '.tmp'
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+    arrays = get_arrays(index)
+    for name, array in arrays.items():
+        np.save(os.path.join(temp_path, name + '.npy'), np.ascontiguousarray(array))
+    metadata = {
+        **index.metadata,
+        'version': index_version,
+        'created': index.metadata.get('created') or datetime.now(timezone.utc).isoformat(),
+        'product_count': len(index),
+        'tables': index.tables,
+        'band_bits': index.band_bits,
+        'nbytes': index.nbytes,
+        'arrays': {name: {'dtype': array.dtype.str, 'shape': list(array.shape)} for name, array in arrays.items()}
+    }
+    with open(os.path.join(temp_path, metadata_file), 'w') as file:
+        json.dump(metadata, file, indent = 2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(temp_path, path)
+    if verbosity > 0:
+        print(f'{time.perf_counter() - t:.2f}: Exported an index of {len(index):,d} products to {path}')
+
+def get_metadata(path: str) -> dict:
+    with open(os.path.join(path, metadata_file)) as file:
+        metadata = json.load(file)
+    if metadata.get('version') != index_version:
+        raise ValueError(f"ANN index {path} has version {metadata.get('version')}, expected {index_version}. Please rebuild it.")
+    return metadata
+
+def load_index(path: str, mmap = True, verbosity = 1) -> AnnIndex:
+    """
+    Loads an index from a directory written by export_index. With mmap, arrays are memory-mapped read-only (see snapshot.load_snapshot).
+    """
+    t = time.perf_counter()
+    metadata = get_metadata(path)
+    arrays = {
+        name: np.load(os.path.join(path, name + '.npy'), mmap_mode = 'r' if mmap else None)
+        for name in metadata['arrays']
+    }
+    vectors = sparse.csr_matrix(
+        (arrays['vector_values'], arrays['vector_users'], arrays['vector_offsets']),
+        shape = (len(arrays['product_ids']), metadata['user_count'])
+    )
+    index = AnnIndex(
+        IdDictionary(arrays['product_ids']),
+        arrays['signatures'],
+        arrays['table_keys'], arrays['table_order'],
+        vectors,
+        metadata['band_bits'],
+        metadata = metadata
+    )
+    if verbosity > 0:
+        print(f"{time.perf_counter() - t:.3f}: Loaded an ANN index of {len(index):,d} products created {metadata['created']}")
+    return index
+
+###########
+# Evaluation
+###########
+def evaluate_index(index: AnnIndex, sample_size = 100, k = 100, seed = 0, max_candidates = None, verbosity = 1) -> dict:
+    """
+    Measures the quality and speed of an index on a random sample of indexed products, with queries limited to 
+    max_candidates candidates (see AnnIndex.get_candidates).
+
+    The exact neighbors of each sampled product are computed with query.get_product_similarities over the same rating
+    vectors: the row of get_pairwise_similarities for that product. Recall@k is the share of the exact top k neighbors (with
+    a similarity above 0) that the index returns in its top k. Rating vectors are short and often tie, so a returned neighbor
+    counts as found when it is at least as similar as the k-th exact neighbor, whichever of the tied products either side
+    picked. Products without any exact neighbors are skipped.
+
+    Returns a dictionary with the mean recall, mean candidates per query, and index and exact query latency percentiles in milliseconds.
+    """
+    ratings = q.RatingMatrix(index.vectors, pd.Index(index.product_ids.take(np.arange(len(index)))), pd.RangeIndex(index.vectors.shape[1]))
+    codes = np.random.default_rng(seed).choice(len(index), size = min(sample_size, len(index)), replace = False)
+    recalls, candidates, index_times, exact_times = [], [], [], []
+    for product_id in ratings.product_ids[codes]:
+        t = time.perf_counter()
+        neighbors = index.get_neighbors(product_id, limit = k, max_candidates = max_candidates)
+        index_times.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        similarities = q.get_product_similarities(product_id, ratings)
+        exact = q.get_top_similarities(similarities[similarities > 0], limit = k)
+        exact_times.append(time.perf_counter() - t)
+        candidates.append(len(index.get_candidates(ratings.product_index(product_id), max_candidates = max_candidates)))
+        if len(exact) > 0:
+            # the index scores in float32
+            found = (neighbors.values >= exact.iloc[-1] - 1e-5).sum()
+            recalls.append(min(found, len(exact)) / len(exact))
+    result = {
+        'products': len(index),
+        'sample_size': len(codes),
+        'k': k,
+        'max_candidates': max_candidates,
+        f'recall@{k}': float(np.mean(recalls)) if len(recalls) > 0 else None,
+        'candidates': float(np.mean(candidates)),
+        'index_ms_p50': float(np.percentile(index_times, 50) * 1000),
+        'index_ms_p95': float(np.percentile(index_times, 95) * 1000),
+        'exact_ms_p50': float(np.percentile(exact_times, 50) * 1000),
+        'exact_ms_p95': float(np.percentile(exact_times, 95) * 1000),
+        'nbytes': index.nbytes,
+        'build_seconds': index.metadata.get('build_seconds')
+    }
+    if verbosity > 0:
+        print(
+            f"recall@{k} {result[f'recall@{k}']:.3f} over {len(recalls)} products, {result['candidates']:,.0f} candidates per query "
+            f"({result['candidates'] / len(index):.1%} of {len(index):,d} products), "
+            f"index p50 {result['index_ms_p50']:.2f}ms / p95 {result['index_ms_p95']:.2f}ms, "
+            f"exact p50 {result['exact_ms_p50']:.2f}ms / p95 {result['exact_ms_p95']:.2f}ms"
+        )
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Build an approximate nearest neighbor index over product rating vectors')
+    parser.add_argument('--db', default = 'data/products.sql')
+    parser.add_argument('--category', default = None, help = "the category to index, e.g. 'Books' or 'Music'. Default: all categories")
+    parser.add_argument('--out', default = 'data/ann')
+    parser.add_argument('--min-reviews', type = int, default = 1)
+    parser.add_argument('--tables', type = int, default = 48)
+    parser.add_argument('--band-bits', type = int, default = 6)
+    parser.add_argument('--evaluate', action = 'store_true', help = 'report recall and latency against exact cosine similarity')
+    parser.add_argument('--max-candidates', type = int, default = None, help = 'the candidates per query to evaluate with')
+    args = parser.parse_args()
+    conn = q.connect(args.db, read_only = True)
+    index = build_index(conn, category = args.category, min_reviews = args.min_reviews, tables = args.tables, band_bits = args.band_bits)
+    conn.close()
+    export_index(index, args.out)
+    if args.evaluate:
+        evaluate_index(index, max_candidates = args.max_candidates)
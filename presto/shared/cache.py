@@ -0,0 +1,165 @@
+# cache.py
+# An in-memory cache for get_recommendations results.
+#
+# Traffic is heavily skewed toward a small number of popular products, and recommendations only change when we ingest new data.
+# Caching full results therefore saves the entire recommendation pipeline for most requests.
+from collections import OrderedDict
+import inspect
+import sqlite3 as sql
+import threading
+import time
+
+import pandas as pd
+
+import shared.query as q
+
+# get_recommendations settings that do not affect results, and are therefore not part of the cache key
+_ignored_settings = {'conn', 'verbosity', 't', 'store'}
+_signature = inspect.signature(q.get_recommendations)
+
+def get_result_size(result: dict) -> int:
+    """
+    Returns the approximate memory footprint in bytes of a get_recommendations result.
+    """
+    size = 0
+    for value in result.values():
+        if isinstance(value, pd.DataFrame):
+            size += value.memory_usage(deep = True).sum()
+        elif isinstance(value, pd.Series):
+            size += value.memory_usage(deep = True)
+    return int(size)
+
+class RecommendationCache:
+    """
+    A thread-safe LRU cache for get_recommendations results with expiration (ttl) and a memory limit.
+
+    Results are keyed on the normalized search (see query.search_text) plus every setting that affects results, so that
+    e.g. 'The Beatles' and 'beatles' share a cache entry. Cached results are shared between callers: treat them as read-only.
+
+    Usage:
+        cache = RecommendationCache()
+        ingest.add_insert_listener(cache.on_insert)     # drop stale results after ingest (see also invalidate)
+        cache.warmup(conn)                              # optional: precompute the most popular products
+        result = cache.get_recommendations('Music', 'Nevermind', conn)
+    """
+    def __init__(self, max_entries = 10_000, ttl = 24 * 60 * 60, max_memory = 512 * 1024 ** 2):
+        """
+        Parameters
+        ----------
+        - max_entries: the maximum number of cached results
+        - ttl: the number of seconds after which a cached result expires. None means results never expire.
+        - max_memory: the approximate maximum number of bytes to use for cached results
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (expiration time, size, result), least recently used first
+        self._generation = 0 # incremented by clear, so that results computed from older data are not cached
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def get_key(category: str, search_term: str, **settings) -> tuple:
+        """
+        Returns the cache key for a get_recommendations call. Omitted settings are filled in with their defaults, so that 
+        passing a default value explicitly results in the same key. An ann_index is identified by its cache_key (see ann.AnnIndex).
+        """
+        arguments = _signature.bind_partial(category = category, search_term = q.search_text(search_term), **settings)
+        arguments.apply_defaults()
+        if arguments.arguments.get('ann_index') is not None:
+            arguments.arguments['ann_index'] = arguments.arguments['ann_index'].cache_key
+        return tuple((name, value) for name, value in arguments.arguments.items() if name not in _ignored_settings)
+
+    def get(self, key):
+        """
+        Returns the cached result for a key, or None if there is no valid cached result.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, result: dict, generation: int = None):
+        """
+        Caches a result. Pass the generation read before computing the result: if the cache was cleared in the meantime,
+        the result may be based on outdated data and is not cached.
+        """
+        size = get_result_size(result)
+        if size > self.max_memory:
+            return
+        expiration = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expiration, size, result)
+            self.memory += size
+            while len(self._entries) > self.max_entries or self.memory > self.max_memory:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.memory -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.memory = 0
+            self._generation += 1
+
+    def invalidate(self):
+        """
+        Drops all cached results. Call this after committing changes to reviews or products that do not go through
+        ingest listeners, e.g. deleting reviews (or call sql_ingest.notify_change).
+        """
+        self.clear()
+
+    def on_insert(self, table: str, count: int):
+        """
+        Ingest listener (see sql_ingest.add_insert_listener). New reviews or products can change any recommendation,
+        so all cached results are dropped.
+        """
+        if table in ('review', 'product') and count > 0:
+            self.invalidate()
+
+    def get_recommendations(self, category: str, search_term: str, conn: sql.Connection, **settings) -> dict:
+        """
+        Returns the cached result of query.get_recommendations with the same parameters, computing and caching it if needed.
+        """
+        key = self.get_key(category, search_term, **settings)
+        generation = self._generation
+        result = self.get(key)
+        if result is None:
+            result = q.get_recommendations(category, search_term, conn, **settings)
+            self.put(key, result, generation)
+        return result
+
+    def warmup(self, conn: sql.Connection, categories = ('Books', 'Music'), top_n = 100, verbosity = 1, **settings) -> int:
+        """
+        Pre-populates the cache with recommendations for the top_n most popular products of each category, searched by title.
+        Settings are passed on to get_recommendations and should match the settings used to serve requests.
+        Returns the number of cached results.
+        """
+        t = time.perf_counter()
+        count = 0
+        for category in categories:
+            products = q.get_popular_products(category, conn, limit = top_n, verbosity = 0)
+            for title in products.title:
+                self.get_recommendations(category, title, conn, **{**settings, 'search_field': 'title', 'exact_match': True, 'verbosity': 0})
+                count += 1
+            if verbosity > 0:
+                print(f'{time.perf_counter() - t:.2f}: warmed up {len(products)} {category} products')
+        return count
@@ -0,0 +1,132 @@
+# connection.py
+# Tuned SQLite connections and a thread-safe connection pool for serving queries from multiple threads.
+#
+# A single sqlite3 connection can not be shared between threads, and default SQLite settings are tuned for tiny databases.
+# ConnectionPool hands every thread its own read-only connection and serializes writes through a single writer connection.
+import contextlib
+import os
+import pathlib
+import sqlite3 as sql
+import threading
+
+# Applied to every connection. Sizes are tuned for our ~7GB product database: reads are served from memory-mapped pages
+# and a large page cache rather than from individual read() calls.
+default_pragmas = {
+    'mmap_size': 8 * 1024 ** 3,  # bytes. SQLite caps this at its compile-time maximum.
+    'cache_size': -256 * 1024,   # negative values are in KiB: 256MB page cache per connection
+    'temp_store': 'MEMORY'       # keep temporary tables and sort/group-by scratch space in memory
+}
+
+# Applied on top of default_pragmas to read-only connections
+read_pragmas = {
+    'query_only': 1
+}
+
+# Applied on top of default_pragmas to the writer connection.
+# Write-ahead logging lets readers keep reading while the writer writes (rollback journaling blocks them).
+write_pragmas = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL'
+}
+
+# The number of prepared statements each connection keeps around for reuse (Python's default is 128)
+cached_statements = 512
+
+def apply_pragmas(conn: sql.Connection, pragmas: dict):
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+
+def open_connection(db: str, read_only = False, pragmas: dict = None, check_same_thread = True) -> sql.Connection:
+    """
+    Opens a tuned SQLite connection.
+
+    Pragmas are default_pragmas plus read_pragmas for read-only connections, updated with any pragmas passed in.
+    Read-only connections open the database in read-only mode, so they can never modify it by accident.
+    """
+    settings = dict(default_pragmas)
+    if read_only:
+        settings.update(read_pragmas)
+        uri = pathlib.Path(os.path.abspath(db)).as_uri() + '?mode=ro'
+        conn = sql.connect(uri, uri = True, check_same_thread = check_same_thread, cached_statements = cached_statements)
+    else:
+        conn = sql.connect(db, check_same_thread = check_same_thread, cached_statements = cached_statements)
+    settings.update(pragmas or {})
+    apply_pragmas(conn, settings)
+    return conn
+
+class ConnectionPool:
+    """
+    Provides one read-only connection per thread plus a single shared writer connection.
+
+    Usage:
+        pool = ConnectionPool('data/products.sql')
+        results = q.get_recommendations('Music', 'Nevermind', pool.connection())   # from any thread
+        with pool.writer() as conn:                                                  # serialized, commits on success
+            ingest.import_reviews(reviews, conn)
+    """
+    def __init__(self, db: str, pragmas: dict = None, writer_pragmas: dict = None, wal = True):
+        self.db = db
+        self.pragmas = pragmas or {}
+        self.writer_pragmas = dict(write_pragmas) if wal else {}
+        self.writer_pragmas.update(writer_pragmas or {})
+        self._local = threading.local()
+        self._lock = threading.Lock()        # guards the connections of threads
+        self._write_lock = threading.Lock()  # serializes writes
+        self._connections = {}               # thread -> its read-only connection
+        self._writer = None
+        if wal:
+            # switch the database to WAL up front: the journal mode is persistent and read-only connections can not change it
+            with self.writer():
+                pass
+
+    def connection(self) -> sql.Connection:
+        """
+        Returns the calling thread's read-only connection, opening it on first use.
+        Opening a connection also closes the connections of threads that have exited (see _prune).
+        """
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            # check_same_thread is off only so that close() can be called from any thread. Each connection is used by one thread.
+            conn = open_connection(self.db, read_only = True, pragmas = self.pragmas, check_same_thread = False)
+            self._local.connection = conn
+            with self._lock:
+                self._prune()
+                self._connections[threading.current_thread()] = conn
+        return conn
+
+    def _prune(self):
+        """
+        Closes the connections of threads that have exited, so that servers that start and stop threads do not leak
+        file handles. Call with self._lock held.
+        """
+        for thread in [thread for thread in self._connections if not thread.is_alive()]:
+            self._connections.pop(thread).close()
+
+    @contextlib.contextmanager
+    def writer(self):
+        """
+        Context manager that provides exclusive access to the writer connection. Commits on success and rolls back on errors.
+        """
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = open_connection(self.db, pragmas = {**self.pragmas, **self.writer_pragmas}, check_same_thread = False)
+            try:
+                yield self._writer
+                self._writer.commit()
+            except:
+                self._writer.rollback()
+                raise
+
+    def close(self):
+        """
+        Closes all connections. Only call this once no threads are using the pool anymore.
+        """
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections = {}
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        self._local = threading.local()
@@ -0,0 +1,183 @@
+# integer_keys.py
+# A dictionary-encoded variant of the product database schema that references users and products by integer keys.
+#
+# Our source data identifies products and users by strings of up to 36 characters (Amazon ASINs and user hashes). These
+# strings are repeated in every one of our 7M+ reviews and in every review index. In the integer key variant:
+# - product.id is an INTEGER PRIMARY KEY and the original product id moves to product.external_id
+# - a new user table maps integer user ids to the original user ids (user.external_id)
+# - every other id column (review.user_id, review.product_id, stats tables, etc) holds integer keys
+#
+# Because the column names are unchanged, all queries work against either variant. External ids only matter at the edges:
+# ingest (see sql_ingest.encode_reviews) and lookups by original id (see get_product_ids and friends below).
+#
+# Usage (from the presto directory) to convert an existing database:
+#   python -m shared.integer_keys data/products.sql data/products-int.sql
+import argparse
+import os
+import re
+import sqlite3 as sql
+import time
+
+import pandas as pd
+
+user_table = """
+-- User: maps integer user ids to the original (external) user ids. Reviews reference users by integer id.
+CREATE TABLE IF NOT EXISTS user(
+    id INTEGER PRIMARY KEY,
+    external_id VARCHAR(36) UNIQUE NOT NULL
+);
+"""
+
+def has_integer_keys(conn: sql.Connection) -> bool:
+    """
+    Returns whether a database uses the integer key variant of the schema.
+    """
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user'").fetchone() is not None
+
+def get_schema(schema: str) -> str:
+    """
+    Given the project schema (data/init/sql_schema), return its integer key variant.
+    All VARCHAR(36) columns in the schema are user or product ids.
+    """
+    schema = schema.replace('VARCHAR(36)', 'INTEGER')
+    schema = re.sub(
+        r'^(\s*)id INTEGER PRIMARY KEY NOT NULL,', 
+        r'\1id INTEGER PRIMARY KEY,\n\1external_id VARCHAR(36) UNIQUE NOT NULL, -- original product id', 
+        schema, 
+        flags = re.MULTILINE
+    )
+    return user_table + schema
+
+###########
+# Lookups
+###########
+def _lookup(values, table: str, from_column: str, to_column: str, conn: sql.Connection) -> pd.Series:
+    values = list(values)
+    batch_size = 10_000 # stay well within sqlite's limit on query parameters
+    results = []
+    for start in range(0, len(values), batch_size):
+        batch = values[start : start + batch_size]
+        placeholders = ','.join('?' * len(batch))
+        q = f"SELECT {from_column}, {to_column} FROM {table} WHERE {from_column} IN ({placeholders})"
+        results.append(pd.read_sql_query(q, conn, params = batch))
+    if len(results) == 0:
+        return pd.Series(dtype = object)
+    result = pd.concat(results)
+    return pd.Series(result[to_column].values, index = result[from_column].values)
+
+def get_product_ids(external_ids, conn: sql.Connection) -> pd.Series:
+    """
+    Given original product ids, return a Series mapping each known original id to its integer id.
+    """
+    return _lookup(external_ids, 'product', 'external_id', 'id', conn)
+
+def get_external_product_ids(product_ids, conn: sql.Connection) -> pd.Series:
+    """
+    Given integer product ids, return a Series mapping each integer id to its original id.
+    """
+    return _lookup(product_ids, 'product', 'id', 'external_id', conn)
+
+def get_user_ids(external_ids, conn: sql.Connection) -> pd.Series:
+    """
+    Given original user ids, return a Series mapping each known original id to its integer id.
+    """
+    return _lookup(external_ids, 'user', 'external_id', 'id', conn)
+
+def get_external_user_ids(user_ids, conn: sql.Connection) -> pd.Series:
+    """
+    Given integer user ids, return a Series mapping each integer id to its original id.
+    """
+    return _lookup(user_ids, 'user', 'id', 'external_id', conn)
+
+#############
+# Migration
+#############
+schema_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'init', 'sql_schema')
+
+product_columns = ['title', 'title_search', 'creator', 'creator_search', 'publisher', 'description', 'category', 'subcategory', 'release_date', 'url']
+review_columns = ['title', 'review', 'rating', 'upvotes', 'downvotes', 'timestamp']
+
+def migrate(source_db: str, target_db: str, schema = schema_path, verbosity = 1):
+    """
+    Copies a database with the regular schema into a new database with the integer key schema.
+
+    Derived tables (product_stats, user_stats, product_similarity and the co-rating stats) are copied with their ids translated, and works with
+    their ids unchanged. Reviews of products that do not exist (orphaned reviews) can not be referenced by integer key and are left out.
+    """
+    t = time.perf_counter()
+    def profile(message: str):
+        if verbosity > 0:
+            print(f'{time.perf_counter() - t:.2f}: {message}')
+
+    if os.path.exists(target_db):
+        raise ValueError(f'{target_db} already exists')
+    conn = sql.connect(target_db)
+    with open(schema) as file:
+        conn.executescript(get_schema(file.read()))
+    # Maintaining review indices row by row is far slower than building them afterwards
+    review_indices = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'review' AND sql IS NOT NULL").fetchall()
+    for name, _ in review_indices:
+        conn.execute(f"DROP INDEX {name}")
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("ATTACH DATABASE ? AS source", [source_db])
+    conn.execute("BEGIN")
+
+    source_tables = set(row[0] for row in conn.execute("SELECT name FROM source.sqlite_master WHERE type = 'table'"))
+    copied_product_columns = product_columns
+    if 'work' in source_tables:
+        conn.execute("INSERT INTO work(id, title_search, creator_search) SELECT id, title_search, creator_search FROM source.work")
+        copied_product_columns = product_columns + ['work_id']
+    columns = ', '.join(copied_product_columns)
+    conn.execute(f"INSERT INTO product(external_id, {columns}) SELECT id, {columns} FROM source.product ORDER BY rowid")
+    profile('Copied products' if 'work' in source_tables else 'Copied products. Works are assigned by update_schema.')
+    conn.execute("INSERT INTO user(external_id) SELECT DISTINCT user_id FROM source.review WHERE user_id IS NOT NULL ORDER BY user_id")
+    profile('Created users')
+    columns = ', '.join(review_columns)
+    source_columns = ', '.join([f'r.{column}' for column in review_columns])
+    conn.execute(f"""
+    INSERT INTO review(user_id, product_id, {columns})
+    SELECT u.id, p.id, {source_columns}
+    FROM source.review r JOIN product p ON p.external_id = r.product_id LEFT JOIN user u ON u.external_id = r.user_id
+    """)
+    profile('Copied reviews')
+    for name, index_sql in review_indices:
+        conn.execute(index_sql)
+    profile('Indexed reviews')
+
+    translations = {
+        'product_stats': ('product_id', 'product'),
+        'user_stats': ('user_id', 'user'),
+        'product_similarity': ('product_id', 'product', 'neighbor_id', 'product'),
+        'product_similarity_done': ('product_id', 'product'),
+        'corating_settings': (),
+        'product_norm': ('product_id', 'product'),
+        'product_corating': ('product_id', 'product', 'neighbor_id', 'product')
+    }
+    for table, translation in translations.items():
+        if table not in source_tables:
+            profile(f'Skipped {table}: not in source database')
+            continue
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        select = [f's.{column}' for column in columns]
+        joins = []
+        for i in range(0, len(translation), 2):
+            column, dictionary = translation[i], translation[i + 1]
+            alias = f'k{i}'
+            select[columns.index(column)] = f'{alias}.id'
+            joins.append(f'JOIN {dictionary} {alias} ON {alias}.external_id = s.{column}')
+        conn.execute(f"INSERT INTO {table}({', '.join(columns)}) SELECT {', '.join(select)} FROM source.{table} s {' '.join(joins)}")
+        profile(f'Copied {table}')
+    conn.commit()
+    conn.execute("DETACH DATABASE source")
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.execute("ANALYZE")
+    conn.close()
+    profile(f'Finished migrating {source_db} to {target_db}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Copy a product database into a new database that uses integer user and product keys')
+    parser.add_argument('source_db')
+    parser.add_argument('target_db')
+    args = parser.parse_args()
+    migrate(args.source_db, args.target_db)
@@ -0,0 +1,164 @@
+# precompute.py
+# Offline batch job that precomputes the nearest neighbors of every sufficiently reviewed product into the product_similarity table.
+# Review data only changes on ingest, so recommendations can be computed ahead of time and served with a single index lookup
+# using get_recommendations(..., source = 'precomputed').
+#
+# Usage (from the presto directory):
+#   python -m shared.precompute --db data/products.sql --category Music --min-reviews 50
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import sqlite3 as sql
+import time
+
+import pandas as pd
+
+import shared.query as q
+
+def get_candidate_products(conn: sql.Connection, category = None, min_reviews = 50, skip_existing = True) -> pd.Series:
+    """
+    Returns the ids of products that have at least min_reviews reviews, optionally limited to one category ('Books', 'Music').
+    With skip_existing, products that a previous build already processed are omitted so that interrupted builds can be resumed.
+    """
+    if q.table_exists('product_stats', conn):
+        q_str = "SELECT p.id FROM product p JOIN product_stats s ON s.product_id = p.id AND s.review_count >= ?"
+    else:
+        q_str = """
+        SELECT p.id FROM product p JOIN (
+            SELECT product_id, COUNT(*) AS reviews FROM review GROUP BY product_id HAVING reviews >= ?
+        ) r ON r.product_id = p.id
+        """
+    params = [min_reviews]
+    conditions = []
+    if category != None:
+        conditions.append("p.category = ?")
+        params.append(category)
+    if skip_existing:
+        # product_similarity covers builds from before product_similarity_done existed
+        conditions.append("p.id NOT IN (SELECT product_id FROM product_similarity_done)")
+        conditions.append("p.id NOT IN (SELECT DISTINCT product_id FROM product_similarity)")
+    if len(conditions) > 0:
+        q_str += " WHERE " + " AND ".join(conditions)
+    return q.query(q_str, conn, params = params, query_description = 'precompute candidates', verbosity = 0).id
+
+# Each worker process holds its own read-only connection
+_worker_connection = None
+_worker_settings = {}
+
+def _init_worker(db: str, settings: dict):
+    global _worker_connection, _worker_settings
+    _worker_connection = q.connect(db)
+    _worker_settings = settings
+
+def _compute_neighbors(product_ids: list) -> pd.DataFrame:
+    """
+    Computes the neighbors for a chunk of products. Runs inside a worker process.
+    """
+    results = []
+    for product_id in product_ids:
+        _, related_reviews = q.get_recommendation_pool(
+            product_id,
+            _worker_connection,
+            filter_unhelpful_reviews = _worker_settings.get('filter_unhelpful_reviews', True),
+            reviewer_max_pool_size = _worker_settings.get('reviewer_max_pool_size', 100),
+            product_max_pool_size = _worker_settings.get('product_max_pool_size', 1_000),
+            verbosity = 0
+        )
+        if product_id not in related_reviews.product_id.values:
+            continue # no helpful reviews by known users: nothing to compare against
+        neighbors = q.get_product_neighbors(product_id, related_reviews, limit = _worker_settings.get('limit', 100)).reset_index()
+        neighbors.insert(0, 'product_id', product_id)
+        results.append(neighbors)
+    if len(results) == 0:
+        return pd.DataFrame(columns = ['product_id', 'neighbor_id', 'similarity', 'co_raters'])
+    return pd.concat(results, ignore_index = True)
+
+def build_product_similarities(
+    db = 'data/products.sql',
+    category = None,
+    min_reviews = 50,
+    limit = 100,
+    filter_unhelpful_reviews = True,
+    reviewer_max_pool_size = 100,
+    product_max_pool_size = 1_000,
+    workers = None,
+    chunk_size = 20,
+    rebuild = False,
+    verbosity = 1
+) -> int:
+    """
+    Precomputes the top neighbors of every product with at least min_reviews reviews and stores them in the product_similarity table.
+
+    Work is spread across a pool of worker processes, each computing recommendations exactly like get_recommendations does.
+    Results are written and committed one chunk at a time, so an interrupted build can simply be run again to resume where it
+    left off. Use rebuild to discard previous results (for the given category) after new reviews have been ingested.
+
+    Returns the number of neighbor records written.
+
+    Parameters
+    ----------
+    - category: limit the build to one category ('Books', 'Music'). None builds all categories.
+    - min_reviews: products with fewer reviews are skipped. Recommendations for rarely reviewed products are of little use.
+    - limit: the number of neighbors to store per product
+    - workers: the number of worker processes. None uses one per CPU.
+    - chunk_size: the number of products per unit of work. Each chunk is committed separately.
+    - Other parameters are as in get_recommendations.
+    """
+    t = time.perf_counter()
+    def profile(message: str):
+        if verbosity > 0:
+            elapsed = time.perf_counter() - t
+            print(f"{elapsed:.2f}: {message}")
+
+    conn = q.connect(db)
+    q.update_schema(conn)
+    if rebuild:
+        if category == None:
+            conn.execute("DELETE FROM product_similarity")
+            conn.execute("DELETE FROM product_similarity_done")
+        else:
+            conn.execute("DELETE FROM product_similarity WHERE product_id IN (SELECT id FROM product WHERE category = ?)", [category])
+            conn.execute("DELETE FROM product_similarity_done WHERE product_id IN (SELECT id FROM product WHERE category = ?)", [category])
+        conn.commit()
+    product_ids = get_candidate_products(conn, category = category, min_reviews = min_reviews).tolist()
+    profile(f'Precomputing neighbors for {len(product_ids):,d} products')
+
+    settings = {
+        'limit': limit,
+        'filter_unhelpful_reviews': filter_unhelpful_reviews,
+        'reviewer_max_pool_size': reviewer_max_pool_size,
+        'product_max_pool_size': product_max_pool_size
+    }
+    chunks = [product_ids[i : i + chunk_size] for i in range(0, len(product_ids), chunk_size)]
+    insert_query = "INSERT INTO product_similarity(product_id, neighbor_id, similarity, co_raters) VALUES(?,?,?,?)"
+    product_count, record_count = 0, 0
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (db, settings)) as executor:
+        futures = {executor.submit(_compute_neighbors, chunk): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            neighbors = future.result()
+            records = zip(
+                neighbors.product_id.tolist(), neighbors.neighbor_id.tolist(),
+                neighbors.similarity.tolist(), neighbors.co_raters.tolist()
+            )
+            conn.executemany(insert_query, records)
+            # including products without neighbors, which have no product_similarity rows to show they were processed
+            conn.executemany("INSERT OR IGNORE INTO product_similarity_done(product_id) VALUES(?)", [[product_id] for product_id in futures[future]])
+            conn.commit()
+            product_count += len(futures[future])
+            record_count += len(neighbors)
+            profile(f'{product_count:,d} of {len(product_ids):,d} products ({record_count:,d} neighbors) @ {product_count / (time.perf_counter() - t):.1f} products / sec')
+    conn.close()
+    return record_count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Precompute product recommendations into the product_similarity table')
+    parser.add_argument('--db', default = 'data/products.sql')
+    parser.add_argument('--category', default = None, help = "limit the build to one category, e.g. 'Books' or 'Music'")
+    parser.add_argument('--min-reviews', type = int, default = 50)
+    parser.add_argument('--limit', type = int, default = 100, help = 'neighbors to store per product')
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--rebuild', action = 'store_true', help = 'discard previously precomputed neighbors first')
+    args = parser.parse_args()
+    build_product_similarities(
+        db = args.db, category = args.category, min_reviews = args.min_reviews,
+        limit = args.limit, workers = args.workers, rebuild = args.rebuild
+    )
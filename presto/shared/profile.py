@@ -1,7 +1,27 @@
 # profile.py
-# A simple time profiler to create timestamped log messages
+# A simple time profiler to create timestamped log messages, and a tracer that aggregates stage timings across requests.
+#
+# Tracing is disabled by default and then costs one attribute check per traced function. Once enabled, every traced function
+# call becomes a span: a named, timed stage nested under the span of its caller, with attributes such as row counts.
+# Span durations are collected per stage (the path of nested span names) into latency histograms, and SQL statements on
+# traced connections are timed the same way.
+#
+# Usage:
+#   from shared.profile import tracer
+#   tracer.enable()
+#   tracer.trace_connection(conn)    # optional: time every SQL statement on this connection
+#   q.get_recommendations('Music', 'Nevermind', conn)
+#   print(tracer.get_stats()['stages']['get_recommendations/get_recommendation_pool']['p95'])
+#   tracer.export_json('trace.json')
+from collections import deque
+import functools
+import json
+import re
+import threading
 import time
 
+import numpy as np
+
 class Profiler:
     def __init__(self):
         self._timestamp = time.perf_counter()
@@ -12,4 +32,299 @@ class Profiler:
 
     def start(self):
         self._timestamp = time.perf_counter()
-    
\ No newline at end of file
+
+###########
+# Spans
+###########
+class Span(Profiler):
+    """
+    A named, timed stage of work. Spans are created by Tracer.span and nest: the path of a span is the path of its parent
+    plus its own name, e.g. 'get_recommendations/get_recommendation_pool/get_related_reviews'.
+    """
+    def __init__(self, tracer: 'Tracer', name: str, parent: 'Span' = None, attributes: dict = None):
+        super().__init__()
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.path = name if parent is None else parent.path + '/' + name
+        self.attributes = attributes or {}
+        self.events = [] # (seconds since the start of the span, message)
+        self.children = []
+        self.duration = None
+
+    def set(self, **attributes):
+        """
+        Sets attributes of the span, e.g. span.set(rows = len(reviews))
+        """
+        self.attributes.update(attributes)
+
+    def event(self, message: str, **attributes):
+        """
+        Records a timestamped message within the span, plus optional attributes
+        """
+        self.events.append((time.perf_counter() - self._timestamp, message))
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> 'Span':
+        self.tracer._push(self)
+        self.start()
+        return self
+
+    def __exit__(self, *exception):
+        self.duration = time.perf_counter() - self._timestamp
+        self.tracer._pop(self)
+        return False
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'events': [{'time': elapsed, 'message': message} for elapsed, message in self.events],
+            'children': [child.to_dict() for child in self.children]
+        }
+
+class _NullSpan:
+    """
+    The span returned while tracing is disabled: accepts the same calls as Span and does nothing
+    """
+    def set(self, **attributes):
+        pass
+
+    def event(self, message: str, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+_null_span = _NullSpan()
+
+###########
+# Stats
+###########
+class Histogram:
+    """
+    Latency statistics of a stage. Percentiles are computed over the most recent max_samples durations,
+    so that memory stays bounded in long-running processes. Counts and totals cover all durations.
+    """
+    def __init__(self, max_samples = 10_000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen = max_samples)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the count, total, mean, p50, p95, p99 and max in seconds
+        """
+        p50, p95, p99 = np.percentile(self.samples, [50, 95, 99]) if len(self.samples) > 0 else (None, None, None)
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count > 0 else None,
+            'p50': None if p50 is None else float(p50),
+            'p95': None if p95 is None else float(p95),
+            'p99': None if p99 is None else float(p99),
+            'max': self.max
+        }
+
+def get_statement_key(statement: str) -> str:
+    """
+    Normalizes an SQL statement for aggregation: bound values become '?', runs of '?' are collapsed and whitespace is condensed,
+    so that executions of the same statement with different parameters share one histogram.
+    """
+    statement = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    statement = re.sub(r'(?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b', '?', statement, flags = re.IGNORECASE)
+    statement = re.sub(r'\bNULL\b', '?', statement)
+    statement = re.sub(r'\?(?:\s*,\s*\?)+', '?, ...', statement)
+    return ' '.join(statement.split())
+
+###########
+# Tracer
+###########
+class Tracer:
+    """
+    Collects spans into per-stage latency histograms (see the top of this file). Thread-safe: every thread has its own stack
+    of open spans, so concurrent requests are traced independently.
+    """
+    def __init__(self, enabled = False, max_samples = 10_000, max_traces = 100):
+        """
+        Parameters
+        ----------
+        - enabled: whether to record spans. Disabled tracers cost next to nothing.
+        - max_samples: the number of recent durations per stage to compute percentiles from
+        - max_traces: the number of recent root spans (with their nested spans) to keep for inspection
+        """
+        self.enabled = enabled
+        self.max_samples = max_samples
+        self.stages = {}    # span path -> Histogram
+        self.statements = {}    # normalized SQL statement -> Histogram
+        self.traces = deque(maxlen = max_traces)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.statements = {}
+            self.traces.clear()
+
+    def current(self) -> Span:
+        """
+        Returns the innermost open span of the calling thread, or None
+        """
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def span(self, name: str, **attributes):
+        """
+        Returns a context manager that times a stage as a span nested under the current span:
+            with tracer.span('similarities', products = len(product_ids)) as span:
+                ...
+                span.set(pairs = len(pairs))
+        """
+        if not self.enabled:
+            return _null_span
+        return Span(self, name, self.current(), attributes)
+
+    def traced(self, name: str = None):
+        """
+        Decorator that runs every call of a function in a span named after the function
+        """
+        def decorator(function):
+            span_name = name or function.__name__
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with Span(self, span_name, self.current()):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def logger(self, verbosity: int, t: float = None):
+        """
+        Returns a function that logs progress messages as '<seconds since t>: <message>' when verbosity > 0,
+        and records them as events (with optional attributes) on the current span when tracing is enabled:
+            profile = tracer.logger(verbosity, t)
+            profile(f'Got {len(reviews)} reviews', reviews = len(reviews))
+        """
+        t = t or time.perf_counter()
+        if verbosity <= 0 and not self.enabled:
+            return _ignore
+        def profile(message: str, **attributes):
+            if verbosity > 0:
+                elapsed = time.perf_counter() - t
+                print(f"{elapsed:.3}: {message}")
+            if self.enabled:
+                span = self.current()
+                if span is not None:
+                    span.event(message, **attributes)
+        return profile
+
+    def _push(self, span: Span):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(span)
+
+    def _pop(self, span: Span):
+        self._finish_statement()
+        stack = self._local.stack
+        stack.pop()
+        with self._lock:
+            histogram = self.stages.get(span.path)
+            if histogram is None:
+                histogram = self.stages[span.path] = Histogram(self.max_samples)
+            histogram.add(span.duration)
+            if span.parent is None:
+                self.traces.append(span)
+            else:
+                span.parent.children.append(span)
+
+    ###########
+    # SQL
+    ###########
+    def trace_connection(self, conn):
+        """
+        Times every SQL statement executed on a connection while tracing is enabled.
+
+        SQLite only reports when a statement starts (see sqlite3.Connection.set_trace_callback), so a statement's time runs
+        until the next statement on the same thread starts or the enclosing span ends. This includes fetching its results.
+        Statements are also counted on the enclosing span as sql_statements and sql_seconds.
+        """
+        conn.set_trace_callback(self._on_statement)
+
+    def untrace_connection(self, conn):
+        conn.set_trace_callback(None)
+
+    def _on_statement(self, statement: str):
+        if not self.enabled:
+            return
+        self._finish_statement()
+        self._local.statement = (statement, time.perf_counter(), self.current())
+
+    def _finish_statement(self):
+        pending = getattr(self._local, 'statement', None)
+        if pending is None:
+            return
+        self._local.statement = None
+        statement, start, span = pending
+        duration = time.perf_counter() - start
+        if span is not None:
+            span.attributes['sql_statements'] = span.attributes.get('sql_statements', 0) + 1
+            span.attributes['sql_seconds'] = span.attributes.get('sql_seconds', 0) + duration
+        key = get_statement_key(statement)
+        with self._lock:
+            histogram = self.statements.get(key)
+            if histogram is None:
+                histogram = self.statements[key] = Histogram(self.max_samples)
+            histogram.add(duration)
+
+    ###########
+    # Export
+    ###########
+    def get_stats(self) -> dict:
+        """
+        Returns latency statistics in seconds per stage (span path) and per SQL statement (see Histogram.get_stats)
+        """
+        with self._lock:
+            return {
+                'stages': {path: histogram.get_stats() for path, histogram in sorted(self.stages.items())},
+                'statements': {statement: histogram.get_stats() for statement, histogram in self.statements.items()}
+            }
+
+    def export_json(self, path: str = None, include_traces = False) -> str:
+        """
+        Returns the stats as JSON, optionally with the recent traces, and writes them to a file if a path is given
+        """
+        result = self.get_stats()
+        if include_traces:
+            with self._lock:
+                result['traces'] = [span.to_dict() for span in self.traces]
+        text = json.dumps(result, indent = 2, default = str)
+        if path is not None:
+            with open(path, 'w') as file:
+                file.write(text)
+        return text
+
+def _ignore(message: str, **attributes):
+    pass
+
+# The tracer used throughout the project
+tracer = Tracer()
@@ -1,35 +1,242 @@
+from concurrent.futures import ProcessPoolExecutor
 import os
 import re
 import time
 import unidecode
 
+import numpy as np
 import pandas as pd
 import sqlite3 as sql
 
+import shared.connection as connection
+import shared.integer_keys as integer_keys
+from shared.profile import tracer
 import shared.reviews as rev
 
 ##################
 # Utilities
 #################
-def connect(db = 'data/products.sql') -> sql.Connection:
+def connect(db = 'data/products.sql', read_only = False, pragmas: dict = None) -> sql.Connection:
+    """
+    Opens a connection to the product database, tuned for large read-heavy workloads (see shared/connection.py).
+    To query from multiple threads, use a connection.ConnectionPool instead.
+    """
     if not os.path.exists(db):
         curdir = os.path.abspath(os.curdir)
         print(f"Path {db} does not exist in {curdir}")
-    return sql.connect(db)
+    return connection.open_connection(db, read_only = read_only, pragmas = pragmas)
+
+def placeholders(params: list, pad_value = None) -> tuple[str, list]:
+    """
+    Returns a placeholder string for an SQL IN (...) clause along with the parameters to bind to it.
+
+    SQLite can only reuse a prepared statement for identical SQL, and IN lists of different lengths make for different SQL.
+    To let hot queries reuse prepared statements, the placeholder count is rounded up to a power of two and the extra 
+    parameters are padded with NULL, which never matches anything in an IN clause.
+    """
+    # sqlite can not bind numpy scalars such as numpy.int64, so convert to Python values
+    if hasattr(params, 'tolist'):
+        params = params.tolist()
+    else:
+        params = [value.item() if isinstance(value, np.generic) else value for value in params]
+    count = len(params)
+    bucket_size = 1 << max(count - 1, 0).bit_length()
+    if bucket_size <= 16_384: # beyond this, stay well clear of sqlite's limit on query parameters
+        params += [pad_value] * (bucket_size - count)
+    return ','.join('?' * len(params)), params
 
 query_verbosity = 1
-def query(q: str, conn: sql.Connection, params = None, verbosity = query_verbosity, query_description = None) -> pd.DataFrame:
+
+def table_exists(table: str, conn: sql.Connection) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", [table]).fetchone() is not None
+
+schema_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'init', 'sql_schema')
+
+# Review stats columns and the SQL aggregates over the review table that compute them. 
+# Used both to populate new stats tables here and to refresh them on ingest (see sql_ingest.refresh_product_stats).
+rating_histogram_columns = [f'rating_{stars}' for stars in range(1, 6)]
+product_stats_aggregates = {
+    'review_count': 'COUNT(*)',
+    'helpful_review_count': 'SUM(upvotes >= downvotes)',
+    'avg_rating': 'AVG(rating)',
+    **{column: f'SUM(ROUND(MIN(MAX(rating, 1), 5)) = {stars})' for stars, column in enumerate(rating_histogram_columns, start = 1)}
+}
+user_stats_aggregates = {
+    'review_count': 'COUNT(*)',
+    'helpful_review_count': 'SUM(upvotes >= downvotes)'
+}
+
+def get_stats_statement(table: str, key_column: str, aggregates: dict, conditions: list = None) -> str:
+    """
+    Returns the statement that inserts the stats of a stats table computed from the review table, optionally
+    only for reviews that match all conditions (SQL expressions)
+    """
+    columns = ', '.join([key_column] + list(aggregates.keys()))
+    where = '' if not conditions else 'WHERE ' + ' AND '.join(conditions)
+    return f"""
+    INSERT INTO {table}({columns})
+    SELECT {key_column}, {', '.join(aggregates.values())} FROM review {where} GROUP BY {key_column}
+    """
+
+# Tables derived from other tables, with the statement that populates them from existing data
+derived_tables = {
+    'product_search': "INSERT INTO product_search(product_search) VALUES('rebuild')",
+    'product_stats': get_stats_statement('product_stats', 'product_id', product_stats_aggregates),
+    'user_stats': get_stats_statement('user_stats', 'user_id', user_stats_aggregates, ['user_id IS NOT NULL'])
+}
+
+# Columns added to existing tables after they were first created, with their definitions in the project schema.
+# CREATE TABLE IF NOT EXISTS leaves existing tables as they are, so update_schema adds these with ALTER TABLE.
+added_columns = {
+    'product': {'work_id': 'INTEGER REFERENCES work(id)'}
+}
+
+# Assigns products without a work to the work of their title and creator, creating missing works (see sql_ingest.assign_works)
+work_statements = [
+    """
+    INSERT OR IGNORE INTO work(title_search, creator_search)
+    SELECT DISTINCT ifnull(title_search, ''), ifnull(creator_search, '') FROM product WHERE work_id IS NULL
+    """,
+    """
+    UPDATE product SET work_id = (
+        SELECT w.id FROM work w WHERE w.title_search = ifnull(product.title_search, '') AND w.creator_search = ifnull(product.creator_search, '')
+    ) WHERE work_id IS NULL
+    """
+]
+
+def has_works(conn: sql.Connection) -> bool:
+    """
+    Returns whether a database has works: the work table and product.work_id, which update_schema adds to older databases
+    """
+    return table_exists('work', conn) and 'work_id' in {row[1] for row in conn.execute("PRAGMA table_info(product)")}
+
+def check_works(conn: sql.Connection):
+    if not has_works(conn):
+        raise ValueError('This database has no works. Run update_schema to add them and assign products to works.')
+
+def add_missing_columns(conn: sql.Connection, columns = added_columns) -> list:
+    """
+    Adds the columns in columns (table -> column -> definition) that existing tables do not have yet. 
+    Returns the added columns as 'table.column'.
+    """
+    added = []
+    for table, definitions in columns.items():
+        if not table_exists(table, conn):
+            continue
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for column, definition in definitions.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                added.append(f'{table}.{column}')
+    return added
+
+def update_schema(conn: sql.Connection, schema = schema_path, verbosity = query_verbosity):
+    """
+    Creates any tables, columns and indices from the project schema that do not exist yet in the database. 
+    Existing tables and data are left untouched, so this is safe to run against an existing database.
+
+    Newly created derived tables (such as the product search index) are populated from existing data, which can take 
+    a while for a large database. Likewise, products without a work are assigned one. Databases with integer keys get
+    the integer key variant of the schema (see shared/integer_keys.py).
+    """
+    missing_tables = [table for table in derived_tables if not table_exists(table, conn)]
+    with open(schema) as file:
+        script = file.read()
+    if integer_keys.has_integer_keys(conn):
+        script = integer_keys.get_schema(script)
+    # before the script, since it creates indices on added columns
+    for column in add_missing_columns(conn):
+        if verbosity > 0:
+            print(f'Added column {column}')
+    conn.executescript(script)
+    for table in missing_tables:
+        t = time.perf_counter()
+        conn.execute(derived_tables[table])
+        conn.commit()
+        if verbosity > 0:
+            print(f'Populated {table} in {time.perf_counter() - t:.3f} seconds')
+    if conn.execute("SELECT 1 FROM product WHERE work_id IS NULL LIMIT 1").fetchone() is not None:
+        t = time.perf_counter()
+        for statement in work_statements:
+            conn.execute(statement)
+        conn.commit()
+        if verbosity > 0:
+            print(f'Assigned works in {time.perf_counter() - t:.3f} seconds')
+
+def fetch_arrays(cursor: sql.Cursor, dtypes: dict, batch_size = 65_536) -> dict:
+    """
+    Fetches the results of an executed query into a dictionary of column name -> NumPy array, without building a DataFrame
+    from row tuples and inferring column types as pd.read_sql_query does.
+
+    Rows are fetched batch_size at a time, turned into a 2D object array in one step and copied column by column into 
+    preallocated arrays of the given dtypes, which grow as needed. Columns with dtype 'category' are returned as pd.Categorical
+    with sorted categories (missing values have code -1), so that grouping by them orders groups like grouping by the raw values.
+    Other columns hold Python objects. Numeric columns that turn out to contain NULL become float columns with NaN.
+    """
+    names = [column[0] for column in cursor.description]
+    kinds = [dtypes.get(name, object) for name in names]
+    capacity = batch_size
+    arrays = [np.empty(capacity, dtype = 'O' if kind == 'category' else kind) for kind in kinds]
+    count = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+        end = count + len(rows)
+        if end > capacity:
+            capacity = max(capacity * 2, end)
+            arrays = [np.resize(array, capacity) for array in arrays]
+        block = np.array(rows, dtype = object).reshape(len(rows), len(names))
+        for i, array in enumerate(arrays):
+            try:
+                array[count:end] = block[:, i]
+            except TypeError: # NULL in a numeric column
+                arrays[i] = array.astype(float)
+                arrays[i][count:end] = np.array(block[:, i].tolist(), dtype = float)
+        count = end
+    result = {}
+    for name, kind, array in zip(names, kinds, arrays):
+        if kind == 'category':
+            codes, categories = pd.factorize(array[:count], sort = True)
+            result[name] = pd.Categorical.from_codes(codes, categories)
+        else:
+            result[name] = array[:count]
+    return result
+
+def query(
+    q: str, 
+    conn: sql.Connection, 
+    params = None, 
+    verbosity = query_verbosity, query_description = None,
+    dtypes: dict = None,
+    as_arrays = False
+) -> pd.DataFrame | dict:
     """
     Utility to execute an SQL query with optional automatic logging and performance profiling
+
+    Parameters
+    ----------
+    - dtypes: column name -> NumPy dtype or 'category'. Fetches results into typed arrays with fetch_arrays rather than 
+      through pd.read_sql_query. Results take a fraction of the memory, and grouping and filtering them afterwards is 
+      much faster. Unlisted columns hold Python objects.
+    - as_arrays: return the dictionary of arrays from fetch_arrays instead of a DataFrame
     """
     if verbosity > 1:
         print(f'QUERY: {q}')
     query_description = query_description or q
     t = time.perf_counter()
-    results = pd.read_sql_query(q, conn, params = params)
+    with tracer.span('query', description = query_description) as span:
+        if dtypes is None and not as_arrays:
+            results = pd.read_sql_query(q, conn, params = params)
+        else:
+            results = fetch_arrays(conn.execute(q, params or []), dtypes or {})
+            if not as_arrays:
+                results = pd.DataFrame(results, copy = False)
+        count = len(results) if not as_arrays else len(next(iter(results.values()), []))
+        span.set(rows = count)
     if verbosity > 0:
         elapsed = time.perf_counter() - t
-        print(f'{query_description}: {len(results)} results in {elapsed:.3f} seconds')
+        print(f'{query_description}: {count} results in {elapsed:.3f} seconds')
     return results
 
 def get_records_by_ids(
@@ -38,16 +245,21 @@ def get_records_by_ids(
     connection: sql.Connection, 
     id_column = 'id', 
     select = "*",
-    verbosity = query_verbosity, query_description = None
-) -> pd.DataFrame:
+    verbosity = query_verbosity, query_description = None,
+    dtypes: dict = None,
+    as_arrays = False
+) -> pd.DataFrame | dict:
     """
     General-purpose utility to fetch details for multiple records by ID. Testing has shown this form of query to be quite scalable and performant.
+    Pass dtypes (and optionally as_arrays) to fetch into typed arrays (see query).
     """
     query_description = query_description or f'{table}.{id_column} lookup ({len(ids)} values)'
-    values = ','.join('?' * len(ids))
-    params = ids
+    values, params = placeholders(ids)
     q = f"SELECT {select} FROM {table} WHERE {id_column} IN ({values})"
-    return query(q, conn = connection, params = params, verbosity = verbosity, query_description = query_description)
+    return query(
+        q, conn = connection, params = params, verbosity = verbosity, query_description = query_description, 
+        dtypes = dtypes, as_arrays = as_arrays
+    )
 
 def search_text(text: str) -> str:
     """
@@ -71,6 +283,39 @@ def search_text(text: str) -> str:
     result = unidecode.unidecode(result) # remove all accents/diacritics
     return result
 
+def _search_texts(texts: list) -> list:
+    # module-level so that worker processes can unpickle it
+    return [search_text(text) for text in texts]
+
+def search_texts(texts: pd.Series, workers = None, parallel_threshold = 200_000, chunk_size = 50_000) -> pd.Series:
+    """
+    Batch version of search_text for a whole column, e.g. product titles and creators at ingest.
+    Results are identical to texts.map(search_text).
+
+    Every distinct value is only normalized once, which saves most of the work for columns with many repeats (creators).
+    With more than parallel_threshold distinct values the work is spread across worker processes.
+
+    Parameters
+    ----------
+    - workers: the number of worker processes, defaults to the number of CPUs. 1 disables multiprocessing.
+    - parallel_threshold: the minimum number of distinct values worth starting worker processes for
+    - chunk_size: the number of distinct values sent to a worker at a time
+    """
+    # missing values are left out of the factorization because e.g. None and NaN normalize differently ('none' vs 'nan')
+    codes, uniques = pd.factorize(texts)
+    uniques = list(uniques)
+    if len(uniques) >= parallel_threshold and workers != 1 and (workers or os.cpu_count() or 1) > 1:
+        chunks = [uniques[i:i + chunk_size] for i in range(0, len(uniques), chunk_size)]
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            normalized = [text for chunk in executor.map(_search_texts, chunks) for text in chunk]
+    else:
+        normalized = _search_texts(uniques)
+    result = np.empty(len(texts), dtype = object)
+    found = codes >= 0
+    result[found] = np.array(normalized, dtype = object)[codes[found]]
+    result[~found] = _search_texts(texts[~found].tolist())
+    return pd.Series(result, index = texts.index, name = texts.name, dtype = str)
+
 ###########
 # Products
 ###########
@@ -84,6 +329,7 @@ def remove_duplicate_products(products: pd.DataFrame) -> pd.DataFrame:
     """
     return products.drop_duplicates(subset = ['title_search', 'creator_search'])
 
+@tracer.traced()
 def find_products(
     category: str,
     search_term: str,
@@ -97,22 +343,81 @@ def find_products(
     Implements a sophisticated product search based on a search term and desired category. Cases handled include:
     - Sorting by popularity to help disambiguate multi-result searches
     - All of the search special cases described in the search_text documentation
+
+    Non-exact (substring) searches use the product_search trigram index when the database has one (see update_schema), 
+    which makes them about as fast as exact searches instead of scanning every product. Likewise, popularity is read from
+    the product_stats table when available instead of counting reviews, and duplicate editions are removed in SQL by
+    grouping products by work (see the work table) when the database has works.
     """
-    columns = 'id, COUNT(*) AS reviews, p.title, title_search, creator, creator_search, publisher, description, release_date, category, subcategory'
+    columns = 'p.title, title_search, creator, creator_search, publisher, description, release_date, category, subcategory'
+    if integer_keys.has_integer_keys(conn):
+        columns = 'external_id, ' + columns
     search_term = search_text(search_term)
     params = [category, search_term] if exact_match else [category, f'%{search_term}%']
-    operator = "=" if exact_match else 'LIKE'
+    if exact_match:
+        condition = f'{search_field}_search = ?'
+    elif table_exists('product_search', conn):
+        condition = f'p.rowid IN (SELECT rowid FROM product_search WHERE {search_field}_search LIKE ?)'
+    else:
+        condition = f'{search_field}_search LIKE ?'
+    has_stats = table_exists('product_stats', conn)
+    group_by_work = remove_duplicates and has_stats and has_works(conn)
+    if group_by_work:
+        # SQLite takes the other columns from the row with the maximum, i.e. the most reviewed edition of each work.
+        # Products without a work are kept as they are.
+        q = f"""
+        SELECT id, MAX(s.review_count) AS reviews, {columns} 
+        FROM product_stats s JOIN product p ON s.product_id = p.id
+        WHERE category = ? AND {condition}
+        GROUP BY ifnull(p.work_id, -p.rowid) ORDER BY reviews DESC
+        """
+    elif has_stats:
+        q = f"""
+        SELECT id, s.review_count AS reviews, {columns} 
+        FROM product_stats s JOIN product p ON s.product_id = p.id
+        WHERE category = ? AND {condition}
+        ORDER BY reviews DESC
+        """
+    else:
+        q = f"""
+        SELECT id, COUNT(*) AS reviews, {columns} 
+        FROM review r JOIN product p ON r.product_id = p.id
+        WHERE category = ? AND {condition}
+        GROUP BY product_id ORDER BY reviews DESC
+        """
+    results = query(q, conn, params = params, query_description = 'find_products', verbosity = verbosity)
+    if remove_duplicates and not group_by_work:
+        results = remove_duplicate_products(results)
+    return results.drop(columns = ['title_search', 'creator_search'])
+
+def get_popular_products(
+    category: str,
+    conn: sql.Connection,
+    limit = 100,
+    verbosity = query_verbosity,
+    remove_duplicates = True
+) -> pd.DataFrame:
+    """
+    Returns the most reviewed products in a category, most popular first, along with their review statistics.
+
+    Reads from the product_stats table, so this is fast enough for user-facing results even across the full catalog.
+    """
+    external_id = 'external_id, ' if integer_keys.has_integer_keys(conn) else ''
     q = f"""
-    SELECT {columns} 
-    FROM review r JOIN product p ON r.product_id = p.id
-    WHERE category = ? AND {search_field}_search {operator} ?
-    GROUP BY product_id ORDER BY reviews DESC
+    SELECT id, {external_id}s.review_count AS reviews, s.helpful_review_count AS helpful_reviews, s.avg_rating, 
+    p.title, title_search, creator, creator_search, publisher, release_date, category, subcategory
+    FROM product_stats s JOIN product p ON s.product_id = p.id
+    WHERE category = ?
+    ORDER BY s.review_count DESC LIMIT ?
     """
-    results = query(q, conn, params = params, query_description = 'find_products', verbosity = verbosity)
+    # fetch extra products to make up for duplicate editions. Popular products tend to have several.
+    fetch_limit = limit * 2 if remove_duplicates else limit
+    results = query(q, conn, params = [category, fetch_limit], query_description = 'get_popular_products', verbosity = verbosity)
     if remove_duplicates:
         results = remove_duplicate_products(results)
-    return results.drop(columns = ['title_search', 'creator_search'])
+    return results[:limit].drop(columns = ['title_search', 'creator_search'])
 
+@tracer.traced()
 def get_product_details(product_ids, conn: sql.Connection, select = '*', verbosity = query_verbosity) -> pd.DataFrame:
     """
     Given a list of up to 250,000 product IDs, return product details for each product.
@@ -128,62 +433,151 @@ def get_product_details(product_ids, conn: sql.Connection, select = '*', verbosi
         result.set_index('id', inplace = True)
     return result
 
+def get_work_ids(product_ids, conn: sql.Connection) -> pd.Series:
+    """
+    Given product IDs, return the id of the work of each product (see the work table), indexed by product id.
+    Products without a work are left out. Raises a ValueError for databases without works (see check_works).
+    """
+    check_works(conn)
+    works = get_records_by_ids(product_ids, 'product', conn, select = 'id, work_id', verbosity = 0, query_description = 'work ids')
+    return works.dropna().set_index('id').work_id.astype(np.int64)
+
+def get_edition_ids(product_id, conn: sql.Connection) -> list:
+    """
+    Returns the ids of all editions of a product (the products that share its work), including the product itself.
+    Raises a ValueError for databases without works (see check_works).
+    """
+    check_works(conn)
+    q = "SELECT id FROM product WHERE work_id = (SELECT work_id FROM product WHERE id = ?)"
+    edition_ids = [row[0] for row in conn.execute(q, [product_id])]
+    return edition_ids or [product_id]
+
+@tracer.traced()
+def get_work_details(work_ids, conn: sql.Connection, verbosity = query_verbosity) -> pd.DataFrame:
+    """
+    Given a list of work IDs, return product details for the most reviewed edition of each work, indexed by work id.
+    """
+    values, params = placeholders(work_ids)
+    # SQLite takes the other columns from the row with the maximum, i.e. the most reviewed edition
+    q = f"""
+    SELECT p.*, MAX(ifnull(s.review_count, 0)) AS reviews
+    FROM product p LEFT JOIN product_stats s ON s.product_id = p.id
+    WHERE p.work_id IN ({values}) GROUP BY p.work_id
+    """
+    result = query(q, conn, params = params, verbosity = verbosity, query_description = f'work details {len(work_ids)}')
+    return result.drop(columns = 'reviews').set_index('work_id')
+
 ############
 # Reviews
 ############
+# Column types for fetching reviews into typed arrays (see fetch_arrays). Ids become categoricals, so that pandas groups and
+# compares them by integer code rather than by string.
+review_dtypes = {
+    'user_id': 'category',
+    'product_id': 'category',
+    'rating': float,
+    'upvotes': np.int64,
+    'downvotes': np.int64
+}
+
+@tracer.traced()
 def get_reviews(
     product_id_or_products, # use product id for single product reviews, collection of ids for multiple products
     conn: sql.Connection,
     drop_null_reviewers = False,
     fields = '*',
-    verbosity = query_verbosity
+    verbosity = query_verbosity,
+    store = None,
+    dtypes: dict = None
 ) -> pd.DataFrame:
     """
     Retrieves all reviews associated with one or more products
+
+    With a ReviewStore (see shared/review_store.py), reviews are read from the store instead of the database. 
+    The store only holds the columns in review_store.columns: other fields are not available.
+    Pass dtypes (e.g. review_dtypes) to fetch reviews into typed columns (see fetch_arrays).
     """
-    product_ids = [product_id_or_products] if isinstance(product_id_or_products, str) else product_id_or_products
-    values = ','.join('?' * len(product_ids))
+    is_single_product = isinstance(product_id_or_products, (str, int, np.integer)) # product ids are integers in databases with integer keys
+    product_ids = [product_id_or_products] if is_single_product else product_id_or_products
+    if store is not None:
+        reviews = store.get_reviews(product_ids, drop_null_reviewers = drop_null_reviewers)
+        return reviews if fields == '*' else reviews[[field.strip() for field in fields.split(',')]]
+    values, params = placeholders(product_ids)
     q = f"SELECT {fields} FROM review WHERE product_id IN ({values})"
     if drop_null_reviewers:
         q += " AND user_id IS NOT NULL;"
-    return query(q, conn, params = product_ids, query_description = 'get_reviews', verbosity = verbosity)
+    return query(q, conn, params = params, query_description = 'get_reviews', verbosity = verbosity, dtypes = dtypes)
 
 def _filter_unhlepful_reviews(reviews: pd.DataFrame) -> pd.DataFrame:
     return reviews[reviews.upvotes >= reviews.downvotes]
 
+def get_most_active_users(user_ids, conn: sql.Connection, limit: int, helpful_only = False) -> pd.Series:
+    """
+    Given a list of user IDs, return the IDs of up to limit users with the most reviews, most active first.
+    Reads from the user_stats table. With helpful_only, only helpful reviews are counted. Equally active users are
+    ordered by id, so that the same users are picked every time (and by get_recommendations_batch).
+    """
+    count_column = 'helpful_review_count' if helpful_only else 'review_count'
+    values, params = placeholders(user_ids)
+    q = f"SELECT user_id FROM user_stats WHERE user_id IN ({values}) ORDER BY {count_column} DESC, user_id LIMIT ?"
+    params = params + [limit]
+    return query(q, conn, params = params, query_description = 'most active users', verbosity = 0).user_id
+
+@tracer.traced()
 def get_related_reviews(
     reviews: pd.DataFrame,
     conn: sql.Connection,
     filter_unhelpful_reviews = True,
     max_reviewer_count = 100,
     max_product_count = 1_000,
-    verbosity = query_verbosity, t = None
+    verbosity = query_verbosity, t = None,
+    store = None,
+    dtypes = review_dtypes
 ) -> pd.DataFrame:
     """
     Given reviews of a product, get all reviews of related products.
     Related products are defined as products who share reviewers in common with the passed in dataset.
+
+    When the database has a user_stats table, the most active reviewers are selected in SQL first, so that we only fetch 
+    reviews by the max_reviewer_count users that would survive filtering anyway.
+
+    With a ReviewStore (see shared/review_store.py), reviews are gathered and filtered in memory without querying the database.
+    Otherwise related reviews are fetched into typed columns with categorical ids (see fetch_arrays). Pass dtypes = None 
+    to fetch them through pandas instead.
     """
     t = t or time.perf_counter()
-    def profile(message: str):
-        if verbosity > 0:
-            elapsed = time.perf_counter() - t
-            print(f"{elapsed:.3}: {message}")
+    profile = tracer.logger(verbosity, t)
 
-    reviews = reviews.copy()
     if filter_unhelpful_reviews:
         reviews = _filter_unhlepful_reviews(reviews)
     user_ids = reviews.user_id.dropna().unique()
+    if max_reviewer_count != None and len(user_ids) > max_reviewer_count:
+        if store is not None:
+            user_ids = store.get_most_active_users(user_ids, max_reviewer_count, helpful_only = filter_unhelpful_reviews)
+            profile(f'Selected {len(user_ids)} most active reviewers')
+        elif table_exists('user_stats', conn):
+            user_ids = get_most_active_users(user_ids, conn, max_reviewer_count, helpful_only = filter_unhelpful_reviews)
+            profile(f'Selected {len(user_ids)} most active reviewers')
+    if store is not None:
+        rows = store.get_user_rows(user_ids)
+        if filter_unhelpful_reviews:
+            rows = rows[store.is_helpful(rows)]
+        rows = rows[rev.get_filter_mask(store.user_codes[rows], store.product_codes[rows], max_reviewer_count, max_product_count)]
+        related_reviews = store.get_frame(rows)
+        profile(f'Got {len(related_reviews)} filtered related reviews from the review store', related_reviews = len(related_reviews))
+        return related_reviews
     related_reviews = get_records_by_ids(
         user_ids, 
         table = 'review', id_column = 'user_id', select = 'user_id, product_id, rating, upvotes, downvotes', 
         connection = conn, 
-        verbosity = 0
+        verbosity = 0,
+        dtypes = dtypes
     )
     count = len(related_reviews)
     if verbosity > 0:
         user_count = len(related_reviews.user_id.unique())
         product_count = len(related_reviews.product_id.unique())
-        profile(f'Got {count} related reviews of {product_count} products by {user_count} users')
+        profile(f'Got {count} related reviews of {product_count} products by {user_count} users', related_reviews = count, products = product_count, users = user_count)
     if filter_unhelpful_reviews:
         related_reviews = _filter_unhlepful_reviews(related_reviews)
         if len(related_reviews) < count:
@@ -201,6 +595,7 @@ def get_related_reviews(
 
 from scipy import sparse
 from sklearn.metrics import pairwise_distances
+from sklearn.preprocessing import normalize
 
 def get_ratings_by_user(data: pd.DataFrame, product_column = 'product_id', user_column = 'user_id', rating_column = 'rating') -> pd.DataFrame:
     """
@@ -208,14 +603,81 @@ def get_ratings_by_user(data: pd.DataFrame, product_column = 'product_id', user_
     """
     return pd.pivot(data, values = 'rating', index = 'product_id', columns = 'user_id')
 
-def get_pairwise_similarities(product_ratings_by_user: pd.DataFrame, fill_value = 0) -> pd.DataFrame:
+class RatingMatrix:
+    """
+    A sparse matrix of ratings with products as rows and users as columns, together with the product and user ids 
+    of each row and column. Unlike get_ratings_by_user, missing ratings take up no memory.
+    """
+    def __init__(self, ratings: sparse.csr_matrix, product_ids: pd.Index, user_ids: pd.Index):
+        self.ratings = ratings
+        self.product_ids = product_ids
+        self.user_ids = user_ids
+
+    @property
+    def shape(self):
+        return self.ratings.shape
+
+    def product_index(self, product_id) -> int:
+        return self.product_ids.get_loc(product_id)
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Returns the equivalent of get_ratings_by_user, with NaN for missing ratings. Only use this for small matrices.
+        """
+        result = pd.DataFrame(self.ratings.toarray(), index = self.product_ids, columns = self.user_ids)
+        return result.where(self.ratings.toarray() != 0)
+
+@tracer.traced()
+def get_sparse_ratings_by_user(data: pd.DataFrame, product_column = 'product_id', user_column = 'user_id', rating_column = 'rating') -> RatingMatrix:
+    """
+    Given a dataset that contains ratings per user, return a sparse matrix of ratings with products as rows and users as columns.
+
+    This is the scalable alternative to get_ratings_by_user: product and user ids are converted to integer row/column
+    numbers and the ratings are placed directly into a sparse matrix, without ever creating the (mostly empty) dense table.
+    Reviews without a user are ignored. If a user reviewed a product more than once, only their last review counts:
+    the sparse matrix would otherwise add up their ratings.
+    """
+    data = data[data[user_column].notna()]
+    product_codes, product_ids = pd.factorize(data[product_column], sort = True)
+    user_codes, user_ids = pd.factorize(data[user_column], sort = True)
+    values = data[rating_column].to_numpy(dtype = float)
+    duplicated = pd.Series(product_codes.astype(np.int64) * len(user_ids) + user_codes).duplicated(keep = 'last').to_numpy()
+    if duplicated.any():
+        product_codes, user_codes, values = product_codes[~duplicated], user_codes[~duplicated], values[~duplicated]
+    ratings = sparse.coo_matrix(
+        (values, (product_codes, user_codes)), 
+        shape = (len(product_ids), len(user_ids))
+    ).tocsr()
+    return RatingMatrix(ratings, pd.Index(product_ids), pd.Index(user_ids))
+
+def get_ratings_by_work(data: pd.DataFrame, work_ids: pd.Series) -> pd.DataFrame:
+    """
+    Given a dataset that contains ratings per user and the work id of each product (see get_work_ids), return one rating
+    per user and work: the mean rating of the user over the editions of the work they rated. The product_id column holds work ids.
+    Ratings of products without a work are left out.
+
+    Use this with get_sparse_ratings_by_user to compute similarities between works instead of editions.
+    """
+    works = data.product_id.map(work_ids)
+    has_work = works.notna().to_numpy()
+    ratings = pd.DataFrame({
+        'user_id': data.user_id[has_work], 
+        'product_id': works[has_work].astype(np.int64),
+        'rating': data.rating[has_work].astype(float)
+    })
+    return ratings.groupby(['user_id', 'product_id'], observed = True, sort = False).rating.mean().reset_index()
+
+def get_pairwise_similarities(product_ratings_by_user: pd.DataFrame | RatingMatrix, fill_value = 0) -> pd.DataFrame:
     """
     Given a matrix of product reviews by users, return a matrix of pairwise product similarities.
     
     This method is central to providing recommendations. To find products most related to a searched product, 
     check the row or column of the searched product in the resulting matrix.
     """
-    user_ratings_per_product_sparse = sparse.csr_matrix(product_ratings_by_user.fillna(fill_value))
+    if isinstance(product_ratings_by_user, RatingMatrix):
+        user_ratings_per_product_sparse = product_ratings_by_user.ratings
+    else:
+        user_ratings_per_product_sparse = sparse.csr_matrix(product_ratings_by_user.fillna(fill_value))
     # compute pairwise cosine similarities
     # The resulting entries represent the cosine of the angles between the user review vectors of two products.
     # A cosine similarity of 1 represents identical products while a cosine similarity of 0 represents orthogonal / unrelated products
@@ -223,9 +685,109 @@ def get_pairwise_similarities(product_ratings_by_user: pd.DataFrame, fill_value
     # cosine similarities return 0 for identical products and 1 for produts with no similarity. Let's invert the 
     # scale for an intuitive user-facing metric.
     product_similarities = 1 - cosine_similarities
-    product_ids = product_ratings_by_user.index.values
+    product_ids = product_ratings_by_user.product_ids.values if isinstance(product_ratings_by_user, RatingMatrix) else product_ratings_by_user.index.values
     return pd.DataFrame(product_similarities, index = product_ids, columns = product_ids)
+
+@tracer.traced()
+def get_product_similarities(product_id: str, ratings: RatingMatrix) -> pd.Series:
+    """
+    Given a sparse matrix of product reviews by users, return the similarity of one product to every other product.
+
+    This is equivalent to reading a single row from get_pairwise_similarities, but computes only that row: one sparse
+    dot product of the product's normalized rating vector against every other product. This scales with the number of 
+    ratings rather than with the square of the number of products, which matters for popular products with large pools.
+    """
+    normalized_ratings = normalize(ratings.ratings) # unit-length rows, so dot products are cosine similarities
+    target_index = ratings.product_index(product_id)
+    similarities = (normalized_ratings @ normalized_ratings[target_index].T).toarray().ravel()
+    similarities = np.clip(similarities, -1, 1) # guard against rounding errors, as pairwise_distances does
+    result = pd.Series(similarities, index = ratings.product_ids.values, name = 'similarity')
+    return result.drop(index = product_id) # Don't recommend the same product as the input.
+
+def get_top_similarities(similarities: pd.Series, limit = None) -> pd.Series:
+    """
+    Given product similarities, return the most similar products sorted by similarity.
+
+    With a limit, only the top results are selected (using a partial sort) and sorted, which is much faster than 
+    sorting every product when we only need a page of results.
+    """
+    if limit is None or limit >= len(similarities):
+        return similarities.sort_values(ascending = False)
+    top_indices = np.argpartition(-similarities.values, limit)[:limit]
+    return similarities.iloc[top_indices].sort_values(ascending = False)
+
+def get_co_raters(product_id: str, ratings: RatingMatrix) -> pd.Series:
+    """
+    Given a sparse matrix of product reviews by users, return the number of users who rated both the given product and each other product.
+    """
+    rated = (ratings.ratings != 0).astype(np.int32)
+    target_index = ratings.product_index(product_id)
+    counts = (rated @ rated[target_index].T).toarray().ravel()
+    result = pd.Series(counts, index = ratings.product_ids.values, name = 'co_raters')
+    return result.drop(index = product_id)
+
+@tracer.traced()
+def get_batch_similarities(product_ids, ratings: RatingMatrix, reviewer_pools = None, product_max_pool_size = None) -> np.ndarray:
+    """
+    Given a sparse matrix of product reviews by users, return the similarities of several products to every other product
+    as a dense array with one row per product in product_ids and one column per product in ratings.product_ids.
+
+    All rows are computed with a few sparse matrix products, which is much faster than calling get_product_similarities
+    once per product. Unlike get_product_similarities, each product's similarity to itself is included.
+
+    Parameters
+    ----------
+    - reviewer_pools: optionally, one collection of user ids per product. Each product's similarities are then computed 
+      from the ratings of its own pool of users only, exactly as if the matrix only contained those users.
+    - product_max_pool_size: optionally, the maximum number of products to compare each product against, keeping the 
+      products rated by the most users in its pool (as rev.filter_reviews does, including its preference for earlier ids
+      on ties). Products outside the pool, or not rated by any user in the pool, get a similarity of NaN.
+    """
+    target_indices = [ratings.product_index(product_id) for product_id in product_ids]
+    if reviewer_pools is None:
+        normalized_ratings = normalize(ratings.ratings)
+        similarities = (normalized_ratings[target_indices] @ normalized_ratings.T).toarray()
+        return np.clip(similarities, -1, 1)
+
+    # pools: a (products x users) mask of the users in each product's pool
+    rows = np.repeat(np.arange(len(reviewer_pools)), [len(pool) for pool in reviewer_pools])
+    columns = ratings.user_ids.get_indexer(np.concatenate([np.asarray(pool) for pool in reviewer_pools]))
+    rows, columns = rows[columns >= 0], columns[columns >= 0]
+    pools = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape = (len(reviewer_pools), ratings.shape[1]))
+
+    # dot products and vector lengths restricted to the users of each pool
+    dot_products = (ratings.ratings[target_indices].multiply(pools) @ ratings.ratings.T).toarray()
+    norms = np.sqrt((pools @ ratings.ratings.multiply(ratings.ratings).T).toarray())
+    target_norms = norms[np.arange(len(target_indices)), target_indices][:, np.newaxis]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        similarities = np.clip(np.nan_to_num(dot_products / (norms * target_norms)), -1, 1)
+
+    # only compare against products rated by users in the pool, limited to the most rated products
+    rater_counts = (pools @ (ratings.ratings != 0).astype(float).T).toarray()
+    similarities[rater_counts == 0] = np.nan
+    if product_max_pool_size != None and product_max_pool_size < ratings.shape[0]:
+        # rank by rater count, then by earlier product: product ids are sorted (see get_sparse_ratings_by_user)
+        product_count = ratings.shape[0]
+        ranks = rater_counts * product_count + (product_count - 1 - np.arange(product_count))
+        outside_pool = np.argpartition(-ranks, product_max_pool_size, axis = 1)[:, product_max_pool_size:]
+        np.put_along_axis(similarities, outside_pool, np.nan, axis = 1)
+    return similarities
+
+def get_product_neighbors(product_id: str, reviews: pd.DataFrame, limit = 100) -> pd.DataFrame:
+    """
+    Given a dataset of users, products, and ratings, return the products most similar to the one with the passed in product ID,
+    along with the number of users who rated both products. Unlike get_recommendations_from_reviews, no product details are added.
+
+    This is the unit of work for precomputed recommendations (see shared/precompute.py).
+    """
+    ratings = get_sparse_ratings_by_user(reviews)
+    similarities = get_top_similarities(get_product_similarities(product_id, ratings), limit = limit)
+    co_raters = get_co_raters(product_id, ratings)
+    result = pd.concat([similarities, co_raters.loc[similarities.index]], axis = 1)
+    result.index.name = 'neighbor_id'
+    return result
                         
+@tracer.traced()
 def get_recommendations_from_reviews(
     product_id: str,
     reviews: pd.DataFrame,
@@ -233,7 +795,8 @@ def get_recommendations_from_reviews(
     limit = 100,
     fill_value = 0,
     verbosity = query_verbosity, t = None,
-    remove_duplicates = True
+    remove_duplicates = True,
+    by_work = False
 ) -> pd.DataFrame:
     """
     Given a dataset of users, products, and ratings, return a list of products 
@@ -241,45 +804,225 @@ def get_recommendations_from_reviews(
     normalized similarity score with 1 = identical product, 0 = not at all similar.
 
     Tip: use get_related_reviews to obtain a good dataset for a product.
+    Returns None if the product has no reviews by known users in the dataset, as get_recommendations_batch does.
 
     Parameters
     ---------
     - fill_value: the rating to fill in if a user has not rated a product
+    - by_work: compute similarities between works instead of products (see get_ratings_by_work). Ratings of all editions
+      of a work count towards it, so there are no duplicate editions to remove, and other editions of the product itself 
+      are not recommended. Each work is represented by its most reviewed edition, with its work_id as the last column.
     """
     # recommendation tables can get enormous. Apply some sanity checks first:
     t = t or time.perf_counter()
-    def profile(message: str):
-        if verbosity > 0:
-            elapsed = time.perf_counter() - t
-            print(f"{elapsed:.3}: {message}")
-    user_count = len(reviews.user_id.unique())
-    product_count = len(reviews.product_id.unique())
-    
+    profile = tracer.logger(verbosity, t)
+    target_id = product_id
+    if by_work:
+        work_ids = get_work_ids(reviews.product_id.unique(), conn)
+        if product_id not in work_ids.index:
+            profile('No reviews by known users to recommend from')
+            return None
+        target_id = work_ids[product_id]
+        count = len(reviews)
+        reviews = get_ratings_by_work(reviews, work_ids)
+        profile(f'Merged {count} reviews into {len(reviews)} ratings of {len(work_ids)} products by work', work_ratings = len(reviews))
     # crunch the numbers to find similar products using cosine similarity
-    user_ratings_per_product = get_ratings_by_user(reviews)
-    pairwise_product_similarities = get_pairwise_similarities(user_ratings_per_product)
-    profile('Calculated similarities')
-
-    # recommended products sorted by most similar
-    recommendations = pairwise_product_similarities.loc[product_id].sort_values(ascending = False)
-    recommendations.drop(index = product_id, inplace = True) # Don't recommend the same product as the input.
-    recommendations.name = 'similarity'
+    user_ratings_per_product = get_sparse_ratings_by_user(reviews)
+    if target_id not in user_ratings_per_product.product_ids:
+        profile('No reviews by known users to recommend from')
+        return None
+    similarities = get_product_similarities(target_id, user_ratings_per_product)
+    profile('Calculated similarities', pool_products = user_ratings_per_product.shape[0], pool_users = user_ratings_per_product.shape[1])
+
+    if by_work:
+        recommendations = get_top_similarities(similarities, limit = limit)
+        details = get_work_details(recommendations.index, conn, verbosity = 0)
+        recommendations = pd.concat([recommendations, details], axis = 1).rename_axis('work_id').reset_index().set_index('id')
+        # the same columns as other recommendations, with the work id last
+        columns = [column for column in recommendations.columns if column not in ('work_id', 'title_search', 'creator_search')]
+        recommendations = recommendations[columns + ['work_id']].rename_axis(None)
+        profile('Added product details', recommendations = len(recommendations))
+        return recommendations
+
+    # recommended products sorted by most similar. Only the top candidates need sorting and product details, 
+    # but removing duplicate editions can eat into the candidates, so widen the selection until we have enough.
+    candidate_count = None if limit is None else limit * 2
+    while True:
+        recommendations = get_top_similarities(similarities, limit = candidate_count)
     
-    # add product data for user-facing results. We only have product Ids.
-    details = get_product_details(recommendations.index, conn, verbosity = 0)
-    recommendations = pd.concat([recommendations, details], axis = 1).rename(columns = {product_id: 'score'})
-    if remove_duplicates:
-        count = len(recommendations)
-        recommendations = remove_duplicate_products(recommendations)
-        if len(recommendations) < count:
-            profile(f'Removed {count - len(recommendations)} duplicate editions of the same product')
+        # add product data for user-facing results. We only have product Ids.
+        details = get_product_details(recommendations.index, conn, verbosity = 0)
+        recommendations = pd.concat([recommendations, details], axis = 1).rename(columns = {product_id: 'score'})
+        if remove_duplicates:
+            count = len(recommendations)
+            recommendations = remove_duplicate_products(recommendations)
+            if len(recommendations) < count:
+                profile(f'Removed {count - len(recommendations)} duplicate editions of the same product')
+        if candidate_count is None or len(recommendations) >= limit or candidate_count >= len(similarities):
+            break
+        candidate_count *= 2
 
     if limit != None:
         recommendations = recommendations[:limit]
     recommendations = recommendations.drop(columns = ['title_search', 'creator_search'])
-    profile('Added product details')
+    profile('Added product details', recommendations = len(recommendations))
     return recommendations
 
+@tracer.traced()
+def get_precomputed_recommendations(
+    product_id: str,
+    conn: sql.Connection,
+    limit = 100,
+    verbosity = query_verbosity,
+    remove_duplicates = True
+) -> pd.DataFrame:
+    """
+    Returns recommendations for a product from the product_similarity table (see shared/precompute.py) using a single indexed lookup.
+    The result has the same format as get_recommendations_from_reviews, with an added co_raters column.
+
+    Products that have not been precomputed return no recommendations.
+    """
+    q = """
+    SELECT neighbor_id, similarity, co_raters, p.* 
+    FROM product_similarity s JOIN product p ON s.neighbor_id = p.id
+    WHERE s.product_id = ?
+    ORDER BY similarity DESC
+    """
+    recommendations = query(q, conn, params = [product_id], query_description = 'precomputed recommendations', verbosity = verbosity)
+    recommendations = recommendations.drop(columns = 'id').set_index('neighbor_id')
+    recommendations.index.name = None
+    if remove_duplicates:
+        recommendations = remove_duplicate_products(recommendations)
+    if limit != None:
+        recommendations = recommendations[:limit]
+    return recommendations.drop(columns = ['title_search', 'creator_search'])
+
+@tracer.traced()
+def get_corating_recommendations(
+    product_id: str,
+    conn: sql.Connection,
+    limit = 100,
+    verbosity = query_verbosity,
+    remove_duplicates = True
+) -> pd.DataFrame:
+    """
+    Returns recommendations for a product from the co-rating stats maintained on ingest (see sql_ingest.build_corating_stats).
+    The result has the same format as get_precomputed_recommendations.
+
+    Similarities are the cosine similarity of the full rating vectors: dot product / sqrt(norm * neighbor norm), over all 
+    helpful reviews rather than a reviewer pool. Products that are not tracked return no recommendations.
+    """
+    norm = conn.execute("SELECT sum_squares FROM product_norm WHERE product_id = ?", [product_id]).fetchone()
+    norm = np.nan if norm is None else norm[0]
+    # dot products are positive, so ranking by dot product ^ 2 / neighbor norm ranks by similarity without needing sqrt in SQL
+    q = """
+    SELECT c.neighbor_id, c.dot_product, n.sum_squares AS neighbor_sum_squares, c.co_raters, p.*
+    FROM product_corating c JOIN product_norm n ON n.product_id = c.neighbor_id JOIN product p ON p.id = c.neighbor_id
+    WHERE c.product_id = ?
+    ORDER BY c.dot_product * c.dot_product / n.sum_squares DESC, c.neighbor_id
+    LIMIT ?
+    """
+    # removing duplicate editions can eat into the neighbors, so widen the search until we have enough (see get_recommendations_from_reviews)
+    candidate_count = -1 if limit is None else limit * 2 # a negative limit means no limit in SQLite
+    while True:
+        recommendations = query(q, conn, params = [product_id, candidate_count], query_description = 'co-rating recommendations', verbosity = verbosity)
+        count = len(recommendations)
+        recommendations.insert(1, 'similarity', recommendations.dot_product / np.sqrt(norm * recommendations.neighbor_sum_squares))
+        recommendations = recommendations.drop(columns = ['id', 'dot_product', 'neighbor_sum_squares']).set_index('neighbor_id')
+        recommendations.index.name = None
+        if remove_duplicates:
+            recommendations = remove_duplicate_products(recommendations)
+        if limit is None or len(recommendations) >= limit or count < candidate_count:
+            break
+        candidate_count *= 2
+    if limit != None:
+        recommendations = recommendations[:limit]
+    return recommendations.drop(columns = ['title_search', 'creator_search'])
+
+@tracer.traced()
+def get_ann_recommendations(
+    product_id: str,
+    index,
+    conn: sql.Connection,
+    limit = 100,
+    max_candidates = None,
+    verbosity = query_verbosity, t = None,
+    remove_duplicates = True
+) -> pd.DataFrame:
+    """
+    Returns recommendations for a product from an approximate nearest neighbor index (see shared/ann.py), which searches
+    every product of the indexed category rather than only the products reachable through the product's own reviewers.
+    Being approximate, it misses some of the nearest neighbors (see ann.build_index for its recall). With max_candidates,
+    at most that many products are compared exactly (see ann.AnnIndex.get_candidates).
+    The result has the same format as get_recommendations_from_reviews.
+
+    Products that are not in the index return no recommendations.
+    """
+    t = t or time.perf_counter()
+    profile = tracer.logger(verbosity, t)
+    # removing duplicate editions can eat into the neighbors, so widen the search until we have enough (see get_recommendations_from_reviews)
+    candidate_count = None if limit is None else limit * 2
+    while True:
+        similarities = index.get_neighbors(product_id, limit = candidate_count, max_candidates = max_candidates)
+        details = get_product_details(similarities.index, conn, verbosity = 0)
+        recommendations = pd.concat([similarities, details], axis = 1)
+        if remove_duplicates:
+            count = len(recommendations)
+            recommendations = remove_duplicate_products(recommendations)
+            if len(recommendations) < count:
+                profile(f'Removed {count - len(recommendations)} duplicate editions of the same product')
+        if candidate_count is None or len(recommendations) >= limit or len(similarities) < candidate_count:
+            break
+        candidate_count *= 2
+    if limit != None:
+        recommendations = recommendations[:limit]
+    return recommendations.drop(columns = ['title_search', 'creator_search'])
+
+@tracer.traced()
+def get_recommendation_pool(
+    product_id: str,
+    conn: sql.Connection,
+    filter_unhelpful_reviews = True,
+    reviewer_max_pool_size = 100,
+    product_max_pool_size = 1_000,
+    verbosity = query_verbosity, t = None,
+    store = None,
+    by_work = False
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Fetches the data that recommendations for a product are computed from. 
+    Returns a tuple of (reviews of the product, related reviews to compute similarities from).
+    With by_work, the reviews of all editions of the product are used (see get_edition_ids).
+
+    See get_recommendations for a description of the parameters.
+    """
+    t = t or time.perf_counter()
+    profile = tracer.logger(verbosity, t)
+
+    reviews = get_reviews(get_edition_ids(product_id, conn) if by_work else product_id, conn, verbosity = 0, store = store)
+    profile(f'Got {len(reviews)} reviews', reviews = len(reviews))
+    if filter_unhelpful_reviews:
+        count = len(reviews)
+        reviews = _filter_unhlepful_reviews(reviews)
+        if len(reviews) < count:
+            profile(f'Filtered {len(reviews)} helpful reviews')
+
+    # get related reviews for recommendations, limited to the most active reviewers and the most reviewed products
+    related_reviews = get_related_reviews(
+        reviews, 
+        conn, 
+        filter_unhelpful_reviews = False,
+        max_reviewer_count = reviewer_max_pool_size,
+        max_product_count = product_max_pool_size,
+        verbosity = verbosity, t = t,
+        store = store
+    )
+    return reviews, related_reviews
+
+# Valid values of get_recommendations(source = ...)
+recommendation_sources = ['live', 'works', 'precomputed', 'corating', 'ann']
+
+@tracer.traced()
 def get_recommendations(
     category: str,
 
@@ -296,6 +1039,10 @@ def get_recommendations(
     product_max_pool_size = 1_000, # maximum number of products to consider for recommendations
     missing_rating_value = 0,   # the value to fill in for rating when a user has not rated a product
     limit = 100,    # maximum number of recommendations
+    source = 'live',    # 'live' computes recommendations from reviews. 'works' does the same for works instead of editions (see get_ratings_by_work). 'precomputed' reads them from the product_similarity table (see shared/precompute.py). 'corating' reads co-rating stats (see sql_ingest.build_corating_stats). 'ann' searches ann_index, which finds most but not all of the nearest neighbors.
+    store = None,   # optional ReviewStore to read reviews from memory instead of the database (see shared/review_store.py)
+    ann_index = None,   # approximate nearest neighbor index for source = 'ann' (see shared/ann.py)
+    ann_max_candidates = None,  # for source = 'ann': the maximum number of products to compare exactly. Lower is faster, but finds fewer of the nearest neighbors (see ann.build_index).
 
     # misc settings
     verbosity = query_verbosity, t = None,
@@ -307,11 +1054,10 @@ def get_recommendations(
     This method is intended to be the first method listed because it is the most central. Due to Python limitations though, it needs to be listed 
     last because Python requires us to define our utility methods before defining the methods using the utility methods.
     """
+    if source not in recommendation_sources:
+        raise ValueError(f"Unknown recommendation source {source!r}. Valid sources: {', '.join(recommendation_sources)}")
     t = t or time.perf_counter()
-    def profile(message: str):
-        if verbosity > 0:
-            elapsed = time.perf_counter() - t
-            print(f"{elapsed:.3}: {message}")
+    profile = tracer.logger(verbosity, t)
     
     # fetch matching products (no reviews yet)
     products = find_products(
@@ -321,7 +1067,7 @@ def get_recommendations(
         conn = conn, 
         verbosity = verbosity
     )
-    profile(f'Found {len(products)} products')
+    profile(f'Found {len(products)} products', products = len(products))
 
     # handle product results (none, exact match, multiple matches)
     count = products.shape[0]
@@ -332,36 +1078,66 @@ def get_recommendations(
     recommendations = None
     if product is not None:
         #product_ids = product.id if search_field == 'title' else products.id
-        product_ids = product.id
-        reviews = get_reviews(product_ids, conn, verbosity = 0)
-        profile(f'Got {len(reviews)} reviews')
-        if filter_unhelpful_reviews:
-            count = len(reviews)
-            reviews = _filter_unhlepful_reviews(reviews)
-            if len(reviews) < count:
-                profile(f'Filtered {len(reviews)} helpful reviews')
-
-        # get related reviews for recommendations
-        related_reviews = get_related_reviews(
-            reviews, 
-            conn, 
-            filter_unhelpful_reviews = False,
-            max_reviewer_count = reviewer_max_pool_size,
-            verbosity = verbosity, t = t
-        )
-        if filter_unhelpful_reviews:
-            count = len(related_reviews)
-            related_reviews = rev.filter_reviews(related_reviews, reviewer_max_pool_size, product_max_pool_size)
-            if len(related_reviews) < count:
-                profile(f'Filtered {len(related_reviews)} of {count} helpful reviews')
-        recommendations = get_recommendations_from_reviews(
-            product.id, 
-            related_reviews, 
-            conn, 
-            limit = limit, fill_value = missing_rating_value,
-            verbosity = verbosity, t = t, 
-            remove_duplicates = remove_duplicates
-        )
+        if source == 'precomputed':
+            reviews = get_reviews(product.id, conn, verbosity = 0, store = store)
+            if filter_unhelpful_reviews:
+                reviews = _filter_unhlepful_reviews(reviews)
+            recommendations = get_precomputed_recommendations(
+                product.id, 
+                conn, 
+                limit = limit, 
+                verbosity = 0, 
+                remove_duplicates = remove_duplicates
+            )
+            profile(f'Got {len(recommendations)} precomputed recommendations')
+        elif source == 'corating':
+            reviews = get_reviews(product.id, conn, verbosity = 0, store = store)
+            if filter_unhelpful_reviews:
+                reviews = _filter_unhlepful_reviews(reviews)
+            recommendations = get_corating_recommendations(
+                product.id, 
+                conn, 
+                limit = limit, 
+                verbosity = 0, 
+                remove_duplicates = remove_duplicates
+            )
+            profile(f'Got {len(recommendations)} co-rating recommendations')
+        elif source == 'ann':
+            if ann_index is None:
+                raise ValueError("source = 'ann' requires an ann_index (see shared/ann.py)")
+            reviews = get_reviews(product.id, conn, verbosity = 0, store = store)
+            if filter_unhelpful_reviews:
+                reviews = _filter_unhlepful_reviews(reviews)
+            recommendations = get_ann_recommendations(
+                product.id,
+                ann_index,
+                conn,
+                limit = limit,
+                max_candidates = ann_max_candidates,
+                verbosity = verbosity, t = t,
+                remove_duplicates = remove_duplicates
+            )
+            profile(f'Got {len(recommendations)} approximate nearest neighbor recommendations')
+        else: # live or works
+            reviews, related_reviews = get_recommendation_pool(
+                product.id, 
+                conn, 
+                filter_unhelpful_reviews = filter_unhelpful_reviews,
+                reviewer_max_pool_size = reviewer_max_pool_size,
+                product_max_pool_size = product_max_pool_size,
+                verbosity = verbosity, t = t,
+                store = store,
+                by_work = source == 'works'
+            )
+            recommendations = get_recommendations_from_reviews(
+                product.id, 
+                related_reviews, 
+                conn, 
+                limit = limit, fill_value = missing_rating_value,
+                verbosity = verbosity, t = t, 
+                remove_duplicates = remove_duplicates,
+                by_work = source == 'works'
+            )
     
     return {
         "result": product,
@@ -370,3 +1146,101 @@ def get_recommendations(
         "recommendations": recommendations
     }
 
+
+@tracer.traced()
+def get_recommendations_batch(
+    product_ids,
+    conn: sql.Connection,
+    filter_unhelpful_reviews = True,
+    reviewer_max_pool_size = 100,
+    product_max_pool_size = 1_000,
+    limit = 100,
+    verbosity = query_verbosity, t = None,
+    remove_duplicates = True
+) -> dict:
+    """
+    Computes recommendations for many products at once, e.g. for a page of products or a nightly email run.
+    Returns a dictionary of product id -> recommendations in the same format as get_recommendations_from_reviews.
+    Products without helpful reviews by known users map to None.
+
+    Instead of repeating the related review fetch and the similarity computation once per product, the reviewers of all
+    products are fetched in one query into one shared rating matrix, and the similarities of all products are computed
+    together (see get_batch_similarities). Each product is still compared using only its own pool of reviewers and products,
+    so results match get_recommendations for a single product: equally active reviewers and equally rated products
+    are picked in id order in both.
+
+    Parameters
+    ----------
+    - product_ids: the ids of the products to recommend for
+    - Other parameters are as in get_recommendations.
+    """
+    t = t or time.perf_counter()
+    profile = tracer.logger(verbosity, t)
+
+    product_ids = list(dict.fromkeys(product_ids)) # remove duplicates, preserving order
+    results = dict.fromkeys(product_ids)
+    reviews = get_reviews(product_ids, conn, drop_null_reviewers = True, fields = 'user_id, product_id, upvotes, downvotes', verbosity = 0)
+    if filter_unhelpful_reviews:
+        reviews = _filter_unhlepful_reviews(reviews)
+    profile(f'Got {len(reviews)} reviews of {len(product_ids)} products')
+
+    # select the reviewer pool of each product as get_related_reviews does, then fetch the reviews of all pools at once
+    user_ids = reviews.user_id.unique()
+    use_user_stats = reviewer_max_pool_size != None and table_exists('user_stats', conn)
+    def select_reviewers(reviews: pd.DataFrame, activity: pd.Series) -> pd.DataFrame:
+        # the most active reviewers of each product, equally active reviewers in id order (see get_most_active_users)
+        reviews = reviews.assign(activity = reviews.user_id.map(activity).fillna(0))
+        reviews = reviews.sort_values(['activity', 'user_id'], ascending = [False, True], kind = 'stable')
+        return reviews.groupby('product_id').head(reviewer_max_pool_size)
+    if use_user_stats:
+        values, params = placeholders(user_ids)
+        activity = query(
+            f"SELECT user_id, review_count FROM user_stats WHERE user_id IN ({values})", conn, 
+            params = params, query_description = 'reviewer activity', verbosity = 0
+        ).set_index('user_id').review_count
+        reviews = select_reviewers(reviews, activity)
+        user_ids = reviews.user_id.unique()
+        profile(f'Selected {len(user_ids)} most active reviewers')
+    related_reviews = get_records_by_ids(
+        user_ids, 
+        table = 'review', id_column = 'user_id', select = 'user_id, product_id, rating, upvotes, downvotes', 
+        connection = conn, 
+        verbosity = 0
+    )
+    if reviewer_max_pool_size != None and not use_user_stats:
+        reviews = select_reviewers(reviews, related_reviews.user_id.value_counts())
+    reviewer_pools = reviews.groupby('product_id').user_id.unique()
+    profile(f'Got {len(related_reviews)} related reviews by {len(user_ids)} users')
+
+    # compute the similarities of all products at once
+    ratings = get_sparse_ratings_by_user(related_reviews)
+    seeds = [product_id for product_id in product_ids if product_id in ratings.product_ids and product_id in reviewer_pools.index]
+    if len(seeds) == 0:
+        return results
+    similarities = get_batch_similarities(seeds, ratings, reviewer_pools = reviewer_pools[seeds].tolist(), product_max_pool_size = product_max_pool_size)
+    profile(f'Calculated similarities for {len(seeds)} products against {ratings.shape[0]} products')
+
+    # select the top candidates of every product, then fetch the details of all candidates at once
+    candidate_count = None if limit is None else limit * 2
+    candidates = {}
+    for seed, row in zip(seeds, similarities):
+        seed_similarities = pd.Series(row, index = ratings.product_ids.values, name = 'similarity').drop(index = seed).dropna()
+        candidates[seed] = get_top_similarities(seed_similarities, limit = candidate_count)
+    candidate_ids = pd.unique(np.concatenate([c.index.values for c in candidates.values()]))
+    details = get_product_details(candidate_ids, conn, verbosity = 0)
+    for seed, row in zip(seeds, similarities):
+        recommendations = pd.concat([candidates[seed], details.reindex(candidates[seed].index)], axis = 1)
+        if remove_duplicates:
+            recommendations = remove_duplicate_products(recommendations)
+            if limit != None and len(recommendations) < limit and len(candidates[seed]) == candidate_count:
+                # duplicate editions ate into the candidates: fall back to the full ranking for this product
+                seed_similarities = pd.Series(row, index = ratings.product_ids.values, name = 'similarity').drop(index = seed).dropna()
+                recommendations = get_top_similarities(seed_similarities)
+                recommendations = pd.concat([recommendations, get_product_details(recommendations.index, conn, verbosity = 0)], axis = 1)
+                recommendations = remove_duplicate_products(recommendations)
+        if limit != None:
+            recommendations = recommendations[:limit]
+        results[seed] = recommendations.drop(columns = ['title_search', 'creator_search'])
+    elapsed = time.perf_counter() - t
+    profile(f'Added product details. {len(product_ids) / elapsed:.1f} products / sec')
+    return results
@@ -0,0 +1,274 @@
+# review_store.py
+# An in-memory store of review ratings that serves review lookups by product or by user without going through SQLite.
+#
+# Finding related reviews is the hot path of live recommendations, and even with a covering index, fetching thousands of
+# reviews through an IN (...) query and pd.read_sql_query dominates its cost. ReviewStore loads the columns needed for
+# recommendations once into compact NumPy arrays, indexed both by user and by product, so that lookups become array gathers.
+#
+# Usage:
+#   store = ReviewStore.from_db(conn)     # once at startup: ~20 bytes per review plus the id dictionaries
+#   result = q.get_recommendations('Music', 'Nevermind', conn, store = store)
+import sqlite3 as sql
+import time
+
+import numpy as np
+import pandas as pd
+
+# The review columns held by the store
+columns = ['user_id', 'product_id', 'rating', 'upvotes', 'downvotes']
+
+class IdDictionary:
+    """
+    A sorted array of ids that encodes ids as their position in the array. String ids are held as fixed-width UTF-8 bytes,
+    which take far less memory than Python strings and can be memory-mapped (see shared/snapshot.py).
+    Integer ids (see shared/integer_keys.py) are held as integers.
+    """
+    def __init__(self, values: np.ndarray):
+        self.values = values
+
+    @classmethod
+    def from_ids(cls, ids) -> 'IdDictionary':
+        """
+        Creates a dictionary from sorted, unique ids
+        """
+        values = np.asarray(ids)
+        if values.dtype.kind in 'OU' or pd.api.types.is_string_dtype(values.dtype):
+            values = _encode(values)
+        return cls(values)
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes
+
+    def get_indexer(self, ids) -> np.ndarray:
+        """
+        Returns the code of each id, or -1 for ids that are missing (None) or not in the dictionary. Like pd.Index.get_indexer.
+        """
+        codes, unique_ids = pd.factorize(np.asarray(ids, dtype = object)) # missing ids get code -1
+        if len(self.values) == 0 or len(unique_ids) == 0:
+            return np.full(len(codes), -1, dtype = np.int64)
+        # only look up each distinct id once
+        keys = _encode(unique_ids) if self.values.dtype.kind == 'S' else np.asarray(unique_ids).astype(self.values.dtype)
+        positions = np.minimum(np.searchsorted(self.values, keys), len(self.values) - 1)
+        unique_codes = np.where(self.values[positions] == keys, positions, -1)
+        return np.where(codes >= 0, unique_codes[codes], -1)
+
+    def take(self, codes: np.ndarray) -> np.ndarray:
+        """
+        Returns the ids of the given codes as an object array. Raises a ValueError for negative codes (missing ids),
+        which NumPy would otherwise silently map to the last ids.
+        """
+        codes = np.asarray(codes)
+        if len(codes) > 0 and codes.min() < 0:
+            raise ValueError('Can not take ids of negative codes (missing ids)')
+        if self.values.dtype.kind != 'S':
+            return self.values[codes].astype(object)
+        unique_codes, inverse = np.unique(codes, return_inverse = True) # only decode each distinct id once
+        return _decode(self.values[unique_codes])[inverse]
+
+def _encode(ids: np.ndarray) -> np.ndarray:
+    ids = np.asarray(ids).astype(str)
+    try:
+        return ids.astype(bytes) # fast path for ASCII ids, which are all we have in practice
+    except UnicodeEncodeError:
+        return np.char.encode(ids, 'utf-8')
+
+def _decode(values: np.ndarray) -> np.ndarray:
+    try:
+        return values.astype(str).astype(object)
+    except UnicodeDecodeError:
+        return np.char.decode(values, 'utf-8').astype(object)
+
+def build_index(codes: np.ndarray, count: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Builds a CSR-style index over integer codes in the range [0, count). Negative codes (missing values) are left out.
+    Returns (offsets, order): the rows with code i are order[offsets[i] : offsets[i + 1]].
+    """
+    counts = np.bincount(codes[codes >= 0], minlength = count)
+    offsets = np.zeros(count + 1, dtype = np.int64)
+    np.cumsum(counts, out = offsets[1:])
+    order = np.argsort(codes, kind = 'stable').astype(np.int32)
+    order = order[len(codes) - offsets[-1]:] # negative codes sort first
+    return offsets, order
+
+def gather(offsets: np.ndarray, order: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    """
+    Returns the rows of all given codes in a CSR-style index (see build_index) in one vectorized operation.
+    """
+    starts, ends = offsets[codes], offsets[codes + 1]
+    lengths = ends - starts
+    # positions within order: each code's start offset plus 0, 1, ... for each of its rows
+    shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return order[np.arange(lengths.sum()) + shifts]
+
+class ReviewStore:
+    """
+    Holds the user, product, rating and vote columns of the review table in NumPy arrays, with user and product ids
+    encoded as integer codes into sorted id dictionaries (see IdDictionary). Reviews are indexed both by user and by product (CSR style),
+    so that fetching all reviews of a set of users or products is a vectorized gather.
+
+    The store is a snapshot: reviews ingested after it was loaded are not included.
+    """
+    def __init__(
+        self,
+        user_codes: np.ndarray, product_codes: np.ndarray,
+        ratings: np.ndarray, upvotes: np.ndarray, downvotes: np.ndarray,
+        user_ids: IdDictionary, product_ids: IdDictionary,
+        user_index: tuple = None, product_index: tuple = None,
+        user_helpful_review_counts: np.ndarray = None
+    ):
+        """
+        Parameters
+        ----------
+        - user_codes, product_codes: per review, the position of its user/product in user_ids/product_ids. -1 for reviews without a user.
+        - ratings, upvotes, downvotes: per review
+        - user_ids, product_ids: the id dictionaries
+        - user_index, product_index: optional precomputed (offsets, order) indexes, see build_index
+        - user_helpful_review_counts: optional precomputed number of helpful reviews per user
+        """
+        self.user_codes = user_codes
+        self.product_codes = product_codes
+        self.ratings = ratings
+        self.upvotes = upvotes
+        self.downvotes = downvotes
+        self.user_ids = user_ids
+        self.product_ids = product_ids
+        self.user_index = user_index or build_index(user_codes, len(user_ids))
+        self.product_index = product_index or build_index(product_codes, len(product_ids))
+        self.user_review_counts = np.diff(self.user_index[0])
+        if user_helpful_review_counts is None:
+            user_helpful_review_counts = np.bincount(
+                user_codes[(user_codes >= 0) & (upvotes >= downvotes)], minlength = len(user_ids)
+            )
+        self.user_helpful_review_counts = user_helpful_review_counts
+
+    def __len__(self):
+        return len(self.ratings)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The approximate memory footprint of the store in bytes
+        """
+        arrays = [
+            self.user_codes, self.product_codes, self.ratings, self.upvotes, self.downvotes,
+            *self.user_index, *self.product_index, self.user_review_counts, self.user_helpful_review_counts
+        ]
+        return sum(array.nbytes for array in arrays) + self.user_ids.nbytes + self.product_ids.nbytes
+
+    @classmethod
+    def from_frame(cls, reviews: pd.DataFrame) -> 'ReviewStore':
+        """
+        Builds a store from a DataFrame with (at least) the store columns.
+        """
+        product_codes, product_ids = pd.factorize(reviews.product_id, sort = True)
+        user_codes, user_ids = pd.factorize(reviews.user_id, sort = True) # missing users get code -1
+        return cls(
+            user_codes.astype(np.int32), product_codes.astype(np.int32),
+            reviews.rating.to_numpy(dtype = np.float32),
+            reviews.upvotes.to_numpy(dtype = np.int32), reviews.downvotes.to_numpy(dtype = np.int32),
+            IdDictionary.from_ids(user_ids), IdDictionary.from_ids(product_ids)
+        )
+
+    @classmethod
+    def from_db(cls, conn: sql.Connection, chunk_size = 1_000_000, verbosity = 1) -> 'ReviewStore':
+        """
+        Loads all reviews from the database. Reviews are read in chunks and encoded as they arrive, so that the full set
+        of id strings is never held in memory at once.
+
+        The id dictionaries hold the distinct ids of the review table itself (both are index scans), rather than the product
+        and user_stats tables: orphaned reviews (of products that no longer exist) and users missing from an outdated
+        user_stats table are then kept as they are, exactly as the database returns them.
+        """
+        t = time.perf_counter()
+        def profile(message: str):
+            if verbosity > 0:
+                elapsed = time.perf_counter() - t
+                print(f"{elapsed:.3}: {message}")
+
+        product_ids = IdDictionary.from_ids(pd.read_sql_query("SELECT DISTINCT product_id FROM review ORDER BY product_id", conn).product_id)
+        user_query = "SELECT DISTINCT user_id FROM review WHERE user_id IS NOT NULL ORDER BY user_id"
+        user_ids = IdDictionary.from_ids(pd.read_sql_query(user_query, conn).user_id)
+        profile(f'Loaded {len(product_ids):,d} product ids and {len(user_ids):,d} user ids')
+
+        chunks = {column: [] for column in columns}
+        cursor = conn.execute(f"SELECT {', '.join(columns)} FROM review")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            chunk = pd.DataFrame.from_records(rows, columns = columns)
+            chunks['user_id'].append(user_ids.get_indexer(chunk.user_id).astype(np.int32))
+            chunks['product_id'].append(product_ids.get_indexer(chunk.product_id).astype(np.int32))
+            chunks['rating'].append(chunk.rating.to_numpy(dtype = np.float32))
+            chunks['upvotes'].append(chunk.upvotes.to_numpy(dtype = np.int32))
+            chunks['downvotes'].append(chunk.downvotes.to_numpy(dtype = np.int32))
+            profile(f'Loaded {sum(len(c) for c in chunks["rating"]):,d} reviews')
+        arrays = {column: np.concatenate(chunks[column]) if len(chunks[column]) > 0 else np.array([], dtype = np.int32) for column in columns}
+        store = cls(
+            arrays['user_id'], arrays['product_id'],
+            arrays['rating'].astype(np.float32), arrays['upvotes'], arrays['downvotes'],
+            user_ids, product_ids
+        )
+        profile(f'Indexed {len(store):,d} reviews in {store.nbytes / 1024 ** 2:,.0f}MB')
+        return store
+
+    def get_frame(self, rows: np.ndarray) -> pd.DataFrame:
+        """
+        Returns the given rows as a DataFrame with the store columns, with ids decoded.
+        """
+        user_codes = self.user_codes[rows]
+        user_ids = self.user_ids.take(np.maximum(user_codes, 0)) if len(self.user_ids) > 0 else np.full(len(rows), None)
+        user_ids[user_codes < 0] = None
+        return pd.DataFrame({
+            'user_id': user_ids,
+            'product_id': self.product_ids.take(self.product_codes[rows]),
+            'rating': self.ratings[rows].astype(float),
+            'upvotes': self.upvotes[rows].astype(np.int64),
+            'downvotes': self.downvotes[rows].astype(np.int64)
+        })
+
+    def get_user_codes(self, user_ids) -> np.ndarray:
+        codes = self.user_ids.get_indexer(user_ids)
+        return codes[codes >= 0]
+
+    def get_product_codes(self, product_ids) -> np.ndarray:
+        codes = self.product_ids.get_indexer(product_ids)
+        return codes[codes >= 0]
+
+    def get_product_rows(self, product_ids, drop_null_reviewers = False) -> np.ndarray:
+        """
+        Returns the rows of all reviews of the given products
+        """
+        rows = gather(*self.product_index, self.get_product_codes(product_ids))
+        if drop_null_reviewers:
+            rows = rows[self.user_codes[rows] >= 0]
+        return rows
+
+    def get_user_rows(self, user_ids) -> np.ndarray:
+        """
+        Returns the rows of all reviews by the given users
+        """
+        return gather(*self.user_index, self.get_user_codes(user_ids))
+
+    def get_reviews(self, product_ids, drop_null_reviewers = False) -> pd.DataFrame:
+        return self.get_frame(self.get_product_rows(product_ids, drop_null_reviewers = drop_null_reviewers))
+
+    def get_reviews_by_users(self, user_ids) -> pd.DataFrame:
+        return self.get_frame(self.get_user_rows(user_ids))
+
+    def get_most_active_users(self, user_ids, limit: int, helpful_only = False) -> pd.Series:
+        """
+        The equivalent of query.get_most_active_users: returns up to limit of the given users with the most reviews, most active first.
+        Equally active users are ordered by id, as in query.get_most_active_users: codes follow sorted ids.
+        """
+        codes = np.sort(self.get_user_codes(user_ids))
+        counts = (self.user_helpful_review_counts if helpful_only else self.user_review_counts)[codes]
+        order = np.argsort(-counts, kind = 'stable')[:limit]
+        return pd.Series(self.user_ids.take(codes[order]), name = 'user_id')
+
+    def is_helpful(self, rows: np.ndarray) -> np.ndarray:
+        return self.upvotes[rows] >= self.downvotes[rows]
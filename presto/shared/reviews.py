@@ -1,5 +1,8 @@
+import numpy as np
 import pandas as pd
 
+from shared.profile import tracer
+
 def sort_reviews(
     reviews: pd.DataFrame,
     include_quality = True  # inserts a 'quality' metric that measures the quality of the user review 
@@ -27,20 +30,72 @@ def review_summary(reviews: pd.DataFrame, name = 'Review Summary') -> pd.DataFra
         name = name
     )
 
-def filter_reviews(reviews: pd.DataFrame, max_user_count = None, max_product_count = None) -> pd.DataFrame:
+def get_top_codes(codes: np.ndarray, limit: int) -> np.ndarray:
+    """
+    Given integer codes (e.g. encoded user ids), returns a boolean mask per code value that is True for the limit most frequent codes.
+    Ties at the cut-off are broken in favor of lower codes, i.e. earlier ids when codes follow sorted ids.
+
+    Counting is a single np.bincount and the cut-off count is found with a partial sort (np.partition), so this is linear 
+    in the number of codes rather than sorting every distinct id by its count.
+    """
+    counts = np.bincount(codes)
+    keep = counts > 0
+    present = np.flatnonzero(keep)
+    if len(present) > limit:
+        present_counts = counts[present]
+        threshold = np.partition(present_counts, len(present) - limit)[len(present) - limit]
+        above = present[present_counts > threshold]
+        ties = present[present_counts == threshold][:limit - len(above)]
+        keep[:] = False
+        keep[above] = True
+        keep[ties] = True
+    return keep
+
+def get_codes(ids: pd.Series) -> np.ndarray:
+    """
+    Returns integer codes for a column of ids, -1 for missing ids. Codes follow sorted id order.
+    Categorical columns (see query.review_dtypes) already carry codes, so nothing is hashed or copied.
+    """
+    if isinstance(ids.dtype, pd.CategoricalDtype):
+        return ids.cat.codes.to_numpy()
+    return pd.factorize(ids, sort = True)[0]
+
+def get_filter_mask(user_codes: np.ndarray, product_codes: np.ndarray, max_user_count = None, max_product_count = None) -> np.ndarray:
+    """
+    The equivalent of filter_reviews on integer-encoded user and product ids (negative codes for missing ids).
+    Returns a boolean mask of the reviews to keep. Codes are only needed for the ids that are limited.
+    """
+    mask = np.ones(len(user_codes if user_codes is not None else product_codes), dtype = bool)
+    if max_user_count != None:
+        mask &= user_codes >= 0
+        keep = get_top_codes(user_codes[mask], max_user_count)
+        mask[mask] = keep[user_codes[mask]]
+    if max_product_count != None:
+        mask &= product_codes >= 0
+        keep = get_top_codes(product_codes[mask], max_product_count)
+        mask[mask] = keep[product_codes[mask]]
+    return mask
+
+@tracer.traced()
+def filter_reviews(reviews: pd.DataFrame, max_user_count = None, max_product_count = None, store = None) -> pd.DataFrame:
     """
     Filter reviews to encompass a limited number of users and/or products. Users and products will be filtered out 
     by how infrequently they appear in the dataset.
 
     This is intended to improve both the performance and relevance of recommendations by filtering low-quality data.
+
+    Ids are encoded as integer codes (see get_codes) and counted with np.bincount instead of grouping by id strings, 
+    and the result is selected with a single boolean mask. When nothing is filtered out, reviews are returned as is.
+    With a ReviewStore (see shared/review_store.py), ids are encoded with the store's id dictionaries instead. 
+    Ids missing from the store are treated as missing.
     """
-    result = reviews.copy()
-    if max_user_count != None:
-        ratings_by_user = result.groupby('user_id')['rating'].count().sort_values(ascending = False)
-        users = ratings_by_user[:max_user_count]
-        result = result[result.user_id.isin(users.index)]
-    if max_product_count != None:
-        ratings_by_product = result.groupby('product_id')['rating'].count().sort_values(ascending = False)
-        products = ratings_by_product[:max_product_count]
-        result = result[result.product_id.isin(products.index)]
-    return result
\ No newline at end of file
+    if max_user_count == None and max_product_count == None:
+        return reviews
+    if store is not None:
+        user_codes = store.user_ids.get_indexer(reviews.user_id)
+        product_codes = store.product_ids.get_indexer(reviews.product_id)
+    else:
+        user_codes = get_codes(reviews.user_id) if max_user_count != None else None
+        product_codes = get_codes(reviews.product_id) if max_product_count != None else None
+    mask = get_filter_mask(user_codes, product_codes, max_user_count, max_product_count)
+    return reviews if mask.all() else reviews[mask]
\ No newline at end of file
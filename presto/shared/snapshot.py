@@ -0,0 +1,124 @@
+# snapshot.py
+# Exports the review store (see shared/review_store.py) to a directory of .npy files that worker processes can memory-map.
+#
+# Loading reviews from products.sql takes a while and leaves every process with a private copy. A snapshot is written once
+# after ingest. Loading it only maps the files, so workers start almost instantly and share the same pages through the OS cache.
+#
+# Usage (from the presto directory):
+#   python -m shared.snapshot --db data/products.sql --out data/snapshot
+#   store = snapshot.load_snapshot('data/snapshot')
+#   result = q.get_recommendations('Music', 'Nevermind', conn, store = store)
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import shared.query as q
+from shared.review_store import IdDictionary, ReviewStore
+
+# Increase when the snapshot layout changes, so that old snapshots are rejected rather than misread
+snapshot_version = 1
+metadata_file = 'metadata.json'
+
+def get_arrays(store: ReviewStore) -> dict:
+    """
+    Returns the arrays that make up a review store by file name
+    """
+    return {
+        'user_codes': store.user_codes,
+        'product_codes': store.product_codes,
+        'ratings': store.ratings,
+        'upvotes': store.upvotes,
+        'downvotes': store.downvotes,
+        'user_ids': store.user_ids.values,
+        'product_ids': store.product_ids.values,
+        'user_offsets': store.user_index[0],
+        'user_order': store.user_index[1],
+        'product_offsets': store.product_index[0],
+        'product_order': store.product_index[1],
+        'user_helpful_review_counts': store.user_helpful_review_counts
+    }
+
+def export_snapshot(store: ReviewStore, path: str, source: str = None, verbosity = 1):
+    """
+    Writes a review store to a snapshot directory, replacing any previous snapshot at that path.
+
+    The snapshot is written to a temporary directory first and then moved into place, so that processes never load a
+    partially written snapshot. Processes that already mapped the previous snapshot keep using it until they reload.
+    """
+    t = time.perf_counter()
+    temp_path = path.rstrip('/') + '.tmp'
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+    arrays = get_arrays(store)
+    for name, array in arrays.items():
+        np.save(os.path.join(temp_path, name + '.npy'), np.ascontiguousarray(array))
+    metadata = {
+        'version': snapshot_version,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'source': source,
+        'review_count': len(store),
+        'user_count': len(store.user_ids),
+        'product_count': len(store.product_ids),
+        'arrays': {name: {'dtype': array.dtype.str, 'shape': list(array.shape)} for name, array in arrays.items()}
+    }
+    with open(os.path.join(temp_path, metadata_file), 'w') as file:
+        json.dump(metadata, file, indent = 2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(temp_path, path)
+    if verbosity > 0:
+        print(f'{time.perf_counter() - t:.2f}: Exported {len(store):,d} reviews to {path}')
+
+def create_snapshot(db = 'data/products.sql', path = 'data/snapshot', verbosity = 1):
+    """
+    Loads all reviews from the database and exports them to a snapshot directory.
+    """
+    conn = q.connect(db, read_only = True)
+    store = ReviewStore.from_db(conn, verbosity = verbosity)
+    conn.close()
+    export_snapshot(store, path, source = os.path.abspath(db), verbosity = verbosity)
+
+def get_metadata(path: str) -> dict:
+    with open(os.path.join(path, metadata_file)) as file:
+        metadata = json.load(file)
+    if metadata.get('version') != snapshot_version:
+        raise ValueError(f"Snapshot {path} has version {metadata.get('version')}, expected {snapshot_version}. Please recreate it.")
+    return metadata
+
+def load_snapshot(path = 'data/snapshot', mmap = True, verbosity = 1) -> ReviewStore:
+    """
+    Loads a review store from a snapshot directory (see export_snapshot).
+
+    With mmap, arrays are memory-mapped read-only instead of read into memory: loading takes milliseconds regardless of
+    size and pages are read on first use, shared with every other process that maps the same snapshot.
+    """
+    t = time.perf_counter()
+    metadata = get_metadata(path)
+    arrays = {
+        name: np.load(os.path.join(path, name + '.npy'), mmap_mode = 'r' if mmap else None)
+        for name in metadata['arrays']
+    }
+    store = ReviewStore(
+        arrays['user_codes'], arrays['product_codes'],
+        arrays['ratings'], arrays['upvotes'], arrays['downvotes'],
+        IdDictionary(arrays['user_ids']), IdDictionary(arrays['product_ids']),
+        user_index = (arrays['user_offsets'], arrays['user_order']),
+        product_index = (arrays['product_offsets'], arrays['product_order']),
+        user_helpful_review_counts = arrays['user_helpful_review_counts']
+    )
+    if verbosity > 0:
+        print(f"{time.perf_counter() - t:.3f}: Loaded a snapshot of {len(store):,d} reviews created {metadata['created']}")
+    return store
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Export the review store to a memory-mappable snapshot directory')
+    parser.add_argument('--db', default = 'data/products.sql')
+    parser.add_argument('--out', default = 'data/snapshot')
+    args = parser.parse_args()
+    create_snapshot(db = args.db, path = args.out)